@@ -0,0 +1,128 @@
+import logging
+from typing import Dict, List, Optional
+
+from selenium.webdriver.common.by import By
+
+from waits import HUMAN_PACING
+
+# URL, title and readyState of the page in one command
+PAGE_STATE_SCRIPT = """
+return {url: location.href, title: document.title, ready_state: document.readyState};
+"""
+
+# Finds an element by CSS selector or XPath, the locator types of By
+FIND_ELEMENT_JS = """
+var find = function (by, selector) {
+    if (by === 'xpath') {
+        return document.evaluate(
+            selector, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+        ).singleNodeValue;
+    }
+    return document.querySelector(selector);
+};
+"""
+
+CLICK_SCRIPT = FIND_ELEMENT_JS + """
+var element = find(arguments[0], arguments[1]);
+if (!element) {
+    return false;
+}
+element.scrollIntoView({block: 'center'});
+element.click();
+return true;
+"""
+
+# Sets the value through the native setter, so frameworks tracking the value
+# (React, Vue) see the change, and fires the events typing would
+TYPE_SCRIPT = FIND_ELEMENT_JS + """
+var element = find(arguments[0], arguments[1]);
+if (!element) {
+    return false;
+}
+element.scrollIntoView({block: 'center'});
+element.focus();
+var proto = element instanceof HTMLTextAreaElement
+    ? HTMLTextAreaElement.prototype : HTMLInputElement.prototype;
+var setter = Object.getOwnPropertyDescriptor(proto, 'value').set;
+setter.call(element, arguments[2]);
+element.dispatchEvent(new Event('input', {bubbles: true}));
+element.dispatchEvent(new Event('change', {bubbles: true}));
+return true;
+"""
+
+
+class PageReads:
+    """
+    Reads of the current page for one step, each kind fetched with a single
+    WebDriver command and cached: all cookies with one get_cookies() instead
+    of a get_cookie() per name, URL, title and readyState with one script.
+    Create a new one after anything which may change the page.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._cookies = None
+        self._page = None
+
+    def cookies(self) -> List[Dict]:
+        if self._cookies is None:
+            self._cookies = self.driver.get_cookies()
+        return self._cookies
+
+    def cookie(self, name: str) -> Optional[Dict]:
+        for cookie in self.cookies():
+            if cookie['name'] == name:
+                return cookie
+        return None
+
+    def page(self) -> Dict:
+        if self._page is None:
+            self._page = self.driver.execute_script(PAGE_STATE_SCRIPT) or {}
+        return self._page
+
+    def url(self) -> str:
+        return self.page().get('url', '')
+
+    def title(self) -> str:
+        return self.page().get('title', '')
+
+    def ready_state(self) -> str:
+        return self.page().get('ready_state', '')
+
+
+def uses_keystrokes(step: Dict, settings: Dict) -> bool:
+    """
+    Whether the step clicks and types through WebDriver (real input events)
+    instead of fused in-page scripts. On by default with human pacing, for
+    anti-bot sites; 'keystrokes' in the step or the campaign settings decides
+    otherwise.
+    """
+    pacing = step.get('pacing', settings.get('pacing'))
+    return step.get('keystrokes', settings.get('keystrokes', pacing == HUMAN_PACING))
+
+
+def _locator(by) -> str:
+    return By.XPATH if by == By.XPATH else By.CSS_SELECTOR
+
+
+def fused_click(driver, by, selector: str) -> bool:
+    """
+    Finds, scrolls to and clicks an element in one command.
+
+    Returns:
+        bool: False if there is no such element.
+    """
+    clicked = bool(driver.execute_script(CLICK_SCRIPT, _locator(by), selector))
+    logging.info(f'Fused click on {selector}: {"done" if clicked else "not found"}')
+    return clicked
+
+
+def fused_type(driver, by, selector: str, text: str) -> bool:
+    """
+    Finds a form field, sets its value and dispatches input and change
+    events in one command.
+
+    Returns:
+        bool: False if there is no such element.
+    """
+    return bool(driver.execute_script(TYPE_SCRIPT, _locator(by), selector, text))
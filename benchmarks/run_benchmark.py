@@ -0,0 +1,226 @@
+"""
+Offline benchmark of the runner against the local stand-in shop.
+
+Usage (from the repository root, on a quiet machine):
+
+    python -m benchmarks.run_benchmark --journeys 20 --campaigns 2
+    python -m benchmarks.run_benchmark --workers 4 --output bench.json
+
+Reports journeys per minute, per-step latency percentiles and peak RSS of
+Python, chromedriver and Chrome.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import yaml
+
+# Runner modules use paths relative to the working directory (reports/, .cache/)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.standin_shop import TRACKING_HOST, StandInShop  # noqa: E402
+
+
+def purchase_journey(shop: StandInShop, title: str) -> Dict:
+    """
+    Full purchase through the affiliate hop: popup, add to cart, form
+    fields, dropdown, screenshot, confirm and order number capture.
+    """
+    return {
+        'title': title,
+        'steps': [
+            {'action': 'goto', 'url': shop.affiliate_url('/product')},
+            {'action': 'close_popup_window', 'selector': '#popup-close'},
+            {'action': 'click_add_to_cart', 'selector': '#add-to-cart'},
+            {'action': 'goto', 'url': shop.shop_url('/cart')},
+            {'action': 'type_in_data', 'selector': '#name', 'text': 'Test Testov'},
+            {'action': 'type_in_data', 'selector': '//input[@id="email"]',
+             'text': 'testings@testmail.com'},
+            {'action': 'type_in_data', 'selector': '#phone', 'text': '407-408-7313'},
+            {'action': 'drop_down_menu', 'selector': '#delivery', 'element': '6'},
+            {'action': 'scroll'},
+            {'action': 'make_screenshot'},
+            {'action': 'click_confirm_order', 'selector': '#confirm',
+             'wait_for': 'url_changes'},
+            {'action': 'capture_order_confirmation'},
+        ],
+    }
+
+
+def deeplink_journey(shop: StandInShop, title: str) -> Dict:
+    """
+    Deeplink check: affiliate hop, final URL and tracking cookies only.
+    """
+    return {
+        'title': title,
+        'steps': [{'action': 'goto', 'url': shop.affiliate_url('/product')}],
+    }
+
+
+def generate_campaigns(shop: StandInShop, campaigns_dir: str,
+                       campaigns: int, journeys: int) -> List[str]:
+    """
+    Writes campaign YAMLs for the stand-in shop, alternating full purchase
+    and deeplink journeys. Snapshots are off, so every purchase journey runs
+    all its steps instead of restoring the shared ones of the first.
+
+    Returns:
+        list: File names of the generated campaigns.
+    """
+    os.makedirs(campaigns_dir, exist_ok=True)
+    file_names = []
+    for number in range(campaigns):
+        campaign_id = 900000 + number
+        test_cases = []
+        for journey in range(journeys):
+            build = purchase_journey if journey % 2 == 0 else deeplink_journey
+            test_cases.append(build(shop, f'bench_{journey}'))
+        campaign = {f'standin_{number}': [{
+            'campaign_id': campaign_id,
+            'settings': {'tracking_domains': [TRACKING_HOST], 'snapshots': False},
+            'test_case': test_cases,
+        }]}
+        file_name = f'{campaign_id}_standin.yaml'
+        with open(os.path.join(campaigns_dir, file_name), 'w') as f:
+            yaml.safe_dump(campaign, f, allow_unicode=True, sort_keys=False)
+        file_names.append(file_name)
+    return file_names
+
+
+def percentiles(values: List[float], points=(50, 90, 99)) -> Dict[str, float]:
+    """
+    Nearest-rank percentiles of the values.
+    """
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        index = max(math.ceil(point / 100 * len(ordered)) - 1, 0)
+        result[f'p{point}'] = round(ordered[min(index, len(ordered) - 1)], 4)
+    return result
+
+
+def step_latencies(results: List[Dict]) -> Dict:
+    """
+    Per-action and overall step latency percentiles from the journey profiles.
+    """
+    by_action = defaultdict(list)
+    for result in results:
+        for span in (result.get('profile') or {}).get('steps', []):
+            by_action[span['action']].append(span['duration'])
+    latencies = {action: percentiles(values) for action, values in sorted(by_action.items())}
+    latencies['all'] = percentiles([v for values in by_action.values() for v in values])
+    return latencies
+
+
+def peak_rss_mb(results: List[Dict] = None, reports_dir: str = 'reports') -> Dict[str, float]:
+    """
+    Peak RSS in MB of Python, chromedriver and Chrome (with its renderers),
+    sampled after every step by the memory governor: from the journey
+    results, and from the run manifests of worker runs.
+    """
+    from memory import memory_high_water
+
+    peak = dict(memory_high_water(results or [])['peak_mb'])
+    for path in glob.glob(os.path.join(reports_dir, '*', '*.manifest.json')):
+        with open(path) as f:
+            manifest_peak = (json.load(f).get('memory') or {}).get('peak_mb') or {}
+        for key, value in manifest_peak.items():
+            peak[key] = max(peak.get(key, 0), value)
+    return peak
+
+
+def bench_shopper_actions(campaigns_dir: str, file_names: List[str]) -> Dict:
+    """
+    Runs the journeys through `shopper_actions_by_steps` with one browser,
+    without the result writing and isolation of the campaign runner.
+    """
+    from main import fresh_browser, load_campaigns
+    from run_func import shopper_actions_by_steps
+
+    campaigns = load_campaigns(file_names, campaigns_dir)
+    driver = fresh_browser()
+    results = []
+    try:
+        started = time.time()
+        for campaign in campaigns:
+            for user_journey in campaign.journeys:
+                results.append(shopper_actions_by_steps(
+                    driver, campaign.campaign_id, user_journey,
+                    settings=campaign.settings))
+        elapsed = time.time() - started
+    finally:
+        driver.quit()
+    return {
+        'journeys': len(results),
+        'seconds': round(elapsed, 2),
+        'journeys_per_minute': round(len(results) / elapsed * 60, 2) if elapsed else None,
+        'step_latency': step_latencies(results),
+        'peak_rss_mb': peak_rss_mb(results),
+    }
+
+
+def bench_campaign_runner(campaigns_dir: str, file_names: List[str], workers: int) -> Dict:
+    """
+    Runs the campaigns end to end through `complete_purchase_and_save_results`.
+    """
+    from main import complete_purchase_and_save_results, load_campaigns
+
+    journeys = sum(len(c.journeys) for c in load_campaigns(file_names, campaigns_dir))
+    started = time.time()
+    complete_purchase_and_save_results(
+        workers=workers, run_test_for=file_names, campaigns_dir=campaigns_dir)
+    elapsed = time.time() - started
+    return {
+        'journeys': journeys,
+        'workers': workers,
+        'seconds': round(elapsed, 2),
+        'journeys_per_minute': round(journeys / elapsed * 60, 2) if elapsed else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the runner')
+    parser.add_argument('--campaigns', type=int, default=2, help='generated campaigns')
+    parser.add_argument('--journeys', type=int, default=10, help='journeys per campaign')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the campaign runner')
+    parser.add_argument('--latency-ms', type=float, default=0, help='artificial server latency')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    shop = StandInShop(latency=args.latency_ms / 1000).start()
+    workdir = tempfile.mkdtemp(prefix='mysteryshopper_bench_')
+    # reports/ and .cache/ of the runner go into the temporary folder
+    os.chdir(workdir)
+    try:
+        campaigns_dir = os.path.join(workdir, 'campaigns')
+        file_names = generate_campaigns(shop, campaigns_dir, args.campaigns, args.journeys)
+        report = {
+            'shopper_actions_by_steps': bench_shopper_actions(campaigns_dir, file_names),
+            'complete_purchase_and_save_results': bench_campaign_runner(
+                campaigns_dir, file_names, args.workers),
+            'server_requests': dict(shop.counters),
+            'workdir': workdir,
+        }
+    finally:
+        shop.stop()
+
+    print(json.dumps(report, indent=4))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
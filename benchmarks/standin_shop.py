@@ -0,0 +1,216 @@
+"""
+Local stand-in e-commerce site for offline benchmarks of the runner.
+
+The shop listens on 127.0.0.1, the affiliate network and its tracking pixels
+on 'localhost' (same server), so tracking traffic is on its own host:
+
+    http://localhost:<port>/g/<code>/?ulp=<url>  affiliate redirect hop
+    http://127.0.0.1:<port>/product               product page, popup, add to cart
+    http://127.0.0.1:<port>/cart                  form fields, dropdown, confirm
+    http://127.0.0.1:<port>/thank-you?order_id=   thank-you page with postback
+    http://localhost:<port>/track/<event>         tracking pixel / postback
+"""
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SHOP_HOST = '127.0.0.1'
+TRACKING_HOST = 'localhost'
+
+# Static assets, sized like on a real retail site
+ASSETS = {
+    '/static/banner.jpg': ('image/jpeg', 250_000),
+    '/static/product.jpg': ('image/jpeg', 120_000),
+    '/static/font.woff2': ('font/woff2', 60_000),
+    '/static/app.js': ('application/javascript', 0),
+}
+APP_JS = b'window.shopReady = true;'
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>@font-face {{font-family: Shop; src: url(/static/font.woff2);}}
+body {{font-family: Shop, sans-serif;}}
+#popup {{position: fixed; top: 0; left: 0; right: 0; bottom: 0;
+        background: rgba(0,0,0,.5);}}</style>
+<script src="/static/app.js"></script></head>
+<body>{body}</body></html>'''
+
+PRODUCT_BODY = '''
+<div id="popup"><button id="popup-close"
+  onclick="document.getElementById('popup').remove()">Close</button></div>
+<img src="/static/banner.jpg" width="600">
+<h1>Stand-in product</h1>
+<img src="/static/product.jpg" width="300">
+<p>In cart: <span id="cart-count">0</span></p>
+<button id="add-to-cart" onclick="addToCart()">Add to cart</button>
+<img src="http://{tracking}/track/view?page=product" width="1" height="1">
+<script>
+function addToCart() {{
+  fetch('/api/cart/add', {{method: 'POST'}}).then(function (r) {{
+    return r.json();
+  }}).then(function (cart) {{
+    localStorage.setItem('cart', JSON.stringify(cart));
+    document.getElementById('cart-count').textContent = cart.items;
+  }});
+}}
+</script>'''
+
+CART_BODY = '''
+<h1>Cart</h1>
+<form id="checkout" onsubmit="return false">
+  <input id="name" name="name" placeholder="Name">
+  <input id="email" name="email" placeholder="Email">
+  <input id="phone" name="phone" placeholder="Phone">
+  <select id="delivery" name="delivery">
+    <option value="1">Courier</option>
+    <option value="2">Pickup</option>
+    <option value="6">Postpayment</option>
+  </select>
+  <button id="confirm" onclick="confirmOrder()">Confirm order</button>
+</form>
+<script>
+function confirmOrder() {{
+  var orderId = Date.now().toString();
+  sessionStorage.setItem('order', orderId);
+  window.location = '/thank-you?order_id=' + orderId;
+}}
+</script>'''
+
+THANK_YOU_BODY = '''
+<h1>Thank you, order {order_id}</h1>
+<img src="http://{tracking}/track/postback?order_id={order_id}" width="1" height="1">'''
+
+
+class ShopHandler(BaseHTTPRequestHandler):
+    # Set by StandInShop
+    port = 0
+    latency = 0.0
+    counters = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='text/html; charset=utf-8',
+              headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or []):
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _page(self, title, body, headers=None):
+        html = PAGE.format(title=title, body=body)
+        self._send(200, html.encode('utf-8'), headers=headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        tracking = f'{TRACKING_HOST}:{self.port}'
+        # Requests per first path segment, e.g. 'g', 'product', 'track'
+        counter = url.path.split('/')[1] or 'root'
+        self.counters[counter] = self.counters.get(counter, 0) + 1
+
+        if url.path.startswith('/g/'):
+            # Affiliate hop: add click id and UTM params, redirect to ulp
+            target = query.get('ulp', [f'http://{SHOP_HOST}:{self.port}/product'])[0]
+            uid = uuid.uuid4().hex
+            params = {'admitad_uid': uid, 'utm_source': 'admitad'}
+            if 'subid' in query:
+                params['subid'] = query['subid'][0]
+            separator = '&' if '?' in target else '?'
+            location = f'{target}{separator}{urllib.parse.urlencode(params)}'
+            self._send(302, headers=[
+                ('Location', location),
+                ('Set-Cookie', f'tagtag_uid={uid}; Path=/'),
+            ])
+        elif url.path == '/product':
+            uid = query.get('admitad_uid', [''])[0]
+            headers = [('Set-Cookie', 'deduplication_cookie=admitad; Path=/')]
+            if uid:
+                headers.append(('Set-Cookie', f'admitad_uid={uid}; Path=/; Max-Age=2592000'))
+            self._page('Product', PRODUCT_BODY.format(tracking=tracking), headers)
+        elif url.path == '/cart':
+            self._page('Cart', CART_BODY.format())
+        elif url.path == '/thank-you':
+            order_id = query.get('order_id', [''])[0]
+            self._page('Thank you', THANK_YOU_BODY.format(
+                tracking=tracking, order_id=order_id))
+        elif url.path.startswith('/track/'):
+            body = json.dumps({'status': 'ok', 'event': url.path[len('/track/'):]})
+            self._send(200, body.encode('utf-8'), 'application/json')
+        elif url.path in ASSETS:
+            content_type, size = ASSETS[url.path]
+            body = APP_JS if url.path.endswith('.js') else b'\0' * size
+            self._send(200, body, content_type,
+                       headers=[('Cache-Control', 'no-store')])
+        elif url.path == '/':
+            self._page('Shop', '<a href="/product">Product</a>')
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path == '/api/cart/add':
+            self._send(200, b'{"items": 1}', 'application/json')
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+
+class StandInShop:
+    """
+    Runs the stand-in shop in a background thread.
+
+    Args:
+        port: Port to listen on, 0 picks a free one.
+        latency: Artificial delay of every GET request, secs.
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0.0):
+        handler = type('Handler', (ShopHandler,), {
+            'latency': latency, 'counters': {}})
+        self.server = ThreadingHTTPServer((SHOP_HOST, port), handler)
+        handler.port = self.server.server_address[1]
+        self.handler = handler
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def counters(self) -> dict:
+        return self.handler.counters
+
+    def shop_url(self, path: str) -> str:
+        return f'http://{SHOP_HOST}:{self.port}{path}'
+
+    def affiliate_url(self, target_path: str = '/product') -> str:
+        ulp = urllib.parse.quote(self.shop_url(target_path), safe='')
+        return f'http://{TRACKING_HOST}:{self.port}/g/bench/?ulp={ulp}'
+
+    def start(self) -> 'StandInShop':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    shop = StandInShop(port=8765)
+    print(f'Affiliate link: {shop.affiliate_url()}')
+    shop.server.serve_forever()
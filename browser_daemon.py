@@ -0,0 +1,352 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Dict, Tuple
+
+from selenium import webdriver
+from seleniumwire import webdriver as wire_webdriver
+
+from memory import wire_options
+
+# Control socket of the daemon, loopback only
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 9290
+# Pre-launched browsers kept warm
+DAEMON_BROWSERS = 2
+# How long a client waits for a warm browser before launching its own, secs.
+# Short: with more workers than warm browsers the others launch at once.
+ACQUIRE_TIMEOUT = 0.5
+# How long a launched Chrome may take to open its debugging port, secs
+LAUNCH_TIMEOUT = 20
+CHROME_BINARIES = ('google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((DAEMON_HOST, 0))
+        return sock.getsockname()[1]
+
+
+def find_chrome() -> str:
+    for name in CHROME_BINARIES:
+        path = shutil.which(name)
+        if path:
+            return path
+    raise FileNotFoundError(f'No Chrome found, tried {", ".join(CHROME_BINARIES)}')
+
+
+class WarmBrowser:
+    """
+    A headless Chrome launched with its own profile directory, a remote
+    debugging port and a fixed selenium-wire proxy port. The proxy only
+    listens while a client is attached, Chrome is idle in between.
+    """
+
+    def __init__(self, chrome: str, headless: bool = True):
+        self.debug_port = _free_port()
+        self.proxy_port = _free_port()
+        self.user_data_dir = tempfile.mkdtemp(prefix='chrome_warm_')
+        args = [
+            chrome,
+            f'--remote-debugging-port={self.debug_port}',
+            f'--user-data-dir={self.user_data_dir}',
+            f'--proxy-server=http://{DAEMON_HOST}:{self.proxy_port}',
+            # Send loopback traffic through selenium-wire too (local test sites)
+            '--proxy-bypass-list=<-loopback>',
+            # selenium-wire decrypts HTTPS with its own certificate
+            '--ignore-certificate-errors',
+            '--no-sandbox',
+            '--no-first-run',
+            '--no-default-browser-check',
+            'about:blank',
+        ]
+        if headless:
+            args.insert(1, '--headless=new')
+        self.process = subprocess.Popen(
+            args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.started = time.time()
+
+    @property
+    def debugger_address(self) -> str:
+        return f'{DAEMON_HOST}:{self.debug_port}'
+
+    def wait_ready(self, timeout: float = LAUNCH_TIMEOUT) -> bool:
+        """
+        Waits until Chrome answers on its debugging port.
+        """
+        deadline = time.time() + timeout
+        url = f'http://{self.debugger_address}/json/version'
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                return False
+            try:
+                with urllib.request.urlopen(url, timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.1)
+        return False
+
+    def info(self) -> Dict:
+        return {
+            'debugger_address': self.debugger_address,
+            'pid': self.process.pid,
+            'proxy_port': self.proxy_port,
+            'user_data_dir': self.user_data_dir,
+        }
+
+    def stop(self) -> None:
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.user_data_dir, ignore_errors=True)
+
+
+class BrowserPool:
+    """
+    Keeps `size` warm browsers. A browser handed to a client is never
+    reused: when the client lets it go it is stopped and a fresh one with
+    an empty profile is launched in the background.
+    """
+
+    def __init__(self, size: int = DAEMON_BROWSERS, chrome: str = None, headless: bool = True):
+        self.chrome = chrome or find_chrome()
+        self.headless = headless
+        self.ready = queue.Queue()
+        self.leased = set()
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self.launch()
+
+    def launch(self) -> None:
+        threading.Thread(target=self._launch, daemon=True).start()
+
+    def _launch(self) -> None:
+        browser = WarmBrowser(self.chrome, self.headless)
+        if browser.wait_ready():
+            logging.info(f'Warm browser ready on {browser.debugger_address}')
+            self.ready.put(browser)
+            return
+        logging.error(f'Chrome did not start on {browser.debugger_address}')
+        browser.stop()
+
+    def acquire(self, timeout: float = ACQUIRE_TIMEOUT) -> WarmBrowser:
+        """
+        Returns a warm browser, None if none gets ready in time.
+        """
+        try:
+            browser = self.ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            self.leased.add(browser)
+        return browser
+
+    def recycle(self, browser: WarmBrowser) -> None:
+        with self._lock:
+            self.leased.discard(browser)
+        browser.stop()
+        self.launch()
+
+    def status(self) -> Dict:
+        with self._lock:
+            leased = len(self.leased)
+        return {'ready': self.ready.qsize(), 'leased': leased}
+
+    def close(self) -> None:
+        with self._lock:
+            browsers = list(self.leased)
+        while not self.ready.empty():
+            browsers.append(self.ready.get_nowait())
+        for browser in browsers:
+            browser.stop()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON request per line: {"cmd": "acquire"}, {"cmd": "status"} or
+    {"cmd": "shutdown"}. An acquired browser is leased to the connection:
+    it is recycled when the client sends {"cmd": "release"} or disconnects,
+    so a crashed run never keeps a browser.
+    """
+
+    def _reply(self, message: Dict) -> None:
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        pool = self.server.pool
+        for line in self.rfile:
+            try:
+                command = json.loads(line).get('cmd')
+            except (ValueError, AttributeError):
+                self._reply({'error': 'invalid request'})
+                continue
+            if command == 'status':
+                self._reply(pool.status())
+            elif command == 'shutdown':
+                self._reply({'ok': True})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+            elif command == 'acquire':
+                browser = pool.acquire()
+                if browser is None:
+                    self._reply({'error': 'no warm browser available'})
+                    continue
+                try:
+                    self._reply(browser.info())
+                    # Held until the client releases it or goes away
+                    self.rfile.readline()
+                except OSError:
+                    pass
+                finally:
+                    pool.recycle(browser)
+                return
+            else:
+                self._reply({'error': f'unknown command {command!r}'})
+
+
+class BrowserDaemon(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pool: BrowserPool, address: Tuple[str, int] = (DAEMON_HOST, DAEMON_PORT)):
+        self.pool = pool
+        super().__init__(address, ControlHandler)
+
+
+class BrowserLease:
+    """
+    A warm browser leased from the daemon, held while the connection is open.
+    """
+
+    def __init__(self, connection: socket.socket, info: Dict):
+        self.connection = connection
+        self.debugger_address = info['debugger_address']
+        # Chrome runs under the daemon, not under chromedriver
+        self.pid = info.get('pid')
+        self.proxy_port = info['proxy_port']
+        self.user_data_dir = info['user_data_dir']
+
+    def release(self) -> None:
+        try:
+            self.connection.sendall(b'{"cmd": "release"}\n')
+        except OSError:
+            pass
+        self.connection.close()
+
+
+def request_browser(address: Tuple[str, int] = (DAEMON_HOST, DAEMON_PORT),
+                    timeout: float = ACQUIRE_TIMEOUT) -> BrowserLease:
+    """
+    Leases a warm browser from the daemon.
+
+    Returns:
+        BrowserLease: The lease, None if no daemon is running or it has no
+                      browser ready in time.
+    """
+    try:
+        connection = socket.create_connection(address, timeout=1)
+    except OSError:
+        return None
+    try:
+        connection.settimeout(timeout + 2)
+        connection.sendall(b'{"cmd": "acquire"}\n')
+        info = json.loads(connection.makefile('rb').readline() or b'{}')
+    except (OSError, ValueError) as er:
+        logging.warning(f'Browser daemon did not answer ({er})')
+        connection.close()
+        return None
+    if 'debugger_address' not in info:
+        logging.warning(f"No warm browser from the daemon: {info.get('error')}")
+        connection.close()
+        return None
+    connection.settimeout(None)
+    return BrowserLease(connection, info)
+
+
+def attach_browser(lease: BrowserLease) -> webdriver:
+    """
+    Attaches a selenium-wire driver to a leased browser through its remote
+    debugging address. Quitting the driver releases the browser.
+    """
+    options = webdriver.ChromeOptions()
+    options.debugger_address = lease.debugger_address
+    options.page_load_strategy = 'eager'
+    try:
+        driver = wire_webdriver.Chrome(
+            options=options,
+            seleniumwire_options=dict(wire_options(), port=lease.proxy_port))
+    except Exception:
+        lease.release()
+        raise
+    original_quit = driver.quit
+
+    def quit():
+        try:
+            original_quit()
+        finally:
+            lease.release()
+
+    driver.quit = quit
+    driver.browser_pid = lease.pid
+    logging.info(f'Attached to warm browser {lease.debugger_address}')
+    return driver
+
+
+def warm_browser(address: Tuple[str, int] = (DAEMON_HOST, DAEMON_PORT)) -> webdriver:
+    """
+    Returns a driver attached to a warm browser of the daemon, None if
+    no daemon is running (the caller launches a browser itself).
+    """
+    lease = request_browser(address)
+    if lease is None:
+        return None
+    return attach_browser(lease)
+
+
+def daemon_status(address: Tuple[str, int] = (DAEMON_HOST, DAEMON_PORT),
+                  command: str = 'status') -> Dict:
+    with socket.create_connection(address, timeout=5) as connection:
+        connection.sendall((json.dumps({'cmd': command}) + '\n').encode('utf-8'))
+        return json.loads(connection.makefile('rb').readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keeps headless Chrome instances warm for runs')
+    parser.add_argument('command', nargs='?', default='serve', choices=('serve', 'status', 'stop'))
+    parser.add_argument('--browsers', type=int, default=DAEMON_BROWSERS,
+                        help=f'warm browsers to keep (default: {DAEMON_BROWSERS})')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT, help='control port on loopback')
+    parser.add_argument('--chrome', help='Chrome binary, found on PATH by default')
+    parser.add_argument('--headed', action='store_true', help='show the browser windows')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    address = (DAEMON_HOST, args.port)
+    if args.command != 'serve':
+        print(daemon_status(address, 'status' if args.command == 'status' else 'shutdown'))
+    else:
+        pool = BrowserPool(args.browsers, args.chrome, not args.headed)
+        server = BrowserDaemon(pool, address)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        logging.info(f'Browser daemon on {address[0]}:{address[1]}, pid {os.getpid()}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            pool.close()
@@ -0,0 +1,204 @@
+import logging
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Dict
+
+from selenium.common.exceptions import WebDriverException
+
+from waits import resolve_wait
+
+# Max time of a page load ('goto' or a navigation after a click), secs
+PAGE_LOAD_TIMEOUT = 30
+# Max time of the waits of one step, secs
+STEP_TIMEOUT = 60
+# Max time of a whole journey, secs; the remaining steps are skipped
+JOURNEY_BUDGET = 600
+# Consecutive failed steps on a host before its journeys are skipped
+BREAKER_THRESHOLD = 3
+BUDGET_KEYS = ('page_load', 'step', 'journey', 'failures')
+
+
+def valid_budget_settings(value) -> bool:
+    """
+    Checks the 'budgets' campaign setting, e.g.
+    {'page_load': 20, 'step': 30, 'journey': 300, 'failures': 3}.
+    """
+    if not isinstance(value, dict) or set(value) - set(BUDGET_KEYS):
+        return False
+    for number in value.values():
+        if isinstance(number, bool) or not isinstance(number, (int, float)) or number <= 0:
+            return False
+    return isinstance(value.get('failures', BREAKER_THRESHOLD), int)
+
+
+def url_host(url: str) -> str:
+    return (urllib.parse.urlparse(url).hostname or '').lower()
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failed steps per campaign and host. When a host
+    reaches the threshold its circuit opens: the remaining steps on it and
+    the remaining journeys of the campaign starting on it are skipped
+    instead of burning their full timeouts.
+
+    Journeys in worker processes count the failures of their own process.
+    """
+
+    def __init__(self):
+        self._failures = defaultdict(int)
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def failure(self, campaign_id, host: str, reason: str,
+                threshold: int = BREAKER_THRESHOLD) -> bool:
+        """
+        Records a failed step on the host.
+
+        Returns:
+            bool: Whether the circuit of the host is open now.
+        """
+        if not host:
+            return False
+        key = (campaign_id, host)
+        with self._lock:
+            self._failures[key] += 1
+            if self._failures[key] >= threshold and key not in self._open:
+                self._open[key] = reason
+                logging.warning(
+                    f'Circuit open for {host} after {self._failures[key]} failures '
+                    f'({reason}), skipping its remaining steps')
+            return key in self._open
+
+    def success(self, campaign_id, host: str) -> None:
+        with self._lock:
+            self._failures.pop((campaign_id, host), None)
+
+    def is_open(self, campaign_id, host: str) -> bool:
+        with self._lock:
+            return (campaign_id, host) in self._open
+
+    def skip_reason(self, campaign_id, journey) -> str:
+        """
+        Returns why the journey is skipped: the circuit of the host of its
+        first 'goto' is open. None if it runs.
+        """
+        host = url_host(journey.steps[0].step.get('url', ''))
+        if self.is_open(campaign_id, host):
+            return f'Skipped: circuit open for {host}'
+        return None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._failures.clear()
+            self._open.clear()
+
+
+class JourneyBudget:
+    """
+    Time budget of a running journey: caps the waits of every step by the
+    step timeout and the time left for the journey, sets the page-load
+    timeout of the driver and records skipped and failed steps.
+
+    Args:
+        campaign_id: The campaign of the journey, circuits are per campaign.
+        settings: The 'budgets' campaign setting.
+    """
+
+    def __init__(self, campaign_id, settings: Dict = None):
+        settings = settings or {}
+        self.campaign_id = campaign_id
+        self.page_load = settings.get('page_load', PAGE_LOAD_TIMEOUT)
+        self.step = settings.get('step', STEP_TIMEOUT)
+        self.journey = settings.get('journey', JOURNEY_BUDGET)
+        self.threshold = settings.get('failures', BREAKER_THRESHOLD)
+        self.deadline = time.time() + self.journey
+        self.host = ''
+        self.skipped = []
+        self.failed_steps = []
+        self._page_load_set = None
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.time(), 0)
+
+    def set_page_load_timeout(self, driver) -> None:
+        """
+        Sets the page-load timeout to the time allowed for the next page,
+        only sending the command when the value changes.
+        """
+        timeout = round(min(self.page_load, max(self.remaining(), 1)))
+        if timeout == self._page_load_set:
+            return
+        try:
+            driver.set_page_load_timeout(timeout)
+        except (AttributeError, WebDriverException) as er:
+            logging.warning(f'Page-load timeout not set ({er})')
+        self._page_load_set = timeout
+
+    def step_timeout(self, timeout: float) -> float:
+        """
+        Caps the wait timeout of a step by the step timeout and the time left.
+        """
+        return min(timeout, self.step, self.remaining())
+
+    def track(self, step: Dict) -> None:
+        """
+        Tracks the host the steps run on: the host of the last 'goto'.
+        """
+        if step.get('url'):
+            self.host = url_host(step['url'])
+
+    def skip_reason(self, step: Dict) -> str:
+        """
+        Returns why the step is skipped, None if it runs.
+        """
+        self.track(step)
+        if self.remaining() <= 0:
+            return f'journey budget of {self.journey} secs spent'
+        if circuit_breaker.is_open(self.campaign_id, self.host):
+            return f'circuit open for {self.host}'
+        return None
+
+    def skip(self, step_number: int, step: Dict, reason: str) -> None:
+        # The wait the step would have cost on a dead or hung page
+        saved = min(resolve_wait(step)[1], self.step)
+        self.skipped.append({
+            'step': step_number, 'action': step.get('action'),
+            'reason': reason, 'time_saved': saved})
+        logging.warning(f'Step {step_number} {step.get("action")} skipped: {reason}')
+
+    def step_done(self, step_number: int, span: Dict, reason: str = None) -> None:
+        """
+        Records the outcome of a step for the circuit of its host. A step
+        fails with a reason (a page-load timeout, a wait condition not met,
+        no element to click) or when it runs over the step timeout.
+        """
+        if reason is None and span['duration'] > self.step:
+            reason = f"took {span['duration']:.1f} secs, over the step timeout"
+        if reason is None:
+            circuit_breaker.success(self.campaign_id, self.host)
+            return
+        span['failed'] = True
+        self.failed_steps.append({
+            'step': step_number, 'action': span['action'],
+            'duration': span['duration'], 'reason': reason})
+        circuit_breaker.failure(self.campaign_id, self.host, reason, self.threshold)
+
+    def failed(self, reason: str) -> None:
+        """
+        Records a step which ended the journey with an error.
+        """
+        circuit_breaker.failure(self.campaign_id, self.host, reason, self.threshold)
+
+    def summary(self) -> Dict:
+        return {
+            'journey_budget': self.journey,
+            'skipped_steps': self.skipped,
+            'failed_steps': self.failed_steps,
+            'time_saved': round(sum(step['time_saved'] for step in self.skipped), 4),
+        }
+
+
+circuit_breaker = CircuitBreaker()
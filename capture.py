@@ -0,0 +1,195 @@
+import logging
+import re
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Dict, List
+
+from seleniumwire.utils import decode
+
+from logging_setup import log_payload
+
+# Tracking and affiliate domains, may be overridden with 'tracking_domains'
+# in the campaign settings
+DEFAULT_TRACKING_DOMAINS = [
+    'aflink.ru',
+    'ad.admitad.com',
+    'tjzuh.com',
+    'z.asbmit.com',
+    'pafutos.com',
+    'lenkmio.com',
+]
+# Max number of characters of a response body kept in the result
+BODY_LIMIT = 10000
+
+
+def decode_content(body: bytes, encoding: str = 'identity') -> bytes:
+    """
+    Decompresses a response body by its Content-Encoding.
+
+    Raises:
+        ValueError: If the body cannot be decoded with the encoding.
+    """
+    try:
+        return decode(body or b'', encoding)
+    except Exception as er:
+        raise ValueError(f'Cannot decode {encoding} body ({er})') from er
+
+
+def decode_body(body: bytes, encoding: str = 'identity') -> str:
+    """
+    Decodes a response body by its Content-Encoding, '' if it cannot be.
+    """
+    try:
+        return decode_content(body, encoding).decode('utf-8', errors='replace')
+    except ValueError:
+        return ''
+
+
+def domain_matches(host: str, domain: str) -> bool:
+    """
+    Checks whether the host is the domain or one of its subdomains.
+    """
+    return host == domain or host.endswith(f'.{domain}')
+
+
+class TrackingCapture:
+    """
+    Records traffic to tracking domains as it arrives through the selenium-wire
+    response interceptor, indexed by domain and step number.
+
+    Only tracking domains are put in the selenium-wire scopes, so other traffic
+    is neither stored nor decoded.
+    """
+
+    def __init__(self, domains: List[str] = None, body_limit: int = BODY_LIMIT):
+        self.domains = list(domains or DEFAULT_TRACKING_DOMAINS)
+        self.body_limit = body_limit
+        self.step = 0
+        self.entries = []
+        self.by_domain = defaultdict(list)
+        self.by_step = defaultdict(list)
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def scopes(self) -> List[str]:
+        """
+        Returns selenium-wire scope regexes matching the tracking domains.
+        """
+        return [
+            rf'^https?://([^/]*\.)?{re.escape(domain)}(:\d+)?(/|$)'
+            for domain in self.domains
+        ]
+
+    def attach(self, driver) -> None:
+        """
+        Starts capturing the tracking traffic of the driver.
+        """
+        driver.scopes = self.scopes()
+        driver.response_interceptor = self.intercept
+
+    def detach(self, driver) -> None:
+        """
+        Stops capturing and restores the default (unscoped) selenium-wire setup.
+        """
+        if getattr(driver, 'response_interceptor', None) == self.intercept:
+            del driver.response_interceptor
+        driver.scopes = []
+
+    def match_domain(self, url: str):
+        """
+        Returns the tracking domain of the URL or None.
+        """
+        host = urllib.parse.urlparse(url).hostname or ''
+        for domain in self.domains:
+            if domain_matches(host, domain):
+                return domain
+        return None
+
+    def intercept(self, request, response) -> None:
+        """
+        selenium-wire response interceptor, runs in the proxy thread.
+        """
+        if self.match_domain(request.url) is None:
+            return
+        body = decode_body(
+            response.body, response.headers.get('Content-Encoding', 'identity'))
+        self.record(
+            request.url, request.method, dict(request.headers),
+            response.status_code, dict(response.headers),
+            body, len(response.body or b''))
+
+    def record(self, url: str, method: str, request_headers: Dict, status_code: int,
+               response_headers: Dict, body: str, size: int) -> None:
+        """
+        Records a request to a tracking domain, other requests are ignored.
+        Used by the interceptor and by the HTTP engine.
+        """
+        domain = self.match_domain(url)
+        if domain is None:
+            return
+        with self._lock:
+            entry = {
+                'step': self.step,
+                'time': time.time(),
+                'domain': domain,
+                'url': url,
+                'method': method,
+                'request_headers': request_headers,
+                'status_code': status_code,
+                'response_headers': response_headers,
+                'size': size,
+                'body': body[:self.body_limit],
+            }
+            self.entries.append(entry)
+            self.by_domain[domain].append(entry)
+            self.by_step[self.step].append(entry)
+
+    def restore(self, entries: List[Dict]) -> None:
+        """
+        Adds entries captured by another journey, e.g. during the steps of a
+        restored snapshot. They are not reported as new.
+        """
+        with self._lock:
+            for entry in entries:
+                self.entries.append(entry)
+                self.by_domain[entry['domain']].append(entry)
+                self.by_step[entry['step']].append(entry)
+            self._cursor = len(self.entries)
+
+    def set_step(self, step_number: int) -> None:
+        """
+        Sets the number of the step the following traffic belongs to.
+        """
+        with self._lock:
+            self.step = step_number
+
+    def new_since_last_step(self) -> List[Dict]:
+        """
+        Returns the entries captured since the previous call.
+        """
+        with self._lock:
+            new_entries = self.entries[self._cursor:]
+            self._cursor = len(self.entries)
+        return new_entries
+
+    def results(self) -> List[Dict]:
+        """
+        Returns a copy of all captured entries, for the journey result.
+        """
+        with self._lock:
+            return list(self.entries)
+
+
+def log_captured(entries: List[Dict]) -> None:
+    """
+    Logs captured tracking requests, headers and bodies as sampled payloads.
+    """
+    for entry in entries:
+        logging.info(
+            f"Captured request to {entry['url']}: {entry['method']}, "
+            f"status {entry['status_code']}, {entry['size']} bytes"
+        )
+        log_payload(' - Headers', entry['request_headers'])
+        log_payload(' - Response body', entry['body'])
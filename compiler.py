@@ -0,0 +1,500 @@
+import glob
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+from typing import Callable, Dict, List, Tuple
+
+import yaml
+
+from budgets import valid_budget_settings
+from isolation import ISOLATION_MODES
+from memory import valid_memory_settings
+from replay import valid_replay_settings
+from resources import valid_resource_settings
+from screenshots import valid_screenshot_settings
+from waits import (
+    ADAPTIVE_PACING,
+    COOKIE_PRESENT,
+    ELEMENT_CONDITIONS,
+    HUMAN_PACING,
+    NO_WAIT,
+    PAGE_CONDITIONS,
+)
+
+CAMPAIGNS_DIR = 'campaigns'
+# Files in the campaigns folder which are not campaigns
+TEMPLATE_PREFIX = '0000_'
+
+# Keys every step may have, on top of the keys of its action
+COMMON_STEP_KEYS = (
+    'action', 'wait_for', 'timeout', 'cookie', 'pacing', 'snapshot', 'keystrokes',
+)
+STRING_KEYS = ('url', 'selector', 'text', 'element', 'cookie', 'title')
+NUMBER_KEYS = ('value', 'timeout')
+WAIT_CONDITIONS = ELEMENT_CONDITIONS + PAGE_CONDITIONS + (NO_WAIT,)
+PACING_MODES = (ADAPTIVE_PACING, HUMAN_PACING)
+# Engines running a journey: a browser, or plain HTTP requests for journeys
+# which only follow a link and read its redirect URL and cookies
+AUTO_ENGINE = 'auto'
+BROWSER_ENGINE = 'browser'
+HTTP_ENGINE = 'http'
+ENGINES = (AUTO_ENGINE, BROWSER_ENGINE, HTTP_ENGINE)
+# Actions the HTTP engine can run
+HTTP_ACTIONS = ('goto', 'wait')
+
+# Campaign settings: key -> check of the value
+SETTINGS_SCHEMA = {
+    'pacing': lambda v: v in PACING_MODES,
+    'isolation': lambda v: v in ISOLATION_MODES,
+    'tracking_domains': lambda v: isinstance(v, list) and all(
+        isinstance(d, str) for d in v),
+    'plugins': lambda v: isinstance(v, list) and all(
+        isinstance(m, str) for m in v),
+    'screenshots': valid_screenshot_settings,
+    'engine': lambda v: v in ENGINES,
+    'resources': valid_resource_settings,
+    'snapshots': lambda v: isinstance(v, bool),
+    'budgets': valid_budget_settings,
+    'keystrokes': lambda v: isinstance(v, bool),
+    'memory': valid_memory_settings,
+    'replay': valid_replay_settings,
+}
+
+
+class CampaignError(ValueError):
+    """
+    Raised when a campaign YAML does not match the schema.
+    """
+
+
+class ActionSpec:
+    """
+    Handler of an action and the keys its steps may have.
+    """
+
+    def __init__(self, name: str, handler: Callable, required: Tuple = (),
+                 optional: Tuple = (), manages_wait: bool = False):
+        self.name = name
+        self.handler = handler
+        self.required = tuple(required)
+        self.optional = tuple(optional)
+        # Handler waits for its page condition itself (e.g. 'goto')
+        self.manages_wait = manages_wait
+
+
+# Dispatch registry: action name -> ActionSpec
+ACTIONS = {}
+
+
+def register_action(name: str, required: Tuple = (), optional: Tuple = (),
+                    manages_wait: bool = False) -> Callable:
+    """
+    Decorator registering a step handler for an action.
+
+    The handler is called as handler(ctx, step) with the journey context
+    and the step dictionary. Plugins register their own actions the same
+    way and are imported through the 'plugins' campaign setting.
+
+    Args:
+        name: Action name used in the YAML.
+        required: Keys the step must have.
+        optional: Keys the step may have.
+        manages_wait: The handler waits for the page condition itself.
+    """
+    def decorator(handler):
+        ACTIONS[name] = ActionSpec(name, handler, required, optional, manages_wait)
+        return handler
+    return decorator
+
+
+class CompiledStep:
+    """
+    A validated step bound to the handler of its action.
+    """
+
+    def __init__(self, spec: ActionSpec, step: Dict):
+        self._action = spec.name
+        self._spec = spec
+        self.step = step
+
+    @property
+    def action(self) -> str:
+        return self._action
+
+    @property
+    def spec(self) -> ActionSpec:
+        if self._spec is None:
+            # Unpickled in a worker before its plugins were imported
+            self._spec = ACTIONS[self._action]
+        return self._spec
+
+    def run(self, ctx, step: Dict = None) -> None:
+        self.spec.handler(ctx, step if step is not None else self.step)
+
+    def __getstate__(self):
+        # Handlers are bound again by name after unpickling (workers)
+        return {'action': self._action, 'step': self.step}
+
+    def __setstate__(self, state):
+        self._action = state['action']
+        self._spec = ACTIONS.get(self._action)
+        self.step = state['step']
+
+
+class CompiledJourney:
+    """
+    A test case compiled into a list of bound steps.
+    """
+
+    def __init__(self, title: str, steps: List[CompiledStep],
+                 engine: str = BROWSER_ENGINE):
+        self.title = title
+        self.steps = steps
+        # BROWSER_ENGINE or HTTP_ENGINE, see journey_engine()
+        self.engine = engine
+        # Numbers of leading steps shared with other journeys of the campaign,
+        # see assign_snapshot_points()
+        self.snapshot_points = ()
+
+    def prefix_key(self, steps: int) -> str:
+        """
+        Returns a key identifying the first `steps` steps.
+        """
+        keys = [_step_key(compiled_step.step) for compiled_step in self.steps[:steps]]
+        return hashlib.sha1('\n'.join(keys).encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        # Dictionary-like access, as for a raw YAML test case
+        if key == 'title':
+            return self.title
+        if key == 'steps':
+            return [compiled_step.step for compiled_step in self.steps]
+        return default
+
+
+def _step_key(step: Dict) -> str:
+    return json.dumps(step, sort_keys=True, default=str)
+
+
+def _snapshot_limit(journey: CompiledJourney) -> int:
+    # Leading steps before the first one which must run live ('snapshot: false')
+    for number, compiled_step in enumerate(journey.steps):
+        if compiled_step.step.get('snapshot') is False:
+            return number
+    return len(journey.steps)
+
+
+def assign_snapshot_points(journeys: List[CompiledJourney]) -> None:
+    """
+    Finds the leading steps browser journeys of a campaign have in common.
+    A journey sharing its first N steps with another one gets N in its
+    snapshot_points: the browser state after them is snapshotted by the
+    first journey to get there and restored by the others. Every journey
+    keeps at least its last step live, identical journeys included.
+    """
+    keys = [[_step_key(compiled_step.step) for compiled_step in journey.steps]
+            for journey in journeys]
+    limits = [_snapshot_limit(journey) for journey in journeys]
+    for i, journey in enumerate(journeys):
+        points = set()
+        for j, other in enumerate(journeys):
+            if i == j or BROWSER_ENGINE != journey.engine or BROWSER_ENGINE != other.engine:
+                continue
+            shared = 0
+            limit = min(limits[i], limits[j], len(keys[i]) - 1, len(keys[j]) - 1)
+            while shared < limit and keys[i][shared] == keys[j][shared]:
+                shared += 1
+            if shared:
+                points.add(shared)
+        journey.snapshot_points = tuple(sorted(points))
+
+
+class CompiledCampaign:
+    """
+    A validated campaign with its compiled test cases.
+    """
+
+    def __init__(self, file_name: str, login: str, campaign_id, settings: Dict,
+                 journeys: List[CompiledJourney]):
+        self.file_name = file_name
+        self.login = login
+        self.campaign_id = campaign_id
+        self.settings = settings
+        self.journeys = journeys
+
+
+# Compiled campaigns: path -> (mtime, CompiledCampaign)
+_plan_cache = {}
+
+
+def _is_number(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def validate_step(step, where: str) -> List[str]:
+    """
+    Validates a step against the spec of its action.
+
+    Returns:
+        list: Error messages, empty if the step is valid.
+    """
+    if not isinstance(step, dict):
+        return [f'{where}: step must be a mapping']
+    action = step.get('action')
+    spec = ACTIONS.get(action)
+    if spec is None:
+        return [f'{where}: unknown action {action!r}']
+    errors = []
+    for key in spec.required:
+        if step.get(key) in (None, ''):
+            errors.append(f'{where}: action {action!r} requires {key!r}')
+    allowed = set(COMMON_STEP_KEYS) | set(spec.required) | set(spec.optional)
+    for key, value in step.items():
+        if key not in allowed:
+            errors.append(f'{where}: unknown key {key!r} for action {action!r}')
+        elif key in STRING_KEYS and not isinstance(value, str):
+            errors.append(f'{where}: {key!r} must be a string')
+        elif key in NUMBER_KEYS and not _is_number(value):
+            errors.append(f'{where}: {key!r} must be a number, got {value!r}')
+    if 'wait_for' in step and step['wait_for'] not in WAIT_CONDITIONS:
+        errors.append(f"{where}: unknown wait condition {step['wait_for']!r}")
+    if step.get('wait_for') == COOKIE_PRESENT and not step.get('cookie'):
+        errors.append(f"{where}: wait_for {COOKIE_PRESENT!r} requires 'cookie'")
+    if 'pacing' in step and step['pacing'] not in PACING_MODES:
+        errors.append(f"{where}: unknown pacing {step['pacing']!r}")
+    for key in ('snapshot', 'keystrokes'):
+        if key in step and not isinstance(step[key], bool):
+            errors.append(f"{where}: {key!r} must be true or false")
+    return errors
+
+
+def validate_settings(settings, where: str) -> List[str]:
+    """
+    Validates campaign settings against SETTINGS_SCHEMA.
+    """
+    if settings is None:
+        return []
+    if not isinstance(settings, dict):
+        return [f'{where}: settings must be a mapping']
+    errors = []
+    for key, value in settings.items():
+        check = SETTINGS_SCHEMA.get(key)
+        if check is None:
+            errors.append(f'{where}: unknown setting {key!r}')
+        elif not check(value):
+            errors.append(f'{where}: invalid value of setting {key!r}: {value!r}')
+    return errors
+
+
+def load_plugins(modules: List[str]) -> None:
+    """
+    Imports plugin modules, which register their actions on import.
+    """
+    for module in modules or []:
+        importlib.import_module(module)
+
+
+def journey_engine(steps: List[Dict], requested: str = AUTO_ENGINE) -> str:
+    """
+    Picks the engine of a test case. 'auto' sends test cases made of
+    HTTP_ACTIONS only (e.g. deeplink checks) to the HTTP engine.
+
+    Raises:
+        CampaignError: If the HTTP engine is requested for steps it cannot run.
+    """
+    http_capable = all(step.get('action') in HTTP_ACTIONS for step in steps)
+    if requested == HTTP_ENGINE and not http_capable:
+        raise CampaignError(
+            f"engine 'http' runs only {', '.join(HTTP_ACTIONS)} steps")
+    if requested == BROWSER_ENGINE or not http_capable:
+        return BROWSER_ENGINE
+    return HTTP_ENGINE
+
+
+def compile_journey(user_journey: Dict, where: str = 'test_case',
+                    default_engine: str = AUTO_ENGINE) -> CompiledJourney:
+    """
+    Validates a test case and binds its steps to their handlers.
+
+    Args:
+        user_journey: The test case from the YAML.
+        where: Location of the test case for error messages.
+        default_engine: Engine of test cases without an 'engine' key.
+
+    Raises:
+        CampaignError: If the test case is invalid.
+    """
+    errors = []
+    if not isinstance(user_journey, dict):
+        raise CampaignError(f'{where}: test case must be a mapping')
+    steps = user_journey.get('steps')
+    if not isinstance(steps, list) or not steps:
+        raise CampaignError(f'{where}: test case needs a non-empty list of steps')
+    for number, step in enumerate(steps, start=1):
+        errors.extend(validate_step(step, f'{where}, step {number}'))
+    if not errors and (steps[0].get('action') != 'goto'):
+        errors.append(f"{where}: first step must be 'goto' to the affiliate link")
+    requested = user_journey.get('engine', default_engine)
+    if requested not in ENGINES:
+        errors.append(f'{where}: unknown engine {requested!r}')
+    if errors:
+        raise CampaignError('\n'.join(errors))
+    try:
+        engine = journey_engine(steps, requested)
+    except CampaignError as er:
+        raise CampaignError(f'{where}: {er}')
+    return CompiledJourney(
+        user_journey.get('title'),
+        [CompiledStep(ACTIONS[step['action']], step) for step in steps],
+        engine
+    )
+
+
+def compile_campaign(file_name: str, campaigns_dir: str = CAMPAIGNS_DIR) -> CompiledCampaign:
+    """
+    Loads a campaign YAML, validates it and compiles its test cases.
+    Compiled campaigns are cached until the file is modified.
+
+    Args:
+        file_name: File name of the campaign in the campaigns folder.
+        campaigns_dir: Folder with the campaign YAML files.
+
+    Raises:
+        CampaignError: If the campaign is invalid, with all errors found.
+    """
+    path = os.path.join(campaigns_dir, file_name)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError as er:
+        raise CampaignError(f'{file_name}: {er}')
+    cached = _plan_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(path, 'r') as c:
+            tests = yaml.safe_load(c)
+    except yaml.YAMLError as er:
+        raise CampaignError(f'{file_name}: invalid YAML: {er}')
+
+    if not isinstance(tests, dict) or len(tests) != 1:
+        raise CampaignError(f'{file_name}: expected a single advertiser login key')
+    login = list(tests.keys())[0]
+    entries = tests[login]
+    if not isinstance(entries, list) or len(entries) != 1 or not isinstance(entries[0], dict):
+        raise CampaignError(f'{file_name}: {login} must be a list with one campaign')
+    entry = entries[0]
+
+    errors = []
+    for key in entry:
+        if key not in ('campaign_id', 'settings', 'test_case'):
+            errors.append(f'{file_name}: unknown campaign key {key!r}')
+    if entry.get('campaign_id') in (None, ''):
+        errors.append(f"{file_name}: 'campaign_id' is required")
+    settings = entry.get('settings') or {}
+    errors.extend(validate_settings(settings, file_name))
+    if not errors:
+        try:
+            load_plugins(settings.get('plugins'))
+        except ImportError as er:
+            errors.append(f'{file_name}: plugin is not importable: {er}')
+
+    journeys = []
+    test_cases = entry.get('test_case')
+    if not isinstance(test_cases, list) or not test_cases:
+        errors.append(f"{file_name}: 'test_case' must be a non-empty list")
+        test_cases = []
+    for number, user_journey in enumerate(test_cases, start=1):
+        title = user_journey.get('title') if isinstance(user_journey, dict) else None
+        try:
+            journeys.append(compile_journey(
+                user_journey, f'{file_name}, test case {number} ({title})',
+                settings.get('engine', AUTO_ENGINE)))
+        except CampaignError as er:
+            errors.append(str(er))
+    if errors:
+        raise CampaignError('\n'.join(errors))
+    if settings.get('snapshots', True):
+        assign_snapshot_points(journeys)
+
+    campaign = apply_replay(CompiledCampaign(
+        file_name, login, entry['campaign_id'], settings, journeys))
+    _plan_cache[path] = (mtime, campaign)
+    return campaign
+
+
+def apply_replay(campaign: CompiledCampaign, replay: Dict = None) -> CompiledCampaign:
+    """
+    Applies the 'replay' setting of the command line (--record / --replay)
+    to a campaign. Recorded and replayed traffic goes through selenium-wire,
+    so with a 'replay' setting every journey runs in the browser, none over
+    the HTTP engine.
+    """
+    if replay:
+        campaign.settings = dict(campaign.settings or {}, replay=replay)
+    if (campaign.settings or {}).get('replay'):
+        for journey in campaign.journeys:
+            journey.engine = BROWSER_ENGINE
+    return campaign
+
+
+def compile_campaigns(file_names: List[str],
+                      campaigns_dir: str = CAMPAIGNS_DIR) -> List[CompiledCampaign]:
+    """
+    Compiles several campaigns, reporting the errors of all of them at once.
+
+    Raises:
+        CampaignError: If any campaign is invalid.
+    """
+    campaigns = []
+    errors = []
+    for file_name in file_names:
+        try:
+            campaigns.append(compile_campaign(file_name, campaigns_dir))
+        except CampaignError as er:
+            errors.append(str(er))
+    if errors:
+        raise CampaignError('\n'.join(errors))
+    return campaigns
+
+
+def validate_all(campaigns_dir: str = CAMPAIGNS_DIR) -> Dict[str, str]:
+    """
+    Validates every campaign YAML in the folder, skipping the template.
+
+    Returns:
+        dict: Error messages keyed by file name, empty if all are valid.
+    """
+    errors = {}
+    for path in sorted(glob.glob(os.path.join(campaigns_dir, '*.yaml'))):
+        file_name = os.path.basename(path)
+        if file_name.startswith(TEMPLATE_PREFIX):
+            continue
+        try:
+            compile_campaign(file_name, campaigns_dir)
+        except CampaignError as er:
+            errors[file_name] = str(er)
+    return errors
+
+
+if __name__ == '__main__':
+    # Built-in actions are registered by the runner in the 'compiler' module,
+    # not in this __main__ one
+    import run_func  # noqa: F401
+    from compiler import validate_all as validate_all_campaigns
+
+    logging.basicConfig(level=logging.INFO)
+    invalid = validate_all_campaigns()
+    for name, message in invalid.items():
+        print(message)
+    print(f'{len(invalid)} invalid campaign(s)')
+    sys.exit(1 if invalid else 0)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The runner modules are top-level modules of the repository, tests import
+# them directly whatever directory pytest is started from
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
@@ -0,0 +1,232 @@
+import logging
+import re
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from capture import TrackingCapture, domain_matches
+from compiler import CompiledJourney, compile_journey
+from logging_setup import log_payload, set_log_context
+from profiling import StepProfiler
+from run_func import (
+    REQUIRED_COOKIES,
+    add_subid_to_url,
+    new_journey_data,
+    parse_redirect_url,
+)
+from waits import resolve_wait
+
+# Journeys of the HTTP engine running at the same time
+HTTP_THREADS = 32
+# Max redirect hops followed by one 'goto'
+MAX_REDIRECTS = 20
+# Connect timeout, the read timeout is the timeout of the step
+CONNECT_TIMEOUT = 5
+HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+# <meta http-equiv="refresh" content="0; url=..."> redirects of affiliate networks
+META_REFRESH = re.compile(
+    r'<meta[^>]+http-equiv=["\']?refresh["\']?[^>]*content=["\']?\s*\d+\s*;\s*url=([^"\'>]+)',
+    re.IGNORECASE)
+
+# Connection pool shared by the sessions of all journeys, cookies are per journey
+_adapter = HTTPAdapter(pool_connections=HTTP_THREADS, pool_maxsize=HTTP_THREADS)
+
+
+def new_session() -> requests.Session:
+    """
+    Returns a session with an empty cookie jar on the shared connection pool.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount('http://', _adapter)
+    session.mount('https://', _adapter)
+    return session
+
+
+def _set_cookies(response: requests.Response) -> List[str]:
+    headers = response.raw.headers if response.raw is not None else None
+    if headers is not None and hasattr(headers, 'getlist'):
+        return headers.getlist('Set-Cookie')
+    value = response.headers.get('Set-Cookie')
+    return [value] if value else []
+
+
+def follow_redirects(session: requests.Session, url: str, timeout: float,
+                     capture: TrackingCapture = None) -> List[Dict]:
+    """
+    Requests the URL and follows its redirect chain hop by hop, including
+    meta refresh redirects.
+
+    Returns:
+        list: Hops with 'url', 'status_code', 'location', 'set_cookie' and 'time',
+              the last hop is the landing page.
+    """
+    hops = []
+    for _ in range(MAX_REDIRECTS + 1):
+        started = time.time()
+        response = session.get(
+            url, allow_redirects=False, timeout=(CONNECT_TIMEOUT, timeout))
+        location = response.headers.get('Location')
+        refresh = False
+        if not response.is_redirect and 'html' in response.headers.get('Content-Type', ''):
+            match = META_REFRESH.search(response.text[:20000])
+            if match:
+                location, refresh = match.group(1).strip(), True
+        hops.append({
+            'url': url,
+            'status_code': response.status_code,
+            'location': location if (response.is_redirect or refresh) else None,
+            'meta_refresh': refresh,
+            'set_cookie': _set_cookies(response),
+            'time': round(time.time() - started, 4),
+        })
+        if capture is not None and capture.match_domain(url):
+            capture.record(
+                url, 'GET', dict(response.request.headers), response.status_code,
+                dict(response.headers), response.text, len(response.content))
+        log_payload(f'Hop {response.status_code} {url} Set-Cookie', hops[-1]['set_cookie'])
+        if not (response.is_redirect or refresh) or not location:
+            return hops
+        url = urllib.parse.urljoin(url, location)
+    raise requests.TooManyRedirects(f'More than {MAX_REDIRECTS} redirects from {hops[0]["url"]}')
+
+
+def page_cookies(session: requests.Session, url: str) -> Dict[str, str]:
+    """
+    Returns the cookies visible to the page at the URL, as driver.get_cookies()
+    would in the browser.
+    """
+    host = urllib.parse.urlparse(url).hostname or ''
+    cookies = {}
+    for cookie in session.cookies:
+        if domain_matches(host, cookie.domain.lstrip('.')) and cookie.name not in cookies:
+            cookies[cookie.name] = cookie.value
+    return cookies
+
+
+def http_actions_by_steps(campaign_id, user_journey, settings: Dict = None,
+                          session: requests.Session = None) -> Dict:
+    """
+    Runs a redirect and cookie-only journey without a browser: every 'goto'
+    follows the redirect chain of its URL, 'wait' steps are skipped.
+
+    Args:
+        campaign_id: The campaign ID associated with the user journey.
+        user_journey: The test case, or the journey compiled from it.
+        settings: Campaign level settings from the YAML.
+        session: Session to use, defaults to a new one with no cookies.
+
+    Returns:
+        dict: The result of `run_func.shopper_actions_by_steps`, plus 'engine'
+              and 'redirects' (every hop of every 'goto' with its status and
+              Set-Cookie headers).
+    """
+    start_time = time.time()
+    journey = user_journey
+    if not isinstance(journey, CompiledJourney):
+        journey = compile_journey(user_journey)
+    settings = settings or {}
+    session = session or new_session()
+    initial_url = journey.steps[0].step['url']
+    data = new_journey_data(journey.title, initial_url)
+    modified_url = add_subid_to_url(initial_url, data)
+    data['engine'] = 'http'
+    data['redirects'] = []
+
+    capture = TrackingCapture(settings.get('tracking_domains'))
+    profiler = StepProfiler(None, capture)
+    first_redirect = True
+    for step_number, compiled_step in enumerate(journey.steps, start=1):
+        step = compiled_step.step
+        capture.set_step(step_number)
+        profiler.start(step_number, step)
+        if compiled_step.action != 'goto':
+            profiler.end()
+            continue
+        url = modified_url if step_number == 1 else step['url']
+        logging.info(f'Open URL over HTTP: {url}')
+        try:
+            hops = follow_redirects(
+                session, url, resolve_wait(step)[1], capture)
+        except requests.RequestException as er:
+            profiler.end(str(er))
+            raise
+        for hop in hops:
+            data['redirects'].append(dict(hop, step=step_number))
+        landing_url = hops[-1]['url']
+        if first_redirect:
+            parse_redirect_url(landing_url, data)
+            cookies = page_cookies(session, landing_url)
+            for cookie_name in REQUIRED_COOKIES:
+                if cookie_name in cookies:
+                    data['cookies'][cookie_name] = cookies[cookie_name]
+            first_redirect = False
+        span = profiler.end()
+        logging.info(
+            f"Step {step_number} goto: {span['duration']:.2f} sec, {len(hops)} hops, "
+            f"landed on {landing_url}"
+        )
+        logging.info(f"Admitad cookies: {data['cookies']}")
+
+    data['Request_Response'] = capture.results()
+    data['screenshots'] = []
+    data['profile'] = profiler.summary()
+    logging.info(f'Execution time: {time.time() - start_time} sec')
+    return data
+
+
+def _run_job(job: Dict) -> Dict:
+    set_log_context(job['campaign_id'], job['user_journey'].title)
+    try:
+        logging.info(f"Running HTTP test for campaign id: {job['campaign_id']}")
+        return http_actions_by_steps(
+            job['campaign_id'], job['user_journey'], job['settings'])
+    finally:
+        set_log_context()
+
+
+def run_http_journeys(jobs: List[Dict], threads: int = HTTP_THREADS,
+                      on_result: Callable = None,
+                      on_failure: Callable = None) -> Dict:
+    """
+    Runs journeys of the HTTP engine concurrently in a thread pool.
+
+    Args:
+        jobs: A list of dictionaries with 'job_id', 'campaign_id',
+              'user_journey' (compiled journey) and 'settings' keys.
+        threads: Number of journeys running at the same time.
+        on_result: Called as on_result(job, result) as soon as a journey is done.
+        on_failure: Called as on_failure(job, error) for a failed journey.
+
+    Returns:
+        dict: Results of the successful journeys keyed by job_id.
+    """
+    results = {}
+    if not jobs:
+        return results
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http') as executor:
+        futures = {executor.submit(_run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as er:
+                logging.error(f"ERROR ({er}) in HTTP test for campaign id: {job['campaign_id']}")
+                if on_failure:
+                    on_failure(job, str(er))
+                continue
+            results[job['job_id']] = result
+            if on_result:
+                on_result(job, result)
+    return results
@@ -0,0 +1,182 @@
+import logging
+import time
+import urllib.parse
+from typing import Callable, Dict, Iterable, List, Set
+
+from selenium.common.exceptions import WebDriverException
+
+# Isolation modes, set with 'isolation' in the campaign settings
+RESET = 'reset'
+INCOGNITO = 'incognito'
+RELAUNCH = 'relaunch'
+ISOLATION_MODES = (RESET, INCOGNITO, RELAUNCH)
+DEFAULT_ISOLATION = RESET
+
+# Browser contexts created for 'incognito' journeys, keyed by session id
+_browser_contexts = {}
+# Origins of the frames seen during journeys, keyed by session id
+_frame_origins = {}
+
+
+def _origins(urls: Iterable[str]) -> Set[str]:
+    origins = set()
+    for url in urls:
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme in ('http', 'https') and parsed.netloc:
+            origins.add(f'{parsed.scheme}://{parsed.netloc}')
+    return origins
+
+
+def _frame_urls(frame_tree: Dict) -> List[str]:
+    urls = [frame_tree.get('frame', {}).get('url', '')]
+    for child in frame_tree.get('childFrames', []):
+        urls.extend(_frame_urls(child))
+    return urls
+
+
+def record_frame_origins(driver) -> None:
+    """
+    Remembers the origins of the current page and its iframes (CDP
+    Page.getFrameTree), whose storages 'reset' clears before the next
+    journey. Called after every step.
+    """
+    try:
+        tree = driver.execute_cdp_cmd('Page.getFrameTree', {})
+    except (AttributeError, WebDriverException):
+        return
+    session_id = getattr(driver, 'session_id', None)
+    _frame_origins.setdefault(session_id, set()).update(
+        _origins(_frame_urls(tree.get('frameTree', {}))))
+
+
+def _visited_origins(driver) -> Set[str]:
+    """
+    Collects origins visited by the browser: the navigation history of the
+    current tab, the frames seen during journeys and the domains of all
+    cookies (sites setting cookies usually keep storage too).
+    """
+    urls = []
+    try:
+        history = driver.execute_cdp_cmd('Page.getNavigationHistory', {})
+        urls.extend(entry['url'] for entry in history.get('entries', []))
+    except WebDriverException:
+        pass
+    origins = _origins(urls)
+    origins.update(_frame_origins.get(getattr(driver, 'session_id', None), ()))
+    try:
+        cookies = driver.execute_cdp_cmd('Network.getAllCookies', {}).get('cookies', [])
+    except WebDriverException:
+        cookies = []
+    for cookie in cookies:
+        domain = cookie.get('domain', '').lstrip('.')
+        if domain:
+            origins.update((f'https://{domain}', f'http://{domain}'))
+    return origins
+
+
+def _close_extra_windows(driver) -> None:
+    """
+    Closes all windows but the first one and switches to it.
+    """
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+
+
+def reset_browser_state(driver) -> None:
+    """
+    Resets the browser state in place: cookies, cache, storages of the
+    visited origins, selenium-wire request buffer and windows.
+
+    Args:
+        driver: WebDriver instance (Chrome).
+    """
+    origins = _visited_origins(driver)
+    _frame_origins.pop(getattr(driver, 'session_id', None), None)
+    _close_extra_windows(driver)
+    driver.get('about:blank')
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+    for origin in origins:
+        driver.execute_cdp_cmd(
+            'Storage.clearDataForOrigin',
+            {'origin': origin, 'storageTypes': 'all'}
+        )
+    if hasattr(driver, 'requests'):
+        del driver.requests
+
+
+def open_incognito_context(driver) -> None:
+    """
+    Opens a tab in a new browser context (like an incognito window),
+    switches the driver to it and disposes the previous context.
+
+    Args:
+        driver: WebDriver instance (Chrome).
+    """
+    previous_context = _browser_contexts.get(driver.session_id)
+    previous_handles = driver.window_handles
+    context = driver.execute_cdp_cmd(
+        'Target.createBrowserContext', {'disposeOnDetach': True})
+    context_id = context['browserContextId']
+    target = driver.execute_cdp_cmd(
+        'Target.createTarget',
+        {'url': 'about:blank', 'browserContextId': context_id}
+    )
+    # Window handles of chromedriver are the CDP target ids
+    driver.switch_to.window(target['targetId'])
+    for handle in previous_handles:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(target['targetId'])
+    if previous_context:
+        try:
+            driver.execute_cdp_cmd(
+                'Target.disposeBrowserContext',
+                {'browserContextId': previous_context}
+            )
+        except WebDriverException:
+            pass
+    _browser_contexts[driver.session_id] = context_id
+    if hasattr(driver, 'requests'):
+        del driver.requests
+
+
+def isolate_journey(driver, mode: str, relaunch: Callable):
+    """
+    Isolates the next journey from the state left by the previous one.
+
+    Args:
+        driver: WebDriver instance used by the previous journey.
+        mode: 'reset' (clear state in place), 'incognito' (fresh browser
+              context) or 'relaunch' (new browser).
+        relaunch: Callable returning a new WebDriver instance, used by 'relaunch'
+                  and as a fallback when the in place reset fails.
+
+    Returns:
+        WebDriver instance for the next journey.
+    """
+    mode = mode or DEFAULT_ISOLATION
+    if mode not in ISOLATION_MODES:
+        raise ValueError(f'Unsupported isolation mode: {mode}')
+    start_time = time.time()
+    try:
+        if mode == RESET:
+            reset_browser_state(driver)
+        elif mode == INCOGNITO:
+            open_incognito_context(driver)
+    except WebDriverException as er:
+        logging.warning(f'Journey isolation ({mode}) failed ({er}), relaunching browser')
+        mode = RELAUNCH
+    if mode == RELAUNCH:
+        _browser_contexts.pop(driver.session_id, None)
+        _frame_origins.pop(driver.session_id, None)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        driver = relaunch()
+    logging.info(f'Journey isolation ({mode}) took {time.time() - start_time:.2f} sec')
+    return driver
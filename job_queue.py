@@ -0,0 +1,310 @@
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from compiler import CAMPAIGNS_DIR, compile_campaigns
+
+JOB_QUEUE_FILE = 'reports/jobs.sqlite'
+# A claimed job goes back to the queue if its lease is not renewed in time, secs
+LEASE_SECS = 300
+# How often the leases of running jobs are renewed, secs
+HEARTBEAT_INTERVAL = 30
+# How many times a job is claimed before it is given up
+MAX_JOB_ATTEMPTS = 3
+# How often a runner with nothing to claim checks for expired leases, secs
+POLL_INTERVAL = 30
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run_name TEXT NOT NULL,
+    campaign_file TEXT NOT NULL,
+    test_index INTEGER NOT NULL,
+    campaign_id TEXT,
+    title TEXT,
+    engine TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    enqueued REAL,
+    started REAL,
+    finished REAL,
+    results_file TEXT,
+    error TEXT,
+    UNIQUE (run_name, campaign_file, test_index)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (run_name, status, lease_expires);
+"""
+
+
+def default_owner() -> str:
+    """
+    Returns the name of this process in leases, unique across containers.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parses a shard 'i/n' (0 <= i < n) into (i, n).
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be i/n, got {value!r}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be in 0..{count - 1}')
+    return index, count
+
+
+class JobQueue:
+    """
+    Journeys of a named run in a SQLite file, one job per (campaign file,
+    test case index). Processes on several nodes may share the file: a job
+    is claimed with a lease which its runner renews, a job whose runner
+    died goes back to the queue when the lease expires.
+
+    Args:
+        path: The SQLite file, e.g. on a volume shared by the containers.
+        run_name: Name of the run, enqueueing the same run again only adds
+                  missing jobs, so a restarted run resumes.
+        shard: Optional (index, count), only jobs with id % count == index
+               are claimed.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_FILE, run_name: str = 'default',
+                 shard: Tuple[int, int] = None):
+        self.path = path
+        self.run_name = run_name
+        self.shard = shard
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            # Not WAL: its shared-memory index does not work across hosts on a
+            # network filesystem, the rollback journal only needs file locks.
+            # Also switches back a queue file created in WAL mode.
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call, leases are renewed from another thread
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            # Take the write lock up front, so two claims never pick the same job
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, campaign_files: List[str], campaigns_dir: str = CAMPAIGNS_DIR) -> int:
+        """
+        Adds a job per test case of the campaigns, skipping jobs the run
+        already has.
+
+        Raises:
+            CampaignError: If any campaign is invalid.
+
+        Returns:
+            int: Number of jobs added.
+        """
+        campaigns = compile_campaigns(campaign_files, campaigns_dir)
+        now = time.time()
+        rows = [
+            (self.run_name, campaign.file_name, index, str(campaign.campaign_id),
+             journey.title, journey.engine, now)
+            for campaign in campaigns
+            for index, journey in enumerate(campaign.journeys)
+        ]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO jobs (run_name, campaign_file, test_index, '
+                'campaign_id, title, engine, enqueued) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            return conn.total_changes - before
+
+    def claim(self, owner: str, limit: int = 1, engine: str = None,
+              lease: float = LEASE_SECS) -> List[Dict]:
+        """
+        Claims up to `limit` pending jobs, jobs whose lease expired, or jobs
+        leased to the same owner name: a runner restarted in its container
+        usually has the name of the one which died (same host, pid 1).
+        Jobs claimed MAX_JOB_ATTEMPTS times already are marked failed.
+
+        Args:
+            owner: Name of the claiming process, see default_owner().
+            limit: Max number of jobs to claim.
+            engine: Only claim jobs of this engine.
+            lease: Lease duration, secs.
+
+        Returns:
+            list: Claimed jobs as dictionaries of their columns.
+        """
+        now = time.time()
+        query = ('SELECT * FROM jobs WHERE run_name = ? AND (status = ? '
+                 'OR (status = ? AND (lease_expires < ? OR lease_owner = ?)))')
+        params = [self.run_name, PENDING, LEASED, now, owner]
+        if engine is not None:
+            query += ' AND engine = ?'
+            params.append(engine)
+        if self.shard is not None:
+            query += ' AND id % ? = ?'
+            params.extend([self.shard[1], self.shard[0]])
+        query += ' ORDER BY id'
+        claimed = []
+        with self._transaction() as conn:
+            for row in conn.execute(query, params).fetchall():
+                if row['attempts'] >= MAX_JOB_ATTEMPTS:
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?',
+                        (FAILED, now, f"lease expired {row['attempts']} times", row['id']))
+                    continue
+                conn.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, '
+                    'lease_expires = ?, started = ? WHERE id = ?',
+                    (LEASED, owner, now + lease, now, row['id']))
+                claimed.append(dict(row, status=LEASED, lease_owner=owner,
+                                    attempts=row['attempts'] + 1))
+                if len(claimed) >= limit:
+                    break
+        return claimed
+
+    def heartbeat(self, owner: str, job_ids: List[int], lease: float = LEASE_SECS) -> None:
+        """
+        Renews the leases of running jobs.
+        """
+        if not job_ids:
+            return
+        marks = ', '.join('?' * len(job_ids))
+        with self._transaction() as conn:
+            conn.execute(
+                f'UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? '
+                f'AND status = ? AND id IN ({marks})',
+                [time.time() + lease, owner, LEASED, *job_ids])
+
+    def complete(self, job_id: int, owner: str, results_file: str = None) -> None:
+        """
+        Records a finished journey.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, finished = ?, results_file = ?, error = NULL '
+                'WHERE id = ? AND lease_owner = ?',
+                (DONE, time.time(), results_file, job_id, owner))
+
+    def fail(self, job_id: int, owner: str, error: str) -> None:
+        """
+        Records a journey which failed with an error. The error is part of
+        the result, the job is not retried.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, finished = ?, error = ? '
+                'WHERE id = ? AND lease_owner = ?',
+                (FAILED, time.time(), error, job_id, owner))
+
+    def release(self, job_id: int, owner: str) -> None:
+        """
+        Puts a claimed job back to the queue, e.g. on shutdown.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires = NULL, '
+                'attempts = MAX(attempts - 1, 0) WHERE id = ? AND lease_owner = ? AND status = ?',
+                (PENDING, job_id, owner, LEASED))
+
+    def next_expiry(self) -> Optional[float]:
+        """
+        Returns when the first lease held by a runner expires, None if no
+        job of the run (and shard) is leased.
+        """
+        query = 'SELECT MIN(lease_expires) FROM jobs WHERE run_name = ? AND status = ?'
+        params = [self.run_name, LEASED]
+        if self.shard is not None:
+            query += ' AND id % ? = ?'
+            params.extend([self.shard[1], self.shard[0]])
+        with self._connect() as conn:
+            return conn.execute(query, params).fetchone()[0]
+
+    def progress(self) -> Dict[str, int]:
+        """
+        Returns the number of jobs of the run by status.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT status, COUNT(*) FROM jobs WHERE run_name = ? GROUP BY status',
+                (self.run_name,)).fetchall()
+        return {status: count for status, count in rows}
+
+
+class LeaseKeeper:
+    """
+    Renews the leases of the jobs held by this process in a background thread.
+    """
+
+    def __init__(self, job_queue: JobQueue, owner: str,
+                 interval: float = HEARTBEAT_INTERVAL):
+        self.job_queue = job_queue
+        self.owner = owner
+        self.interval = interval
+        self.job_ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                job_ids = list(self.job_ids)
+            try:
+                self.job_queue.heartbeat(self.owner, job_ids)
+            except sqlite3.Error:
+                # Try again with the next heartbeat, the lease is longer
+                pass
+
+    def hold(self, job_ids: List[int]) -> None:
+        with self._lock:
+            self.job_ids.update(job_ids)
+
+    def drop(self, job_id: int) -> None:
+        with self._lock:
+            self.job_ids.discard(job_id)
+
+    def __enter__(self) -> 'LeaseKeeper':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Job queue of campaign runs')
+    parser.add_argument('run_name', help='name of the run')
+    parser.add_argument('--queue', default=JOB_QUEUE_FILE, help='SQLite file of the queue')
+    args = parser.parse_args()
+    for status, count in sorted(JobQueue(args.queue, args.run_name).progress().items()):
+        print(f'{status}: {count}')
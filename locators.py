@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from selenium.common.exceptions import InvalidSelectorException
+from selenium.webdriver.common.by import By
+
+# Locator types of selectors, kept between runs
+LOCATOR_CACHE_FILE = '.cache/locators.json'
+
+_XPATH_PREFIXES = ('/', '(', './', '..')
+_CSS_PREFIXES = ('#', '.', '[', '*')
+# Attribute steps (div[@id], a/@href) or axes (following-sibling::)
+_XPATH_PATTERN = re.compile(r'\[@|/@|::')
+# Combinators, pseudo classes, attribute selectors or tag.class / tag#id
+_CSS_PATTERN = re.compile(r'[>~+]|:[\w-]|\[[\w-]+[~|^$*]?=|^[\w-]+[.#][\w-]')
+
+
+def classify_by_syntax(selector: str) -> Optional[str]:
+    """
+    Classifies a selector as XPath or CSS selector by its syntax.
+
+    Args:
+        selector: The CSS selector or XPath expression from the YAML.
+
+    Returns:
+        By.XPATH, By.CSS_SELECTOR or None if the syntax is valid for both.
+    """
+    selector = selector.strip()
+    # '@' alone is no sign of XPath, CSS attribute values may hold it (mailto:x@y)
+    if selector.startswith(_XPATH_PREFIXES) or _XPATH_PATTERN.search(selector):
+        return By.XPATH
+    if selector.startswith(_CSS_PREFIXES) or _CSS_PATTERN.search(selector):
+        return By.CSS_SELECTOR
+    return None
+
+
+def probe_locator(driver, selector: str) -> Optional[str]:
+    """
+    Classifies a selector by looking it up in the current page.
+
+    Returns:
+        By.XPATH, By.CSS_SELECTOR or None if nothing was found with either.
+    """
+    try:
+        if driver.find_elements(By.CSS_SELECTOR, selector):
+            return By.CSS_SELECTOR
+    except InvalidSelectorException:
+        return By.XPATH
+    try:
+        if driver.find_elements(By.XPATH, selector):
+            return By.XPATH
+    except InvalidSelectorException:
+        return By.CSS_SELECTOR
+    return None
+
+
+class LocatorCache:
+    """
+    Locator types of campaign selectors keyed by campaign and selector,
+    persisted in a JSON file between runs.
+    """
+
+    def __init__(self, path: str = LOCATOR_CACHE_FILE):
+        self.path = path
+        self.locators = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.locators = json.load(f)
+            except (OSError, ValueError) as er:
+                logging.warning(f'Locator cache {path} is not readable ({er}), starting empty')
+
+    def get(self, campaign_id, selector: str) -> Optional[str]:
+        return self.locators.get(str(campaign_id), {}).get(selector)
+
+    def set(self, campaign_id, selector: str, by: str) -> None:
+        with self._lock:
+            self.locators.setdefault(str(campaign_id), {})[selector] = by
+            self._changed = True
+
+    def classify_campaign(self, campaign_id, user_journeys: List[Dict]) -> None:
+        """
+        Classifies the selectors of all steps of a campaign by their syntax.
+        Selectors valid for both types are left to the probe at run time.
+        """
+        for user_journey in user_journeys:
+            for step in user_journey.get('steps') or []:
+                selector = step.get('selector')
+                if not selector or self.get(campaign_id, selector):
+                    continue
+                by = classify_by_syntax(selector)
+                if by:
+                    self.set(campaign_id, selector, by)
+
+    def resolve(self, driver, campaign_id, selector: str) -> str:
+        """
+        Returns the locator type of a selector, probing the page once
+        if it is not known yet.
+        """
+        by = self.get(campaign_id, selector)
+        if by:
+            return by
+        by = classify_by_syntax(selector) or probe_locator(driver, selector)
+        if by is None:
+            # Nothing on the page yet, do not remember the guess
+            return By.CSS_SELECTOR
+        self.set(campaign_id, selector, by)
+        logging.info(f'Selector classified as {by}: {selector}')
+        return by
+
+    def save(self) -> None:
+        """
+        Writes the cache atomically, merged with entries saved meanwhile
+        by other processes.
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            locators = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        locators = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            for campaign_id, selectors in self.locators.items():
+                locators.setdefault(campaign_id, {}).update(selectors)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(locators, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.locators = locators
+            self._changed = False
+
+
+# Cache shared by the runner of the current process
+locator_cache = LocatorCache()
@@ -0,0 +1,279 @@
+import atexit
+import logging
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List
+
+LOG_FORMAT = '%(levelname)s (%(asctime)s) - %(message)s'
+REPORTS_DIR = 'reports'
+# Max number of log records waiting for the writer thread
+LOG_QUEUE_SIZE = 10000
+# Max number of characters of a logged body or cookie dump
+LOG_VALUE_LIMIT = 2000
+# Log files kept open at the same time by the writer thread
+MAX_OPEN_LOG_FILES = 32
+# Level of verbose network payloads (headers, bodies, cookie dumps), below DEBUG
+PAYLOAD = 5
+logging.addLevelName(PAYLOAD, 'PAYLOAD')
+
+# Campaign and journey of the records of the current thread
+_context = threading.local()
+# Log every Nth verbose network payload, 1 for all, 0 for none
+PAYLOAD_SAMPLE = 1
+
+# Options shared with worker processes, see log_options()
+_options = {'value_limit': LOG_VALUE_LIMIT, 'payload_sample': PAYLOAD_SAMPLE}
+# Payloads seen, counted by the journey and HTTP engine threads
+_payloads_seen = 0
+_payloads_lock = threading.Lock()
+_listener = None
+_router = None
+
+
+def truncate(value, limit: int = None) -> str:
+    """
+    Returns str(value) cut to the limit of logged values, with the number of
+    dropped characters.
+    """
+    limit = _options['value_limit'] if limit is None else limit
+    text = str(value)
+    if limit and len(text) > limit:
+        return f'{text[:limit]}... [{len(text) - limit} more chars]'
+    return text
+
+
+def set_log_context(campaign_id=None, journey: str = None) -> None:
+    """
+    Sets the campaign and journey the following records of this thread
+    belong to, they go to the campaign and journey log files as well.
+    """
+    _context.campaign_id = campaign_id
+    _context.journey = journey
+
+
+def log_payload(label: str, value) -> None:
+    """
+    Logs a verbose network payload at the PAYLOAD level, cut to the limit
+    of logged values. With 'payload_sample' N only every Nth payload is
+    logged, 0 logs none. The value is only converted to text if the payload
+    is logged.
+    """
+    global _payloads_seen
+    every = _options['payload_sample']
+    if not every or not logging.getLogger().isEnabledFor(PAYLOAD):
+        return
+    with _payloads_lock:
+        _payloads_seen += 1
+        skipped = (_payloads_seen - 1) % every
+    if skipped:
+        return
+    logging.log(PAYLOAD, f'{label}: {truncate(value)}')
+
+
+class LogContextFilter(logging.Filter):
+    """
+    Stamps records with the campaign and journey of the emitting thread.
+    Records coming from worker processes keep their own stamps.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'campaign_id'):
+            record.campaign_id = getattr(_context, 'campaign_id', None)
+            record.journey = getattr(_context, 'journey', None)
+        return True
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue without blocking the driver thread.
+    When the writer falls behind, INFO and lower records are dropped and
+    counted, warnings and errors wait for free space.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.addFilter(LogContextFilter())
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def file_part(value) -> str:
+    """
+    Returns a value, e.g. a journey title, made safe for a file name.
+    """
+    return re.sub(r'[^\w.-]+', '_', str(value)).strip('_') or 'journey'
+
+
+class RoutingFileHandler(logging.Handler):
+    """
+    Writes every record to the run log reports/<run_name>.log and, if the
+    record has a campaign and journey, to reports/<campaign_id>/<run_name>.log
+    and reports/<campaign_id>/<run_name>-<journey>.log. Runs in the writer
+    thread of the queue listener.
+    """
+
+    def __init__(self, run_name: str, reports_dir: str = REPORTS_DIR):
+        super().__init__()
+        self.run_name = run_name
+        self.reports_dir = reports_dir
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+        self._files = OrderedDict()
+
+    def paths(self, record: logging.LogRecord) -> List[str]:
+        paths = [os.path.join(self.reports_dir, f'{self.run_name}.log')]
+        campaign_id = getattr(record, 'campaign_id', None)
+        if campaign_id is not None:
+            folder_name = os.path.join(self.reports_dir, str(campaign_id))
+            paths.append(os.path.join(folder_name, f'{self.run_name}.log'))
+            journey = getattr(record, 'journey', None)
+            if journey:
+                paths.append(os.path.join(
+                    folder_name, f'{self.run_name}-{file_part(journey)}.log'))
+        return paths
+
+    def _stream(self, path: str):
+        stream = self._files.pop(path, None)
+        if stream is None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            stream = open(path, 'a', encoding='utf-8')
+            if len(self._files) >= MAX_OPEN_LOG_FILES:
+                _, oldest = self._files.popitem(last=False)
+                oldest.close()
+        # Most recently used last
+        self._files[path] = stream
+        return stream
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.format(record) + '\n'
+            for path in self.paths(record):
+                self._stream(path).write(line)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            for stream in self._files.values():
+                stream.flush()
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        self.acquire()
+        try:
+            for stream in self._files.values():
+                stream.close()
+            self._files.clear()
+        finally:
+            self.release()
+        super().close()
+
+
+class _FlushingListener(QueueListener):
+    """
+    Queue listener flushing the log files whenever the queue runs empty, so
+    the files are up to date without a flush per record.
+    """
+
+    def enqueue_sentinel(self) -> None:
+        # Wait for space instead of failing on a full queue
+        self.queue.put(self._sentinel)
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+
+def _set_levels(payload_sample: int) -> None:
+    logging.getLogger().setLevel(PAYLOAD if payload_sample else logging.DEBUG)
+    logging.getLogger('selenium').setLevel(logging.CRITICAL)
+    logging.getLogger('seleniumwire').setLevel(logging.WARNING)
+
+
+def configure_logging(run_name: str, reports_dir: str = REPORTS_DIR,
+                      value_limit: int = LOG_VALUE_LIMIT,
+                      payload_sample: int = PAYLOAD_SAMPLE) -> None:
+    """
+    Sets up logging of a run once: records are put on a bounded queue and
+    written to the log files by a background thread, so file I/O stays off
+    the driver thread. Further calls do nothing.
+
+    Args:
+        run_name: Name of the log files, e.g. the run timestamp.
+        reports_dir: Folder of the log files.
+        value_limit: Max characters of a logged body or cookie dump, 0 for no limit.
+        payload_sample: Log every Nth network payload, 1 (default) for all, 0 for none.
+    """
+    global _listener, _router
+    if _listener is not None:
+        return
+    _options.update(value_limit=value_limit, payload_sample=payload_sample)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _router = RoutingFileHandler(run_name, reports_dir)
+    root = logging.getLogger()
+    root.handlers = [BoundedQueueHandler(log_queue)]
+    _set_levels(payload_sample)
+    _listener = _FlushingListener(log_queue, _router, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """
+    Writes the queued records and closes the log files.
+    """
+    global _listener, _router
+    if _listener is None:
+        return
+    handler = logging.getLogger().handlers[0]
+    dropped = getattr(handler, 'dropped', 0)
+    if dropped:
+        logging.warning(f'{dropped} log records dropped, the log writer fell behind')
+    _listener.stop()
+    _router.close()
+    logging.getLogger().handlers = []
+    _listener = _router = None
+
+
+def listener_handlers() -> List[logging.Handler]:
+    """
+    Returns the handlers writing the log files, for records of worker processes.
+    """
+    return [_router] if _router is not None else list(logging.getLogger().handlers)
+
+
+def log_options() -> Dict:
+    """
+    Returns the logging options to pass to worker processes.
+    """
+    return dict(_options)
+
+
+def configure_worker_logging(log_queue, value_limit: int = LOG_VALUE_LIMIT,
+                             payload_sample: int = PAYLOAD_SAMPLE) -> None:
+    """
+    Sends the log records of a worker process to the pool process, which
+    writes the log files.
+    """
+    _options.update(value_limit=value_limit, payload_sample=payload_sample)
+    handler = QueueHandler(log_queue)
+    handler.addFilter(LogContextFilter())
+    logging.getLogger().handlers = [handler]
+    _set_levels(payload_sample)
@@ -1,9 +1,10 @@
+import argparse
 import os
-import yaml
+import time
 
 from datetime import datetime
-from json import dump
 from selenium import webdriver
+from seleniumwire import webdriver as wire_webdriver
 import shutil
 
 import logging
@@ -11,16 +12,46 @@ import logging
 import undetected_chromedriver as uc
 from undetected_chromedriver import Chrome
 
+from browser_daemon import warm_browser
+from budgets import circuit_breaker
+from compiler import (
+    CAMPAIGNS_DIR,
+    HTTP_ENGINE,
+    apply_replay,
+    compile_campaign,
+    compile_campaigns,
+)
+from http_engine import HTTP_THREADS, run_http_journeys
+from isolation import isolate_journey
+from job_queue import (
+    JOB_QUEUE_FILE,
+    POLL_INTERVAL,
+    JobQueue,
+    LeaseKeeper,
+    default_owner,
+    parse_shard,
+)
+from locators import locator_cache
+from logging_setup import LOG_VALUE_LIMIT, PAYLOAD_SAMPLE, configure_logging, set_log_context
+from memory import memory_governor, memory_high_water, wire_options
+from profiling import save_campaign_profile
+from replay import RECORD_MODE, RECORDINGS_DIR, REPLAY_MODE
+from results_sink import ResultSink
+from results_store import ingest_run
 from run_func import shopper_actions_by_steps
 from campaigns.campaigns_to_test import list_of_campaigns_to_test
+from workers import run_journeys_in_workers
 
 
-def browser_setup(browser_name='chrome') -> webdriver:
+def browser_setup(browser_name='chrome',
+                  user_data_dir='/tmp/chrome_user_data') -> webdriver:
     """
     Sets up a WebDriver instance for the specified browser with desired window size and page loading strategy.
     FIREFOX requires to set executable_path
     Args:
           browser_name (str, optional): The name of the browser to use. Defaults to "chrome".
+          user_data_dir (str, optional): Chrome profile directory, each parallel
+                                         worker needs its own one.
     Returns:
           webdriver: A WebDriver instance for the specified browser.
     """
@@ -32,15 +63,19 @@ def browser_setup(browser_name='chrome') -> webdriver:
         # If run in Docker, below line is to be uncommented
         options.add_argument('--no-sandbox')
         options.add_argument('--headless')
+        # Send loopback traffic through selenium-wire too (local test sites)
+        options.add_argument('--proxy-bypass-list=<-loopback>')
         options.page_load_strategy = 'eager'
-        driver = webdriver.Chrome(options=options)
 
         # Create a unique user data directory. This is for Docker
         # Or any other suitable path
-        user_data_dir = '/tmp/chrome_user_data'
         # create folder if it doesn't exist already
-        os.makedirs(user_data_dir,exist_ok=True)
+        os.makedirs(user_data_dir, exist_ok=True)
+        # Must be added before the driver is created to take effect
         options.add_argument(f'--user-data-dir={user_data_dir}')
+        # selenium-wire driver, its proxy captures traffic to tracking domains,
+        # its storage of requests is capped
+        driver = wire_webdriver.Chrome(options=options, seleniumwire_options=wire_options())
 
         # https://scrapfly.io/blog/web-scraping-without-blocking-using-undetected-chromedriver/
         # https://www.browserscan.net/bot-detection
@@ -66,88 +101,451 @@ def browser_setup(browser_name='chrome') -> webdriver:
     return driver
 
 
-def complete_purchase_and_save_results():
+def fresh_browser(user_data_dir='/tmp/chrome_user_data') -> webdriver:
+    """
+    Returns a new Chrome with an empty profile directory: a warm one from the
+    browser daemon (see browser_daemon.py) if it runs, else a local launch.
+    Used when a journey has to be isolated by relaunching the browser. The
+    memory governor starts counting anew for the new browser.
+    """
+    memory_governor.browser_replaced()
+    driver = warm_browser()
+    if driver is not None:
+        return driver
+    shutil.rmtree(user_data_dir, ignore_errors=True)
+    return browser_setup(user_data_dir=user_data_dir)
+
+
+def load_campaigns(run_test_for: list, campaigns_dir: str = CAMPAIGNS_DIR,
+                   replay: dict = None) -> list:
+    """
+    Loads, validates and compiles campaign YAML files before any browser starts.
+
+    Args:
+        run_test_for (list): File names of the campaigns in the 'campaigns' folder.
+        campaigns_dir (str, optional): Folder with the campaign YAML files.
+        replay (dict, optional): 'replay' setting applied to all campaigns, e.g.
+                                 {'mode': 'replay', 'dir': 'recordings'}. All their
+                                 journeys then run in the browser.
+    Returns:
+        list: CompiledCampaign objects. Selectors of the campaigns are classified
+              in the locator cache.
+    Raises:
+        CampaignError: If any campaign is invalid, with all errors found.
+    """
+    campaigns = compile_campaigns(run_test_for, campaigns_dir)
+    for campaign in campaigns:
+        # Classify selectors once, so each step needs exactly one lookup
+        locator_cache.classify_campaign(campaign.campaign_id, campaign.journeys)
+        apply_replay(campaign, replay)
+    return campaigns
+
+
+def finish_campaign_run(sink: ResultSink, file_name: str, results: list,
+                        compact: bool = True) -> None:
+    """
+    Closes the result stream of a campaign run, writes the legacy pretty JSON
+    (if compact) and the aggregated step profile, and adds the results to the
+    results store.
+    """
+    sink.close()
+    if compact:
+        sink.compact(file_name, results)
+    # Aggregated step profile (Prometheus text and folded stacks)
+    save_campaign_profile(sink.campaign_id, sink.run_id, results)
+    # Memory high-water marks of the run
+    sink.update_manifest(memory=memory_high_water(results))
+    # Indexed store of all runs, for queries across runs (results_store.py)
+    ingest_run(sink.campaign_id, sink.run_id, results, sink.path)
+
+
+def prepare_browser(driver, settings: dict):
+    """
+    Starts the browser for the first journey, relaunches it when it crossed
+    the memory limits of the campaign ('memory' setting), or isolates the
+    journey from the browser state of the previous one ('isolation' setting
+    of the campaign: reset, incognito or relaunch).
+
+    Returns:
+        The driver to run the journey with.
+    """
+    if driver is None:
+        return fresh_browser()
+    # Long runs: a browser over its memory limits is relaunched between journeys
+    reason = memory_governor.recycle_reason(settings.get('memory'))
+    if reason:
+        return memory_governor.recycle(driver, reason, fresh_browser)
+    return isolate_journey(driver, settings.get('isolation'), fresh_browser)
+
+
+def build_jobs(campaigns: list) -> list:
+    """
+    Returns a job per journey of the campaigns, in YAML order.
+    """
+    jobs = []
+    for campaign in campaigns:
+        for user_journey in campaign.journeys:
+            jobs.append({
+                'job_id': len(jobs),
+                'campaign_id': campaign.campaign_id,
+                'user_journey': user_journey,
+                'settings': campaign.settings,
+            })
+    return jobs
+
+
+def complete_purchase_from_queue(run_test_for: list, job_queue: JobQueue,
+                                 campaigns_dir: str = CAMPAIGNS_DIR,
+                                 compact: bool = True, replay: dict = None) -> None:
+    """
+    Runs the journeys of a named run from a persistent job queue. The
+    campaigns are enqueued first, which only adds the jobs the run does not
+    have yet, so the same command resumes an interrupted run. Several
+    processes or containers sharing the queue file split the jobs between
+    them: each job is leased to one runner, whose leases are renewed in the
+    background while it runs.
+
+    Args:
+        run_test_for (list): Campaign YAML file names.
+        job_queue (JobQueue): The queue of the run.
+        campaigns_dir (str, optional): Folder with the campaign YAML files.
+        compact (bool, optional): Also write the legacy pretty JSON results file
+                                  of the journeys run by this process.
+        replay (dict, optional): 'replay' setting applied to all campaigns.
+    """
+    owner = default_owner()
+    added = job_queue.enqueue(run_test_for, campaigns_dir)
+    logging.info(
+        f'Run {job_queue.run_name}: {added} jobs added, {job_queue.progress()}, runner {owner}')
+    file_name = datetime.now().strftime('%d%m%Y-%H%M')
+    sinks = {}
+    # campaign_id -> {test case index: result}, for the YAML order of the legacy JSON
+    results = {}
+    classified = set()
+    driver = None
+
+    def to_job(row) -> dict:
+        campaign = apply_replay(compile_campaign(row['campaign_file'], campaigns_dir), replay)
+        if campaign.file_name not in classified:
+            locator_cache.classify_campaign(campaign.campaign_id, campaign.journeys)
+            classified.add(campaign.file_name)
+        if campaign.campaign_id not in sinks:
+            sinks[campaign.campaign_id] = ResultSink(campaign.campaign_id)
+            results[campaign.campaign_id] = {}
+        return {
+            'job_id': row['id'],
+            'test_index': row['test_index'],
+            'campaign_id': campaign.campaign_id,
+            'user_journey': campaign.journeys[row['test_index']],
+            'settings': campaign.settings,
+        }
+
+    def on_result(job, result):
+        sink = sinks[job['campaign_id']]
+        sink.append(result)
+        results[job['campaign_id']][job['test_index']] = result
+        job_queue.complete(job['job_id'], owner, sink.path)
+        keeper.drop(job['job_id'])
+
+    def on_failure(job, error):
+        sinks[job['campaign_id']].failed(job['user_journey'].title, error)
+        job_queue.fail(job['job_id'], owner, error)
+        keeper.drop(job['job_id'])
+
+    with LeaseKeeper(job_queue, owner) as keeper:
+        try:
+            # Redirect and cookie-only journeys first, concurrently and without a browser.
+            # Recorded or replayed runs take them in the browser below, with the rest.
+            while not replay:
+                rows = job_queue.claim(owner, HTTP_THREADS, engine=HTTP_ENGINE)
+                if not rows:
+                    break
+                keeper.hold([row['id'] for row in rows])
+                run_http_journeys(
+                    [to_job(row) for row in rows], on_result=on_result, on_failure=on_failure)
+
+            while True:
+                rows = job_queue.claim(owner)
+                if not rows:
+                    # Jobs of runners which died come back when their lease expires
+                    expires = job_queue.next_expiry()
+                    if expires is None:
+                        break
+                    time.sleep(min(max(expires - time.time(), 0) + 1, POLL_INTERVAL))
+                    continue
+                keeper.hold([rows[0]['id']])
+                job = to_job(rows[0])
+                set_log_context(job['campaign_id'], job['user_journey'].title)
+                skip_reason = circuit_breaker.skip_reason(job['campaign_id'], job['user_journey'])
+                if skip_reason:
+                    logging.warning(skip_reason)
+                    on_failure(job, skip_reason)
+                    continue
+                logging.info(f"Running job {job['job_id']} for campaign id: {job['campaign_id']}")
+                try:
+                    driver = prepare_browser(driver, job['settings'])
+                    result = shopper_actions_by_steps(
+                        driver, job['campaign_id'], job['user_journey'],
+                        settings=job['settings'])
+                except Exception as er:
+                    logging.error(f"ERROR ({er}) test for campaign id: {job['campaign_id']}")
+                    on_failure(job, str(er))
+                    continue
+                on_result(job, result)
+        except BaseException:
+            # Interrupted, put the jobs of this runner back for the next one
+            for job_id in list(keeper.job_ids):
+                job_queue.release(job_id, owner)
+            raise
+        finally:
+            set_log_context()
+            for campaign_id, sink in sinks.items():
+                campaign_results = [
+                    result for _, result in sorted(results[campaign_id].items())]
+                finish_campaign_run(sink, file_name, campaign_results, compact)
+            locator_cache.save()
+            if driver is not None:
+                driver.quit()
+    logging.info(f'Run {job_queue.run_name}: {job_queue.progress()}')
+
+
+def run_http_jobs(jobs: list, sinks: dict) -> dict:
+    """
+    Runs the journeys of the HTTP engine (redirect and cookie-only checks)
+    concurrently without a browser, streaming their results to the sinks.
+
+    Returns:
+        dict: Results of the successful journeys keyed by job_id.
+    """
+    http_jobs = [job for job in jobs if job['user_journey'].engine == HTTP_ENGINE]
+    if http_jobs:
+        logging.info(f'Running {len(http_jobs)} journeys over HTTP')
+    return run_http_journeys(
+        http_jobs,
+        on_result=lambda job, result: sinks[job['campaign_id']].append(result),
+        on_failure=lambda job, error: sinks[job['campaign_id']].failed(
+            job['user_journey'].title, error),
+    )
+
+
+def complete_purchase_in_workers(run_test_for: list, workers: int,
+                                 campaigns_dir: str = CAMPAIGNS_DIR,
+                                 compact: bool = True, replay: dict = None) -> None:
+    """
+    Runs the journeys of all campaigns in a pool of isolated headless browsers
+    and merges the results back into reports/<campaign_id>/ in YAML order.
+    Journeys of the HTTP engine run first, without a browser.
+
+    Args:
+        run_test_for (list): Campaign YAML file names.
+        workers (int): Number of browser worker processes.
+        campaigns_dir (str, optional): Folder with the campaign YAML files.
+        compact (bool, optional): Also write the legacy pretty JSON results file.
+        replay (dict, optional): 'replay' setting applied to all campaigns.
+    """
+    file_name = datetime.now().strftime('%d%m%Y-%H%M')
+
+    campaigns = load_campaigns(run_test_for, campaigns_dir, replay)
+    sinks = {campaign.campaign_id: ResultSink(campaign.campaign_id) for campaign in campaigns}
+    jobs = build_jobs(campaigns)
+    results = run_http_jobs(jobs, sinks)
+
+    browser_jobs = [job for job in jobs if job['user_journey'].engine != HTTP_ENGINE]
+    logging.info(f'Running {len(browser_jobs)} journeys in {workers} workers')
+    # Results are streamed as they arrive, the legacy JSON keeps YAML order
+    results.update(run_journeys_in_workers(
+        browser_jobs, workers,
+        on_result=lambda job, result: sinks[job['campaign_id']].append(result),
+        on_failure=lambda job, error: sinks[job['campaign_id']].failed(
+            job['user_journey'].title, error),
+    ))
+
+    results_by_campaign = {campaign_id: [] for campaign_id in sinks}
+    for job in jobs:
+        if job['job_id'] in results:
+            results_by_campaign[job['campaign_id']].append(results[job['job_id']])
+    for campaign_id, campaign_results in results_by_campaign.items():
+        finish_campaign_run(sinks[campaign_id], file_name, campaign_results, compact)
+        logging.info(f'Completed test for campaign id: {campaign_id}')
+    locator_cache.save()
+
+
+def complete_purchase_and_save_results(workers: int = 1, run_test_for: list = None,
+                                       campaigns_dir: str = CAMPAIGNS_DIR,
+                                       compact: bool = True,
+                                       log_options: dict = None,
+                                       job_queue: JobQueue = None,
+                                       replay: dict = None):
     """
     This function iterates through a list of campaigns, performs purchase simulations
     using the `shopper_actions_by_steps` function for each user journey within a campaign,
     and saves the results in JSON format.
 
     It performs the following steps:
-        1. Iterates through a list of YAML files specifying user journeys for each campaign.
-        2. For each campaign:
-            - Opens the corresponding YAML file and loads the user journeys.
-            - Iterates through each user journey within the campaign.
-                - Creates a folder to store the results for the current campaign (if it doesn't exist).
-                - Creates a filename with a timestamp for the current test.
-                - Configures logging to suppress excessive output and save test results to a log file.
+        1. Loads, validates and compiles the list of YAML files specifying user journeys
+           for each campaign, an invalid campaign stops the run before the browser starts.
+           Opens a result stream reports/<campaign_id>/<run_id>.jsonl with its run manifest
+           per campaign.
+        2. Runs the redirect and cookie-only journeys (HTTP engine) concurrently
+           without a browser.
+        3. For each campaign:
+            - Iterates through each browser journey within the campaign.
+                - Routes the log records to the campaign and journey log files.
+                - Skips the journey if the circuit of its site is open, after repeated
+                  failed steps on it (see `budgets.CircuitBreaker`).
                 - Logs a message indicating the start of the test for the current campaign.
+                - Isolates the journey from the browser state of the previous one
+                  ('isolation' setting of the campaign: reset, incognito or relaunch).
                 - Simulates the purchase process using the `shopper_actions_by_steps` function, handling any exceptions.
                 - Logs a message indicating the completion of the test for the current campaign.
-                - Updates the timestamp for the current user journey.
-                - Saves the test results (including user journeys and timestamps) in a JSON file.
-                - Prints the test results (likely for debugging purposes).
+                - Appends the journey result to the result stream as soon as it is done.
+                - Prints the test result (likely for debugging purposes).
+            - Closes the result stream, writes the legacy pretty JSON file (if compact)
+              and the aggregated step profile of the campaign (.prom and .folded files).
+
+    Args:
+        workers (int, optional): Number of parallel browser processes. With more than
+                                 one worker journeys are spread across a worker pool
+                                 (see `complete_purchase_in_workers`).
+        run_test_for (list, optional): Campaign YAML file names, defaults to
+                                       `list_of_campaigns_to_test`.
+        campaigns_dir (str, optional): Folder with the campaign YAML files.
+        compact (bool, optional): At the end of every campaign also write the legacy
+                                  pretty JSON list of results.
+        log_options (dict, optional): Options of `logging_setup.configure_logging`,
+                                      e.g. {'value_limit': 2000, 'payload_sample': 10}.
+        job_queue (JobQueue, optional): Run the journeys from this persistent job queue
+                                        (see `complete_purchase_from_queue`).
+        replay (dict, optional): 'replay' setting applied to all campaigns: record every
+                                 response of the browser journeys, or serve them from the
+                                 recordings without network (see replay.py).
     """
-    run_test_for = list_of_campaigns_to_test
-    driver = browser_setup()
+    if run_test_for is None:
+        run_test_for = list_of_campaigns_to_test
+    # Logging is set up once per run, files are written by a background thread
+    configure_logging(datetime.now().strftime('%d%m%Y-%H%M'), **(log_options or {}))
+    if job_queue is not None:
+        complete_purchase_from_queue(run_test_for, job_queue, campaigns_dir, compact, replay)
+        return
+    if workers > 1:
+        complete_purchase_in_workers(run_test_for, workers, campaigns_dir, compact, replay)
+        return
+    # Invalid campaigns fail here, before the browser starts
+    campaigns = load_campaigns(run_test_for, campaigns_dir, replay)
+    # Create a file name with timestamp for the legacy results files
+    file_name = datetime.now().strftime('%d%m%Y-%H%M')
+    # Stream results to reports/<campaign_id>/<run_id>.jsonl
+    sinks = {campaign.campaign_id: ResultSink(campaign.campaign_id) for campaign in campaigns}
+    jobs = build_jobs(campaigns)
+    # Redirect and cookie-only journeys need no browser, they run concurrently first
+    http_results = run_http_jobs(jobs, sinks)
+    # The browser starts with the first journey which needs it
+    driver = None
 
-    for campaign in run_test_for:
+    for campaign in campaigns:
         results = []
+        campaign_id = campaign.campaign_id
+        settings = campaign.settings
+        sink = sinks[campaign_id]
 
-        # Open YAML file specifying user journeys for the current campaign
-        with open(f'campaigns/{campaign}', 'r') as c:
-            tests = yaml.safe_load(c)
-
-        # Unpack YAML as dictionary, extract first line - login
-        campaign_login = list(tests.keys())[0]
-        shopper_steps = tests.get(campaign_login)[0].get
-
-        for user_journey in shopper_steps('test_case'):
-            # Create a folder name to store the results for the current campaign
-            folder_name = f"reports/{shopper_steps('campaign_id')}"
-            # Create a file name with timestamp for the current test
-            file_name = datetime.now().strftime('%d%m%Y-%H%M')
-            if not os.path.exists(folder_name):
-                os.mkdir(folder_name)
-
-            # Configure logging to save test results in a log file
-            logging.getLogger('selenium').setLevel(logging.CRITICAL)
-            logging.basicConfig(
-                filename=f'reports/{file_name}.log',
-                level=logging.DEBUG,
-                format='%(levelname)s (%(asctime)s) - %(message)s'
-            )
+        for job in jobs:
+            if job['campaign_id'] != campaign_id:
+                continue
+            user_journey = job['user_journey']
+            if user_journey.engine == HTTP_ENGINE:
+                # Already streamed, kept here for the YAML order of the legacy JSON
+                if job['job_id'] in http_results:
+                    results.append(http_results[job['job_id']])
+                continue
+            # Following records also go to the campaign and journey log files
+            set_log_context(campaign_id, user_journey.title)
+            # A dead or hung site: its remaining journeys would only burn their timeouts
+            skip_reason = circuit_breaker.skip_reason(campaign_id, user_journey)
+            if skip_reason:
+                logging.warning(skip_reason)
+                sink.failed(user_journey.title, skip_reason)
+                continue
             logging.info(
-                f"Running test for campaign id: {shopper_steps('campaign_id')}"
+                f"Running test for campaign id: {campaign_id}"
             )
 
             try:
+                driver = prepare_browser(driver, settings)
                 # Simulate purchase process using shopper_actions_by_steps
                 # function
                 result = shopper_actions_by_steps(
                     driver,
-                    shopper_steps('campaign_id'),
-                    user_journey
+                    campaign_id,
+                    user_journey,
+                    settings=settings
                 )
                 results.append(result)
+                sink.append(result)
             except Exception as er:
                 print()
                 logging.error(
-                    f"ERROR ({er}) test for campaign id: {shopper_steps('campaign_id')}"
+                    f"ERROR ({er}) test for campaign id: {campaign_id}"
                 )
+                sink.failed(user_journey.title, str(er))
                 continue
             logging.info(
-                f"Completed test for campaign id: {shopper_steps('campaign_id')}"
+                f"Completed test for campaign id: {campaign_id}"
             )
+            # Print the test result (for debugging purposes)
+            print(result)
 
-            # Save the test results in JSON file
-            with open(f'{folder_name}/{file_name}.json', 'w') as test_file:
-                dump(results, test_file, indent=4, ensure_ascii=False)
-            # Print the test results (for debugging purposes)
-            print(tests)
+        # The JSONL stream is complete, write the legacy JSON once per campaign
+        finish_campaign_run(sink, file_name, results, compact)
+        set_log_context()
 
-    driver.close()
-    driver.quit()
+    locator_cache.save()
+    if driver is not None:
+        driver.close()
+        driver.quit()
 
 
 if __name__ == '__main__':
-    complete_purchase_and_save_results()
+    parser = argparse.ArgumentParser(description='Run mystery shopper campaigns')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of parallel headless browsers (default: 1)')
+    parser.add_argument(
+        '--no-compact', action='store_true',
+        help='only write the JSONL results stream, not the pretty JSON file')
+    parser.add_argument(
+        '--log-limit', type=int, default=LOG_VALUE_LIMIT,
+        help='max characters of a logged body or cookie dump, 0 for no limit')
+    parser.add_argument(
+        '--log-payloads', type=int, default=PAYLOAD_SAMPLE, metavar='N',
+        help='log every Nth network payload (headers, bodies, all cookies), cut to '
+             '--log-limit; 1 (default) for all, 0 for none')
+    parser.add_argument(
+        '--queue', nargs='?', const=JOB_QUEUE_FILE, metavar='PATH',
+        help=f'run from a persistent job queue, shared by all runners of the run '
+             f'(default file: {JOB_QUEUE_FILE})')
+    parser.add_argument(
+        '--run', default=datetime.now().strftime('%d%m%Y'),
+        help='name of the queued run, the same name resumes it (default: today)')
+    parser.add_argument(
+        '--shard', type=parse_shard, metavar='I/N',
+        help='only claim queued jobs of shard I of N')
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        '--record', nargs='?', const=RECORDINGS_DIR, metavar='DIR',
+        help=f'record every response of the browser journeys (default folder: {RECORDINGS_DIR})')
+    recording.add_argument(
+        '--replay', nargs='?', const=RECORDINGS_DIR, metavar='DIR',
+        help='serve the browser journeys from their recordings, without network')
+    args = parser.parse_args()
+    replay = None
+    if args.record:
+        replay = {'mode': RECORD_MODE, 'dir': args.record}
+    elif args.replay:
+        replay = {'mode': REPLAY_MODE, 'dir': args.replay}
+    complete_purchase_and_save_results(
+        workers=args.workers,
+        compact=not args.no_compact,
+        log_options={'value_limit': args.log_limit, 'payload_sample': args.log_payloads},
+        job_queue=JobQueue(args.queue, args.run, args.shard) if args.queue else None,
+        replay=replay,
+    )
@@ -0,0 +1,195 @@
+import logging
+import os
+from typing import Dict, List
+
+# Journey boundaries where the browser is relaunched, by default when the
+# RSS of Chrome and chromedriver or of this process crosses these, MB
+BROWSER_RSS_LIMIT = 1536
+PYTHON_RSS_LIMIT = 1024
+# Requests kept by selenium-wire, the oldest are evicted first. The capture
+# of tracking traffic copies what it needs, the storage only serves waits.
+WIRE_STORAGE_MAX_SIZE = 500
+MEMORY_KEYS = ('browser_mb', 'python_mb', 'max_journeys')
+PROC_DIR = '/proc'
+MB = 1024 * 1024
+
+
+def valid_memory_settings(value) -> bool:
+    """
+    Checks the 'memory' campaign setting, e.g.
+    {'browser_mb': 1024, 'python_mb': 768, 'max_journeys': 50}.
+    """
+    if not isinstance(value, dict) or set(value) - set(MEMORY_KEYS):
+        return False
+    return all(
+        isinstance(number, int) and not isinstance(number, bool) and number > 0
+        for number in value.values())
+
+
+def wire_options() -> Dict:
+    """
+    selenium-wire options capping the requests it keeps in memory.
+    """
+    return {'request_storage': 'memory', 'request_storage_max_size': WIRE_STORAGE_MAX_SIZE}
+
+
+def process_rss(pid: int) -> int:
+    """
+    Returns the resident set size of a process in bytes, 0 if unknown.
+    """
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'status')) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def child_pids(pid: int) -> List[int]:
+    """
+    Returns the descendants of a process, e.g. Chrome and its renderers
+    under chromedriver.
+    """
+    children = {}
+    try:
+        entries = os.listdir(PROC_DIR)
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIR, entry, 'stat')) as f:
+                # The command name may contain spaces, fields follow its ')'
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    descendants, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+    return descendants
+
+
+def driver_pid(driver) -> int:
+    """
+    Returns the pid of the chromedriver of a driver, None if not local.
+    """
+    process = getattr(getattr(driver, 'service', None), 'process', None)
+    return getattr(process, 'pid', None)
+
+
+def sample_memory(driver=None) -> Dict[str, float]:
+    """
+    Samples the RSS of this process, chromedriver and the browser, in MB.
+    A browser attached from the daemon (browser_daemon.py) is not under
+    chromedriver, its process tree is found by the pid of its lease.
+    """
+    sample = {'python': process_rss(os.getpid()) / MB, 'chromedriver': 0.0, 'chrome': 0.0}
+    pid = driver_pid(driver) if driver is not None else None
+    if pid is not None:
+        sample['chromedriver'] = process_rss(pid) / MB
+        sample['chrome'] = sum(process_rss(child) for child in child_pids(pid)) / MB
+    chrome_pid = getattr(driver, 'browser_pid', None)
+    if chrome_pid is not None:
+        sample['chrome'] += sum(
+            process_rss(process) for process in [chrome_pid] + child_pids(chrome_pid)) / MB
+    return {key: round(value, 1) for key, value in sample.items()}
+
+
+class MemoryGovernor:
+    """
+    Samples memory between the steps of journeys and decides at journey
+    boundaries whether the browser is relaunched: when Chrome and
+    chromedriver or this process (selenium-wire keeps its storage here)
+    crossed their limit, or after 'max_journeys' journeys of one browser.
+    """
+
+    def __init__(self):
+        self.peak = {}
+        self.last = {}
+        self.journeys = 0
+        self.recycled = 0
+        self._journey_peak = {}
+
+    def start_journey(self) -> None:
+        self.journeys += 1
+        self._journey_peak = {}
+
+    def sample(self, driver) -> Dict[str, float]:
+        """
+        Samples memory and updates the high-water marks.
+        """
+        sample = sample_memory(driver)
+        sample['browser'] = round(sample['chrome'] + sample['chromedriver'], 1)
+        for key, value in sample.items():
+            self._journey_peak[key] = max(self._journey_peak.get(key, 0), value)
+            self.peak[key] = max(self.peak.get(key, 0), value)
+        self.last = sample
+        return sample
+
+    def recycle_reason(self, settings: Dict = None) -> str:
+        """
+        Returns why the browser is relaunched before the next journey, None
+        if it is kept.
+        """
+        settings = settings or {}
+        max_journeys = settings.get('max_journeys')
+        if max_journeys and self.journeys >= max_journeys:
+            return f'{self.journeys} journeys run in this browser'
+        browser_limit = settings.get('browser_mb', BROWSER_RSS_LIMIT)
+        if self.last.get('browser', 0) > browser_limit:
+            return f"browser RSS {self.last['browser']} MB over {browser_limit} MB"
+        python_limit = settings.get('python_mb', PYTHON_RSS_LIMIT)
+        if self.last.get('python', 0) > python_limit:
+            return f"python RSS {self.last['python']} MB over {python_limit} MB"
+        return None
+
+    def recycle(self, driver, reason: str, relaunch):
+        """
+        Quits the browser and returns a new one from relaunch().
+        """
+        logging.warning(f'Relaunching browser: {reason}')
+        try:
+            driver.quit()
+        except Exception as er:
+            logging.warning(f'Browser did not quit cleanly ({er})')
+        self.recycled += 1
+        return relaunch()
+
+    def browser_replaced(self) -> None:
+        """
+        Starts counting journeys and memory of a new browser, whatever
+        replaced the old one (recycling, 'relaunch' isolation or its fallback).
+        """
+        self.journeys = 0
+        self.last = {}
+
+    def journey_summary(self) -> Dict:
+        return {
+            'peak_mb': dict(self._journey_peak),
+            'browser_journeys': self.journeys,
+            'recycled': self.recycled,
+        }
+
+
+def memory_high_water(results: List[Dict]) -> Dict:
+    """
+    Returns the memory high-water marks of a run from its journey results,
+    for the run manifest.
+    """
+    peak = {}
+    recycled = 0
+    for result in results:
+        memory = result.get('memory') or {}
+        for key, value in (memory.get('peak_mb') or {}).items():
+            peak[key] = max(peak.get(key, 0), value)
+        recycled = max(recycled, memory.get('recycled', 0))
+    return {'peak_mb': peak, 'browser_recycles': recycled}
+
+
+memory_governor = MemoryGovernor()
@@ -0,0 +1,175 @@
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from waits import waited_time
+
+# Prefix of the exported Prometheus metrics
+METRIC_PREFIX = 'mysteryshopper'
+
+
+class CommandCounter:
+    """
+    Counts WebDriver commands sent by a driver. Every command of the driver
+    and of its elements goes through driver.execute, which is wrapped once.
+    """
+
+    def __init__(self, driver):
+        self.count = 0
+        original_execute = driver.execute
+
+        def execute(driver_command, params=None):
+            self.count += 1
+            return original_execute(driver_command, params)
+
+        driver.execute = execute
+
+
+def command_counter(driver) -> CommandCounter:
+    """
+    Returns the command counter of the driver, installing it on first use.
+    """
+    counter = getattr(driver, '_command_counter', None)
+    if counter is None:
+        counter = CommandCounter(driver)
+        driver._command_counter = counter
+    return counter
+
+
+class StepProfiler:
+    """
+    Records a span for every step of a journey: action, selector, start and
+    end time, WebDriver commands, bytes captured by selenium-wire and the
+    split between waiting and work.
+    """
+
+    def __init__(self, driver, capture):
+        # No driver for journeys of the HTTP engine
+        self.counter = command_counter(driver) if driver is not None else None
+        self.capture = capture
+        self.spans = []
+        self._current = None
+
+    def _commands(self) -> int:
+        return self.counter.count if self.counter is not None else 0
+
+    def start(self, step_number: int, step: Dict) -> None:
+        self._current = {
+            'step': step_number,
+            'action': step.get('action'),
+            'selector': step.get('selector') or step.get('url'),
+            'start': time.time(),
+            '_commands': self._commands(),
+            '_waited': waited_time(),
+        }
+
+    def end(self, error: str = None) -> Dict:
+        span = self._current
+        span['end'] = time.time()
+        span['duration'] = round(span['end'] - span['start'], 4)
+        span['commands'] = self._commands() - span.pop('_commands')
+        span['wait_time'] = round(waited_time() - span.pop('_waited'), 4)
+        span['work_time'] = round(max(span['duration'] - span['wait_time'], 0), 4)
+        span['bytes_captured'] = sum(
+            entry.get('size', 0)
+            for entry in self.capture.by_step.get(span['step'], []))
+        if error:
+            span['error'] = error
+        self.spans.append(span)
+        self._current = None
+        return span
+
+    def summary(self) -> Dict:
+        """
+        Returns the spans with journey totals, for the journey result.
+        """
+        return {
+            'steps': self.spans,
+            'duration': round(sum(span['duration'] for span in self.spans), 4),
+            'commands': sum(span['commands'] for span in self.spans),
+            'commands_per_step': round(
+                sum(span['commands'] for span in self.spans) / max(len(self.spans), 1), 2),
+            'wait_time': round(sum(span['wait_time'] for span in self.spans), 4),
+            'work_time': round(sum(span['work_time'] for span in self.spans), 4),
+            'bytes_captured': sum(span['bytes_captured'] for span in self.spans),
+        }
+
+
+def _label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def prometheus_profile(campaign_id, results: List[Dict]) -> str:
+    """
+    Aggregates step spans of a campaign run in Prometheus text format.
+    """
+    steps = defaultdict(lambda: defaultdict(float))
+    journeys = []
+    for result in results:
+        profile = result.get('profile') or {}
+        journeys.append((result.get('test_name'), profile.get('duration', 0)))
+        for span in profile.get('steps', []):
+            totals = steps[span['action']]
+            totals['count'] += 1
+            for key in ('duration', 'wait_time', 'work_time', 'commands', 'bytes_captured'):
+                totals[key] += span.get(key, 0)
+
+    campaign = _label(campaign_id)
+    lines = []
+    metrics = [
+        ('step_duration_seconds', 'summary', 'Time spent in steps by action', 'duration'),
+        ('step_wait_seconds_total', 'counter', 'Time spent waiting in steps by action', 'wait_time'),
+        ('step_work_seconds_total', 'counter', 'Time spent working in steps by action', 'work_time'),
+        ('step_webdriver_commands_total', 'counter', 'WebDriver commands sent in steps by action', 'commands'),
+        ('step_captured_bytes_total', 'counter', 'Bytes captured by selenium-wire in steps by action', 'bytes_captured'),
+    ]
+    for name, kind, help_text, key in metrics:
+        metric = f'{METRIC_PREFIX}_{name}'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for action, totals in sorted(steps.items()):
+            labels = f'campaign="{campaign}",action="{_label(action)}"'
+            if kind == 'summary':
+                lines.append(f'{metric}_sum{{{labels}}} {totals[key]:.4f}')
+                lines.append(f'{metric}_count{{{labels}}} {int(totals["count"])}')
+            else:
+                lines.append(f'{metric}{{{labels}}} {totals[key]:g}')
+    metric = f'{METRIC_PREFIX}_journey_duration_seconds'
+    lines.append(f'# HELP {metric} Duration of journeys')
+    lines.append(f'# TYPE {metric} gauge')
+    for test_name, duration in journeys:
+        lines.append(
+            f'{metric}{{campaign="{campaign}",test_name="{_label(test_name)}"}} {duration:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+def flame_profile(campaign_id, results: List[Dict]) -> str:
+    """
+    Summarises step spans of a campaign run as folded stacks
+    ('campaign;journey;step action;wait|work milliseconds'), the input format
+    of flamegraph.pl and speedscope.
+    """
+    stacks = defaultdict(int)
+    for result in results:
+        journey = str(result.get('test_name')).replace(';', ',')
+        for span in (result.get('profile') or {}).get('steps', []):
+            frame = f"{campaign_id};{journey};{span['step']:02d} {span['action']}"
+            for part in ('wait', 'work'):
+                milliseconds = int(span.get(f'{part}_time', 0) * 1000)
+                if milliseconds:
+                    stacks[f'{frame};{part}'] += milliseconds
+    return ''.join(f'{stack} {value}\n' for stack, value in stacks.items())
+
+
+def save_campaign_profile(campaign_id, file_name: str, results: List[Dict]) -> None:
+    """
+    Saves the aggregated profile of a campaign run next to its results:
+    reports/<campaign_id>/<file_name>.prom and <file_name>.folded.
+    """
+    folder_name = f'reports/{campaign_id}'
+    os.makedirs(folder_name, exist_ok=True)
+    with open(f'{folder_name}/{file_name}.prom', 'w') as prom_file:
+        prom_file.write(prometheus_profile(campaign_id, results))
+    with open(f'{folder_name}/{file_name}.folded', 'w') as flame_file:
+        flame_file.write(flame_profile(campaign_id, results))
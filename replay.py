@@ -0,0 +1,253 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from capture import TrackingCapture, decode_body, decode_content
+from logging_setup import file_part
+from results_sink import write_json_atomic
+
+# Folder of the archives, one per journey: recordings/<campaign_id>/<journey>/
+RECORDINGS_DIR = 'recordings'
+RECORD_MODE = 'record'
+REPLAY_MODE = 'replay'
+REPLAY_MODES = (RECORD_MODE, REPLAY_MODE)
+REPLAY_KEYS = ('mode', 'dir')
+ARCHIVE_VERSION = 2
+INDEX_FILE = 'index.json'
+BODIES_FILE = 'bodies.bin'
+# Query parameters differing between runs of the same journey
+VOLATILE_PARAMS = ('subid',)
+# Bodies are stored decompressed, the proxy encodes and frames the served
+# body itself, so these headers are not kept
+SKIPPED_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length', 'connection')
+
+
+def valid_replay_settings(value) -> bool:
+    """
+    Checks the 'replay' campaign setting, e.g.
+    {'mode': 'replay', 'dir': 'recordings'}.
+    """
+    if not isinstance(value, dict) or set(value) - set(REPLAY_KEYS):
+        return False
+    return value.get('mode') in REPLAY_MODES and isinstance(value.get('dir', ''), str)
+
+
+def archive_key(method: str, url: str) -> str:
+    """
+    Key of a request in the archive: method and URL without the parameters
+    which change between runs, e.g. the SUBID.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = [
+        (name, value)
+        for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in VOLATILE_PARAMS
+    ]
+    url = urllib.parse.urlunsplit(
+        (parts.scheme, parts.netloc, parts.path, urllib.parse.urlencode(query), ''))
+    return f'{method.upper()} {url}'
+
+
+def archive_path(campaign_id, journey_title: str, directory: str = RECORDINGS_DIR) -> str:
+    return os.path.join(directory or RECORDINGS_DIR, str(campaign_id), file_part(journey_title))
+
+
+def _headers(headers) -> List[Tuple[str, str]]:
+    return [
+        [name, value] for name, value in headers.items()
+        if name.lower() not in SKIPPED_HEADERS
+    ]
+
+
+class JourneyRecorder:
+    """
+    Records every response of a journey through the selenium-wire response
+    interceptor into its archive: bodies decompressed and appended once per
+    distinct content to bodies.bin, and index.json with the responses to
+    each request key in the order they arrived, pointing at their body by
+    offset and length. The archive of an earlier recording is replaced when
+    the journey ends.
+    """
+
+    mode = RECORD_MODE
+
+    def __init__(self, path: str, capture: TrackingCapture):
+        self.path = path
+        self.capture = capture
+        self.responses = defaultdict(list)
+        self.bodies = {}
+        self.count = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._bodies_path = os.path.join(path, f'{BODIES_FILE}.{os.getpid()}.tmp')
+        self._file = open(self._bodies_path, 'wb')
+
+    def attach(self, driver) -> None:
+        """
+        Widens the capture to all traffic, the tracking capture still gets
+        the responses of its domains.
+        """
+        driver.scopes = []
+        driver.response_interceptor = self.intercept
+
+    def intercept(self, request, response) -> None:
+        """
+        selenium-wire response interceptor, runs in the proxy thread.
+        """
+        self.capture.intercept(request, response)
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        try:
+            body = decode_content(response.body, encoding)
+        except ValueError as er:
+            logging.warning(f'Recorded undecoded body of {request.url}: {er}')
+            body = response.body or b''
+        digest = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if digest not in self.bodies:
+                self._file.write(body)
+                self.bodies[digest] = [self._size, len(body)]
+                self._size += len(body)
+            self.responses[archive_key(request.method, request.url)].append({
+                'step': self.capture.step,
+                'status_code': response.status_code,
+                'headers': _headers(response.headers),
+                'body': digest,
+            })
+            self.count += 1
+
+    def close(self, driver) -> None:
+        """
+        Stops recording and writes the archive.
+        """
+        if getattr(driver, 'response_interceptor', None) == self.intercept:
+            del driver.response_interceptor
+        with self._lock:
+            self._file.close()
+            os.replace(self._bodies_path, os.path.join(self.path, BODIES_FILE))
+            write_json_atomic(os.path.join(self.path, INDEX_FILE), {
+                'version': ARCHIVE_VERSION,
+                'recorded': time.time(),
+                'bodies': self.bodies,
+                'responses': self.responses,
+            })
+        logging.info(
+            f'Recorded {self.count} responses ({len(self.bodies)} bodies, '
+            f'{self._size} bytes) to {self.path}')
+
+    def summary(self) -> Dict:
+        return {
+            'mode': self.mode,
+            'archive': self.path,
+            'responses': self.count,
+            'bodies': len(self.bodies),
+            'bytes': self._size,
+        }
+
+
+class JourneyReplayer:
+    """
+    Serves the requests of a journey from its archive through the
+    selenium-wire request interceptor, so the journey runs without network.
+    Repeated requests get the recorded responses in order, the last one once
+    they are used up. Requests the archive has no response to get a 404 and
+    are reported as unrecorded. Tracking traffic is captured as it is served.
+    """
+
+    mode = REPLAY_MODE
+
+    def __init__(self, path: str, capture: TrackingCapture):
+        self.path = path
+        self.capture = capture
+        self.served = 0
+        self.unrecorded = []
+        self._used = defaultdict(int)
+        self._lock = threading.Lock()
+        self._file = None
+        try:
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                index = json.load(f)
+            self._file = open(os.path.join(path, BODIES_FILE), 'rb')
+        except (OSError, ValueError) as er:
+            logging.error(f'No recording in {path} ({er}), every request is unrecorded')
+            index = {}
+        if index and index.get('version') != ARCHIVE_VERSION:
+            logging.error(f'Recording in {path} is of an older format, record it again')
+            index = {}
+        self.recorded = index.get('recorded')
+        self.bodies = index.get('bodies', {})
+        self.responses = index.get('responses', {})
+
+    def attach(self, driver) -> None:
+        """
+        Sends all traffic through the interceptor, nothing reaches the network.
+        """
+        if getattr(driver, 'response_interceptor', None) is not None:
+            del driver.response_interceptor
+        driver.scopes = []
+        driver.request_interceptor = self.serve
+
+    def _body(self, digest: str) -> bytes:
+        offset, length = self.bodies[digest]
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def serve(self, request) -> None:
+        """
+        selenium-wire request interceptor, runs in the proxy thread.
+        """
+        key = archive_key(request.method, request.url)
+        with self._lock:
+            responses = self.responses.get(key)
+            if not responses:
+                self.unrecorded.append(
+                    {'step': self.capture.step, 'method': request.method, 'url': request.url})
+                logging.warning(f'Not recorded: {request.method} {request.url}')
+                request.create_response(status_code=404, headers=[], body=b'')
+                return
+            response = responses[min(self._used[key], len(responses) - 1)]
+            self._used[key] += 1
+            body = self._body(response['body'])
+            self.served += 1
+        request.create_response(
+            status_code=response['status_code'], headers=response['headers'], body=body)
+        self.capture.record(
+            request.url, request.method, dict(request.headers), response['status_code'],
+            dict(response['headers']), decode_body(body), len(body))
+
+    def close(self, driver) -> None:
+        if getattr(driver, 'request_interceptor', None) == self.serve:
+            del driver.request_interceptor
+        if self._file is not None:
+            self._file.close()
+        if self.unrecorded:
+            logging.warning(f'{len(self.unrecorded)} requests not in the recording {self.path}')
+
+    def summary(self) -> Dict:
+        return {
+            'mode': self.mode,
+            'archive': self.path,
+            'recorded': self.recorded,
+            'served': self.served,
+            'unrecorded': self.unrecorded,
+        }
+
+
+def replay_session(campaign_id, journey_title: str, settings: Dict,
+                   capture: TrackingCapture):
+    """
+    Returns the recorder or replayer of a journey for the 'replay' campaign
+    setting, None without one.
+    """
+    if not settings:
+        return None
+    path = archive_path(campaign_id, journey_title, settings.get('dir'))
+    if settings['mode'] == RECORD_MODE:
+        return JourneyRecorder(path, capture)
+    return JourneyReplayer(path, capture)
@@ -0,0 +1,244 @@
+import logging
+from typing import Dict, List, Tuple
+
+from selenium.common.exceptions import WebDriverException
+
+from capture import DEFAULT_TRACKING_DOMAINS
+
+# File extensions of the resource types blocked on page loads
+RESOURCE_EXTENSIONS = {
+    'image': ('jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'svg', 'ico', 'bmp'),
+    'font': ('woff', 'woff2', 'ttf', 'otf', 'eot'),
+    'media': ('mp4', 'webm', 'ogg', 'ogv', 'mp3', 'wav', 'mov', 'm3u8'),
+}
+# Hosts of third-party widgets (video embeds, chats, maps) not needed for a purchase
+WIDGET_HOSTS = (
+    'youtube.com',
+    'ytimg.com',
+    'vimeo.com',
+    'vimeocdn.com',
+    'jivosite.com',
+    'livechatinc.com',
+    'tawk.to',
+    'intercom.io',
+    'zopim.com',
+    'api-maps.yandex.ru',
+    'maps.googleapis.com',
+)
+RESOURCE_TYPES = tuple(RESOURCE_EXTENSIONS) + ('widget',)
+DEFAULT_BLOCKED = RESOURCE_TYPES
+RESOURCE_KEYS = ('block', 'allow', 'urls', 'baseline')
+
+# Requests and bytes transferred by the current page. Cross-origin resources
+# without Timing-Allow-Origin report 0 bytes, they are still counted.
+PAGE_METRICS_SCRIPT = """
+var entries = performance.getEntriesByType('navigation')
+    .concat(performance.getEntriesByType('resource'));
+var bytes = 0;
+for (var i = 0; i < entries.length; i++) {
+    bytes += entries[i].transferSize || 0;
+}
+return {requests: entries.length, transfer_bytes: bytes};
+"""
+
+# Measurements of unblocked page loads: (campaign_id, url) -> page metrics
+_baselines = {}
+
+
+def _is_string_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def valid_resource_settings(value) -> bool:
+    """
+    Checks the 'resources' campaign setting, e.g.
+    {'block': ['image', 'font'], 'allow': ['*://cdn.shop.com/checkout/*']}.
+    """
+    if value is False:
+        return True
+    if not isinstance(value, dict) or set(value) - set(RESOURCE_KEYS):
+        return False
+    block = value.get('block', list(DEFAULT_BLOCKED))
+    if not _is_string_list(block) or set(block) - set(RESOURCE_TYPES):
+        return False
+    if not _is_string_list(value.get('allow', [])) or not _is_string_list(value.get('urls', [])):
+        return False
+    return isinstance(value.get('baseline', False), bool)
+
+
+def _url_patterns(host: str = '*', path: str = '*') -> List[str]:
+    """
+    Returns URLPattern strings (Network.setBlockedURLs 'urlPatterns') matching
+    the host and its subdomains, with and without a query string.
+    """
+    hosts = [host] if host == '*' else [host, f'*.{host}']
+    return [
+        pattern
+        for name in hosts
+        for pattern in (f'*://{name}:*/{path}', f'*://{name}:*/{path}?*')
+    ]
+
+
+def _wildcard_patterns(host: str = '*', path: str = '*') -> List[str]:
+    """
+    Returns wildcard patterns (Network.setBlockedURLs 'urls') matching the
+    host and its subdomains, with and without a query string.
+    """
+    if host == '*':
+        return [f'*{path[1:]}', f'*{path[1:]}?*']
+    return [f'*://{host}/*', f'*://*.{host}/*']
+
+
+class ResourcePolicy:
+    """
+    Blocks heavy resources of page loads through CDP Network.setBlockedURLs.
+
+    Tracking domains and the 'allow' patterns of the campaign are never
+    blocked. With the 'baseline' option (off by default) the first load of
+    every URL of a campaign in a process is not blocked, later loads report
+    the bytes and time saved against it.
+
+    Args:
+        settings: The 'resources' campaign setting, False to block nothing.
+        tracking_domains: Domains whose traffic is never blocked.
+    """
+
+    def __init__(self, settings=None, tracking_domains: List[str] = None):
+        self.enabled = settings is not False
+        settings = settings or {}
+        self.block = list(settings.get('block', DEFAULT_BLOCKED))
+        self.allow = list(settings.get('allow', []))
+        self.urls = list(settings.get('urls', []))
+        self.baseline = settings.get('baseline', False)
+        self.tracking_domains = list(tracking_domains or DEFAULT_TRACKING_DOMAINS)
+        self.blocking = False
+
+    def _blocked(self, render, resource_types: List[str]) -> List[str]:
+        patterns = []
+        for resource_type in resource_types:
+            if resource_type == 'widget':
+                for host in WIDGET_HOSTS:
+                    patterns.extend(render(host))
+                continue
+            for extension in RESOURCE_EXTENSIONS[resource_type]:
+                patterns.extend(render(path=f'*.{extension}'))
+        return patterns
+
+    def rules(self) -> List[Tuple[str, bool]]:
+        """
+        Returns (URLPattern, block) rules, the first matching rule wins.
+        """
+        rules = []
+        for domain in self.tracking_domains:
+            rules.extend((pattern, False) for pattern in _url_patterns(domain))
+        rules.extend((pattern, False) for pattern in self.allow)
+        rules.extend((pattern, True) for pattern in self._blocked(_url_patterns, self.block))
+        rules.extend((pattern, True) for pattern in self.urls)
+        return rules
+
+    def wildcard_urls(self) -> List[str]:
+        """
+        Returns blocked wildcard patterns for Chrome versions without allow
+        rules. Images are left out, so tracking pixels still load.
+        """
+        resource_types = [t for t in self.block if t != 'image']
+        return self._blocked(_wildcard_patterns, resource_types) + self.urls
+
+    def apply(self, driver, blocking: bool = True) -> bool:
+        """
+        Sets the blocked URLs of the current browser target.
+
+        Chrome versions without allow rules ('urlPatterns') in
+        Network.setBlockedURLs get wildcard patterns without images.
+
+        Returns:
+            bool: Whether resources are blocked.
+        """
+        self.blocking = False
+        if not self.enabled:
+            return False
+        try:
+            driver.execute_cdp_cmd('Network.enable', {})
+            if not blocking:
+                driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': []})
+                return False
+            try:
+                driver.execute_cdp_cmd('Network.setBlockedURLs', {'urlPatterns': [
+                    {'urlPattern': pattern, 'block': block}
+                    for pattern, block in self.rules()]})
+            except WebDriverException:
+                driver.execute_cdp_cmd(
+                    'Network.setBlockedURLs', {'urls': self.wildcard_urls()})
+        except (AttributeError, WebDriverException) as er:
+            logging.warning(f'Resource blocking is not available ({er})')
+            return False
+        self.blocking = True
+        return True
+
+    def clear(self, driver) -> None:
+        """
+        Unblocks all URLs, e.g. before the browser is used by another campaign.
+        """
+        if not self.blocking:
+            return
+        try:
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': []})
+        except WebDriverException:
+            pass
+        self.blocking = False
+
+    def needs_baseline(self, campaign_id, urls: List[str]) -> bool:
+        """
+        Checks whether any of the URLs has no unblocked measurement yet.
+        """
+        return self.enabled and self.baseline and any(
+            (campaign_id, url) not in _baselines for url in urls)
+
+
+def page_metrics(driver) -> Dict:
+    """
+    Returns the requests and transferred bytes of the current page.
+    """
+    try:
+        return driver.execute_script(PAGE_METRICS_SCRIPT) or {}
+    except WebDriverException:
+        return {}
+
+
+class ResourceReport:
+    """
+    Page load metrics of a journey for its result: per 'goto' step the
+    duration, requests and transferred bytes, and the savings against the
+    unblocked baseline of the same URL. Savings are only known with the
+    'baseline' option, without a baseline the totals are left out rather
+    than reported as 0.
+    """
+
+    def __init__(self, campaign_id, blocking: bool):
+        self.campaign_id = campaign_id
+        self.blocking = blocking
+        self.pages = []
+
+    def add(self, driver, step_number: int, url: str, duration: float) -> Dict:
+        page = dict(page_metrics(driver), step=step_number, url=url,
+                    duration=round(duration, 4))
+        key = (self.campaign_id, url)
+        if not self.blocking:
+            _baselines.setdefault(key, page)
+        elif key in _baselines:
+            baseline = _baselines[key]
+            page['bytes_saved'] = (
+                baseline.get('transfer_bytes', 0) - page.get('transfer_bytes', 0))
+            page['requests_saved'] = baseline.get('requests', 0) - page.get('requests', 0)
+            page['load_time_saved'] = round(baseline['duration'] - page['duration'], 4)
+        self.pages.append(page)
+        return page
+
+    def summary(self) -> Dict:
+        summary = {'blocking': self.blocking, 'pages': self.pages}
+        measured = [page for page in self.pages if 'bytes_saved' in page]
+        if measured:
+            summary['bytes_saved'] = sum(page['bytes_saved'] for page in measured)
+            summary['load_time_saved'] = round(
+                sum(page['load_time_saved'] for page in measured), 4)
+        return summary
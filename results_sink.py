@@ -0,0 +1,159 @@
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List
+
+REPORTS_DIR = 'reports'
+
+
+def new_run_id() -> str:
+    """
+    Returns a run id unique even for runs started within the same second.
+    """
+    return f"{datetime.now().strftime('%d%m%Y-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def write_json_atomic(path: str, data, indent: int = None) -> None:
+    """
+    Writes JSON to a temporary file and moves it over the target, so readers
+    never see a half-written file.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_jsonl(path: str) -> List[Dict]:
+    """
+    Reads a JSON Lines file, skipping a torn last line left by a crash.
+    """
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+class ResultSink:
+    """
+    Streams journey results of a campaign run to
+    reports/<campaign_id>/<run_id>.jsonl, one JSON record per line, flushed to
+    disk after every journey. A small run manifest
+    reports/<campaign_id>/<run_id>.manifest.json is kept next to it; it is
+    rewritten with fixed-size counters as journeys end, the timings of all
+    journeys are only added when the run is closed.
+    """
+
+    def __init__(self, campaign_id, run_id: str = None, reports_dir: str = REPORTS_DIR):
+        self.campaign_id = campaign_id
+        self.run_id = run_id or new_run_id()
+        self.folder_name = os.path.join(reports_dir, str(campaign_id))
+        os.makedirs(self.folder_name, exist_ok=True)
+        self.path = os.path.join(self.folder_name, f'{self.run_id}.jsonl')
+        self.manifest_path = os.path.join(self.folder_name, f'{self.run_id}.manifest.json')
+        self.manifest = {
+            'run_id': self.run_id,
+            'campaign_id': campaign_id,
+            'status': 'running',
+            'started': time.time(),
+            'finished': None,
+            'journeys': 0,
+            'failed': 0,
+            'results_file': os.path.basename(self.path),
+        }
+        self.timings = []
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        write_json_atomic(self.manifest_path, self.manifest, indent=4)
+
+    def append(self, result: Dict) -> None:
+        """
+        Appends one journey result and flushes it to disk.
+        """
+        self._file.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.manifest['journeys'] += 1
+        self.timings.append({
+            'test_name': result.get('test_name'),
+            'duration': (result.get('profile') or {}).get('duration'),
+        })
+        self._write_manifest()
+
+    def failed(self, test_name: str, error: str) -> None:
+        """
+        Records a journey which produced no result.
+        """
+        self.manifest['failed'] += 1
+        self.manifest.setdefault('errors', []).append(
+            {'test_name': test_name, 'error': error})
+        self._write_manifest()
+
+    def update_manifest(self, **fields) -> None:
+        """
+        Adds run-level fields (e.g. resource usage) to the manifest.
+        """
+        self.manifest.update(fields)
+        self._write_manifest()
+
+    def close(self, status: str = 'completed') -> None:
+        if self._file.closed:
+            return
+        self._file.close()
+        self.manifest['status'] = status
+        self.manifest['timings'] = self.timings
+        self.manifest['finished'] = time.time()
+        self.manifest['duration'] = round(
+            self.manifest['finished'] - self.manifest['started'], 2)
+        self._write_manifest()
+
+    def compact(self, file_name: str, results: List[Dict] = None) -> str:
+        """
+        Writes the legacy pretty JSON list of results,
+        reports/<campaign_id>/<file_name>.json. An existing file of another
+        run is not overwritten, the run id is appended to the name instead.
+
+        Args:
+            file_name: Legacy file name without extension (ddmmYYYY-HHMM).
+            results: Results in the order to write, defaults to the JSONL file.
+
+        Returns:
+            str: Path of the written file.
+        """
+        if results is None:
+            results = read_jsonl(self.path)
+        path = os.path.join(self.folder_name, f'{file_name}.json')
+        if os.path.exists(path) and self.manifest.get('legacy_file') != os.path.basename(path):
+            path = os.path.join(self.folder_name, f'{file_name}-{self.run_id}.json')
+        write_json_atomic(path, results, indent=4)
+        self.update_manifest(legacy_file=os.path.basename(path))
+        return path
+
+
+def compact_file(jsonl_path: str) -> str:
+    """
+    Converts a JSON Lines result file (e.g. of a crashed run) to pretty JSON
+    next to it.
+    """
+    json_path = f'{os.path.splitext(jsonl_path)[0]}.json'
+    write_json_atomic(json_path, read_jsonl(jsonl_path), indent=4)
+    return json_path
+
+
+if __name__ == '__main__':
+    for jsonl in sys.argv[1:]:
+        print(compact_file(jsonl))
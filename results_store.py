@@ -0,0 +1,386 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from results_sink import REPORTS_DIR, read_jsonl
+
+RESULTS_DB = os.path.join(REPORTS_DIR, 'results.sqlite')
+# Format of the 'datetime' field of journey results
+RESULT_DATETIME_FORMAT = '%d.%m.%Y-%H:%M:%S'
+# Query parameters which differ on every run, ignored by diffs
+VOLATILE_PARAMS = ('subid',)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journeys (
+    id INTEGER PRIMARY KEY,
+    campaign_id TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    test_name TEXT,
+    subid TEXT,
+    started REAL,
+    initial_link TEXT,
+    final_url TEXT,
+    engine TEXT,
+    order_number TEXT,
+    duration REAL,
+    source TEXT,
+    result TEXT,
+    UNIQUE (campaign_id, test_name, subid)
+);
+CREATE INDEX IF NOT EXISTS journeys_run ON journeys (run_id, campaign_id);
+CREATE INDEX IF NOT EXISTS journeys_test ON journeys (campaign_id, test_name, started);
+CREATE INDEX IF NOT EXISTS journeys_subid ON journeys (subid);
+CREATE TABLE IF NOT EXISTS cookies (
+    journey_id INTEGER NOT NULL REFERENCES journeys (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS cookies_name ON cookies (name, journey_id);
+CREATE TABLE IF NOT EXISTS query_params (
+    journey_id INTEGER NOT NULL REFERENCES journeys (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS query_params_name ON query_params (name, journey_id);
+CREATE TABLE IF NOT EXISTS tracking_requests (
+    journey_id INTEGER NOT NULL REFERENCES journeys (id) ON DELETE CASCADE,
+    step INTEGER,
+    domain TEXT,
+    url TEXT,
+    method TEXT,
+    status_code INTEGER,
+    size INTEGER,
+    time REAL
+);
+CREATE INDEX IF NOT EXISTS tracking_requests_domain ON tracking_requests (domain, journey_id);
+"""
+
+
+def _started(result: Dict) -> float:
+    try:
+        return datetime.strptime(result.get('datetime', ''), RESULT_DATETIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+
+def _query_params(result: Dict) -> Iterable[Tuple[str, str]]:
+    params = result.get('query_params')
+    if not isinstance(params, dict):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(result.get('final_url', '')).query)
+    for name, values in params.items():
+        for value in (values if isinstance(values, list) else [values]):
+            yield name, str(value)
+
+
+def parse_since(value: str) -> float:
+    """
+    Parses '7d', '12h' or '30m' into the epoch time that long ago.
+    """
+    units = {'d': 86400, 'h': 3600, 'm': 60}
+    try:
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise argparse.ArgumentTypeError(f'expected e.g. 7d, 12h or 30m, got {value!r}')
+
+
+class ResultsStore:
+    """
+    Journey results of all runs in one indexed SQLite file, keyed by
+    campaign, test case, run and SUBID, with cookies, final URL query
+    parameters and captured tracking requests in their own tables.
+    """
+
+    def __init__(self, path: str = RESULTS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA foreign_keys=ON')
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def ingest(self, campaign_id, run_id: str, results: List[Dict], source: str = None) -> int:
+        """
+        Adds the journey results of a run. A journey already stored (same
+        campaign, test case and SUBID) is skipped, so files may be ingested
+        again.
+
+        Returns:
+            int: Number of journeys added.
+        """
+        added = 0
+        with self.connect() as conn:
+            for result in results:
+                if not isinstance(result, dict):
+                    continue
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO journeys (campaign_id, run_id, test_name, subid, '
+                    'started, initial_link, final_url, engine, order_number, duration, '
+                    'source, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (str(campaign_id), run_id, result.get('test_name'),
+                     str(result.get('subid') or ''), _started(result),
+                     result.get('initial_link'), result.get('final_url'),
+                     result.get('engine', 'browser'), str(result.get('Order_number') or ''),
+                     (result.get('profile') or {}).get('duration'), source,
+                     json.dumps(result, ensure_ascii=False, default=str)))
+                if not cursor.rowcount:
+                    continue
+                journey_id = cursor.lastrowid
+                added += 1
+                conn.executemany(
+                    'INSERT INTO cookies (journey_id, name, value) VALUES (?, ?, ?)',
+                    [(journey_id, name, str(value))
+                     for name, value in (result.get('cookies') or {}).items()])
+                conn.executemany(
+                    'INSERT INTO query_params (journey_id, name, value) VALUES (?, ?, ?)',
+                    [(journey_id, name, value) for name, value in _query_params(result)])
+                requests = result.get('Request_Response')
+                conn.executemany(
+                    'INSERT INTO tracking_requests (journey_id, step, domain, url, method, '
+                    'status_code, size, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(journey_id, entry.get('step'), entry.get('domain'), entry.get('url'),
+                      entry.get('method'), entry.get('status_code'), entry.get('size'),
+                      entry.get('time'))
+                     for entry in (requests if isinstance(requests, list) else [])
+                     if isinstance(entry, dict)])
+        return added
+
+    def ingest_file(self, path: str, campaign_id=None) -> int:
+        """
+        Ingests a results file, reports/<campaign_id>/<run_id>.jsonl or a
+        legacy pretty JSON list. The run id is the file name.
+        """
+        campaign_id = campaign_id or os.path.basename(os.path.dirname(os.path.abspath(path)))
+        run_id = os.path.splitext(os.path.basename(path))[0]
+        if path.endswith('.jsonl'):
+            results = read_jsonl(path)
+        else:
+            with open(path, 'r') as f:
+                results = json.load(f)
+            if not isinstance(results, list):
+                return 0
+        return self.ingest(campaign_id, run_id, results, path)
+
+    def backfill(self, reports_dir: str = REPORTS_DIR) -> Dict[str, int]:
+        """
+        Ingests every results file under reports/<campaign_id>/. JSONL
+        streams go first, the legacy JSON of the same run then adds nothing.
+
+        Returns:
+            dict: Journeys added per file, files which added nothing left out.
+        """
+        paths = sorted(glob.glob(os.path.join(reports_dir, '*', '*.jsonl')))
+        paths += sorted(
+            path for path in glob.glob(os.path.join(reports_dir, '*', '*.json'))
+            if not path.endswith('.manifest.json'))
+        added = {}
+        for path in paths:
+            try:
+                count = self.ingest_file(path)
+            except (OSError, ValueError) as er:
+                logging.warning(f'Not ingested {path}: {er}')
+                continue
+            if count:
+                added[path] = count
+        return added
+
+    def runs(self, campaign_id=None, limit: int = 20) -> List[sqlite3.Row]:
+        query = ('SELECT campaign_id, run_id, COUNT(*) AS journeys, MIN(started) AS started '
+                 'FROM journeys')
+        params = []
+        if campaign_id is not None:
+            query += ' WHERE campaign_id = ?'
+            params.append(str(campaign_id))
+        query += ' GROUP BY campaign_id, run_id ORDER BY started DESC LIMIT ?'
+        with self.connect() as conn:
+            return conn.execute(query, params + [limit]).fetchall()
+
+    def lost_cookie(self, cookie_name: str, since: float) -> List[sqlite3.Row]:
+        """
+        Returns the test cases whose latest journey lacks the cookie although
+        a journey since the given time had it.
+        """
+        query = """
+            WITH latest AS (
+                SELECT campaign_id, test_name, MAX(started) AS started
+                FROM journeys GROUP BY campaign_id, test_name
+            )
+            SELECT j.campaign_id, j.test_name, j.run_id AS latest_run,
+                   MAX(had.started) AS last_seen
+            FROM latest
+            JOIN journeys j ON j.campaign_id = latest.campaign_id
+                AND j.test_name = latest.test_name AND j.started = latest.started
+            JOIN journeys had ON had.campaign_id = j.campaign_id
+                AND had.test_name = j.test_name AND had.started >= ? AND had.id != j.id
+            JOIN cookies c ON c.journey_id = had.id AND c.name = ?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM cookies lc WHERE lc.journey_id = j.id AND lc.name = ?)
+            GROUP BY j.campaign_id, j.test_name
+            ORDER BY j.campaign_id, j.test_name
+        """
+        with self.connect() as conn:
+            return conn.execute(query, (since, cookie_name, cookie_name)).fetchall()
+
+    def history(self, campaign_id, test_name: str = None,
+                param: str = None, limit: int = 20) -> List[sqlite3.Row]:
+        """
+        Returns the journeys of a campaign, latest first, with a query
+        parameter of their final URL.
+        """
+        query = ('SELECT j.run_id, j.test_name, j.started, j.final_url, '
+                 '(SELECT value FROM query_params q WHERE q.journey_id = j.id AND q.name = ?) '
+                 'AS param FROM journeys j WHERE j.campaign_id = ?')
+        params = [param, str(campaign_id)]
+        if test_name is not None:
+            query += ' AND j.test_name = ?'
+            params.append(test_name)
+        query += ' ORDER BY j.started DESC LIMIT ?'
+        with self.connect() as conn:
+            return conn.execute(query, params + [limit]).fetchall()
+
+    def _run_journeys(self, conn, run: str, campaign_id=None) -> Dict[Tuple[str, str], Dict]:
+        # The latest journey per test case of the runs whose id starts with `run`
+        query = 'SELECT * FROM journeys WHERE run_id LIKE ?'
+        params = [run.replace('%', '') + '%']
+        if campaign_id is not None:
+            query += ' AND campaign_id = ?'
+            params.append(str(campaign_id))
+        journeys = {}
+        for row in conn.execute(query + ' ORDER BY started', params):
+            journey = {
+                'run_id': row['run_id'],
+                'final_url': row['final_url'] or '',
+                'cookies': {r['name'] for r in conn.execute(
+                    'SELECT name FROM cookies WHERE journey_id = ?', (row['id'],))},
+                'params': {r['name']: r['value'] for r in conn.execute(
+                    'SELECT name, value FROM query_params WHERE journey_id = ?', (row['id'],))
+                    if r['name'] not in VOLATILE_PARAMS},
+                'domains': {r['domain'] for r in conn.execute(
+                    'SELECT DISTINCT domain FROM tracking_requests WHERE journey_id = ?',
+                    (row['id'],))},
+            }
+            journeys[(row['campaign_id'], row['test_name'])] = journey
+        return journeys
+
+    def diff(self, run_a: str, run_b: str, campaign_id=None) -> List[Dict]:
+        """
+        Compares the test cases of two runs: presence, final URL (without
+        query), query parameters, cookie names and tracking domains. A run
+        is given by its id or a prefix of it, e.g. a date.
+
+        Returns:
+            list: A change per test case which differs.
+        """
+        with self.connect() as conn:
+            before = self._run_journeys(conn, run_a, campaign_id)
+            after = self._run_journeys(conn, run_b, campaign_id)
+        changes = []
+        for key in sorted(set(before) | set(after), key=str):
+            a, b = before.get(key), after.get(key)
+            change = {'campaign_id': key[0], 'test_name': key[1]}
+            if a is None or b is None:
+                change['only_in'] = run_a if b is None else run_b
+                changes.append(change)
+                continue
+            url_a, url_b = (url.split('?')[0] for url in (a['final_url'], b['final_url']))
+            if url_a != url_b:
+                change['final_url'] = [url_a, url_b]
+            params = {
+                name: [a['params'].get(name), b['params'].get(name)]
+                for name in set(a['params']) | set(b['params'])
+                if a['params'].get(name) != b['params'].get(name)
+            }
+            if params:
+                change['query_params'] = params
+            for field in ('cookies', 'domains'):
+                if a[field] != b[field]:
+                    change[field] = {'lost': sorted(a[field] - b[field]),
+                                     'gained': sorted(b[field] - a[field])}
+            if len(change) > 2:
+                changes.append(change)
+        return changes
+
+    def query(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        with self.connect() as conn:
+            return conn.execute(sql, params).fetchall()
+
+
+def ingest_run(campaign_id, run_id: str, results: List[Dict], source: str = None,
+               path: str = RESULTS_DB) -> None:
+    """
+    Adds the results of a finished campaign run to the store. A store
+    which cannot be written is logged, the results files stay the record.
+    """
+    try:
+        added = ResultsStore(path).ingest(campaign_id, run_id, results, source)
+    except sqlite3.Error as er:
+        logging.warning(f'Results of run {run_id} not stored in {path}: {er}')
+        return
+    logging.info(f'{added} journeys of run {run_id} stored in {path}')
+
+
+def _print_rows(rows: List[sqlite3.Row]) -> None:
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in tuple(row)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Indexed store of journey results')
+    parser.add_argument('--db', default=RESULTS_DB, help='SQLite file of the store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill = commands.add_parser('backfill', help='ingest all reports')
+    backfill.add_argument('--reports', default=REPORTS_DIR)
+    ingest = commands.add_parser('ingest', help='ingest results files')
+    ingest.add_argument('files', nargs='+')
+    runs = commands.add_parser('runs', help='list runs, latest first')
+    runs.add_argument('--campaign')
+    lost = commands.add_parser('lost-cookie', help='test cases which lost a cookie')
+    lost.add_argument('cookie')
+    lost.add_argument('--since', type=parse_since, default='7d', help='e.g. 7d, 12h')
+    history = commands.add_parser('history', help='journeys of a campaign, latest first')
+    history.add_argument('campaign')
+    history.add_argument('--test')
+    history.add_argument('--param', default='admitad_uid', help='final URL query parameter')
+    diff = commands.add_parser('diff', help='compare two runs (run id or prefix)')
+    diff.add_argument('run_a')
+    diff.add_argument('run_b')
+    diff.add_argument('--campaign')
+    sql = commands.add_parser('sql', help='run a read query')
+    sql.add_argument('query')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == 'backfill':
+        added = store.backfill(args.reports)
+        print(f'{sum(added.values())} journeys from {len(added)} files')
+    elif args.command == 'ingest':
+        for path in args.files:
+            print(f'{path}: {store.ingest_file(path)}')
+    elif args.command == 'runs':
+        _print_rows(store.runs(args.campaign))
+    elif args.command == 'lost-cookie':
+        _print_rows(store.lost_cookie(args.cookie, args.since))
+    elif args.command == 'history':
+        _print_rows(store.history(args.campaign, args.test, args.param))
+    elif args.command == 'diff':
+        for change in store.diff(args.run_a, args.run_b, args.campaign):
+            print(json.dumps(change, ensure_ascii=False))
+    else:
+        _print_rows(store.query(args.query))
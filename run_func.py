@@ -1,46 +1,77 @@
 from typing import Dict
 
-import os
+import copy
 import time
 import urllib.parse
 from datetime import datetime
-from time import sleep
 
-import blinker
-from selenium import webdriver
-# from selenium.common.exceptions import NoSuchElementException, TimeoutException
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import Select
 from seleniumwire import webdriver
 
 import logging
 
-
-def css_selector_or_xpath(driver, param):
+from batching import PageReads, fused_click, fused_type, uses_keystrokes
+from budgets import JourneyBudget
+from capture import TrackingCapture, log_captured
+from compiler import CompiledJourney, CompiledStep, compile_journey, register_action
+from isolation import record_frame_origins
+from locators import locator_cache
+from memory import memory_governor
+from logging_setup import log_payload
+from profiling import StepProfiler
+from replay import replay_session
+from resources import ResourcePolicy, ResourceReport
+from screenshots import (
+    DEFAULT_FORMAT,
+    DEFAULT_QUALITY,
+    capture_screenshot,
+    collect_screenshots,
+    screenshot_writer,
+)
+from snapshots import restore_latest, snapshot_store, take_snapshot
+from waits import (
+    ADAPTIVE_PACING,
+    CLICK_ACTIONS,
+    DEFAULT_TIMEOUT,
+    DOCUMENT_READY,
+    ELEMENT_CONDITIONS,
+    HUMAN_PACING,
+    NETWORK_IDLE,
+    PAGE_CONDITIONS,
+    URL_CHANGES,
+    human_pause,
+    pause,
+    resolve_wait,
+    wait_for_condition,
+)
+
+
+def css_selector_or_xpath(driver, param, campaign_id=None):
     """
-    Attempts to find an element using either CSS Selector or XPath.
+    Returns the locator type (CSS Selector or XPath) of a selector.
 
-    This function prioritizes CSS Selector for efficiency.
+    The type is taken from the locator cache, which is filled from the selector
+    syntax when the campaign is loaded. Selectors valid for both types are
+    probed in the page once and the result is cached between runs.
 
     Args:
         driver: The Selenium WebDriver instance.
         param: The CSS selector or XPath expression to locate the element.
+        campaign_id: The campaign the selector belongs to.
 
     Returns:
-        By: The type of locator (CSS Selector or XPath) used to find the element.
+        By: The type of locator (CSS Selector or XPath) of the selector.
     """
-    try:
-        driver.find_element(By.CSS_SELECTOR, param).click()
-        logging.info(f'CSS_SELECTOR found')
-        return By.CSS_SELECTOR
-    except:
-        driver.find_element(By.XPATH, param).click()
-        logging.info(f'XPATH found')
-        return By.XPATH
+    return locator_cache.resolve(driver, campaign_id, param)
 
 
-def click_element(driver, step):
+def click_element(driver, step, campaign_id=None):
     """
     Clicks on an element on the web page using either CSS Selector or XPath.
 
@@ -48,20 +79,17 @@ def click_element(driver, step):
         driver: The Selenium WebDriver instance.
         step: A dictionary containing the step information,
               including the 'selector' for the element.
+        campaign_id: The campaign the selector belongs to.
 
     Raises:
-        NoSuchElementException: If the element cannot be found using
-                                either CSS Selector or XPath.
+        NoSuchElementException: If the element cannot be found.
         """
-    try:
-        driver.find_element(By.CSS_SELECTOR, step['selector']).click()
-        logging.info(f'CSS_SELECTOR')
-    except:
-        driver.find_element(By.XPATH, step['selector']).click()
-        logging.info(f'XPATH')
+    by = css_selector_or_xpath(driver, step['selector'], campaign_id)
+    driver.find_element(by, step['selector']).click()
+    logging.info(f'{by} clicked')
 
 
-def text_input_click_and_clear(driver, by, step):
+def text_input_click_and_clear(driver, by, step, pacing=ADAPTIVE_PACING):
     """
     Clicks, clears, and enters text into a form field.
 
@@ -69,14 +97,18 @@ def text_input_click_and_clear(driver, by, step):
         driver: The WebDriver instance.
         by: The method to locate the element (By.CSS_SELECTOR or By.XPATH).
         step: A dictionary containing step information, including the selector.
+        pacing: Pacing mode, short pauses between key actions are kept for 'human'.
     """
     text_input = driver.find_element(by, step['selector'])
     text_input.click()
     text_input.clear()
-    sleep(0.1)
-    webdriver.ActionChains(driver).send_keys_to_element(
-        text_input, step['text']
-    ).pause(0.2).perform()
+    chain = webdriver.ActionChains(driver)
+    if pacing == HUMAN_PACING:
+        pause(0.1)
+        chain.send_keys_to_element(text_input, step['text']).pause(0.2)
+    else:
+        chain.send_keys_to_element(text_input, step['text'])
+    chain.perform()
     # The below code is to input letter-by-letter
     # for character in step['text']:
     #     webdriver.ActionChains(driver).send_keys(text_input, character).pause(0.1).perform()
@@ -96,27 +128,66 @@ def add_subid_to_url(url, data):
     return urllib.parse.urlunparse(parsed_url._replace(query=new_query_string))
 
 
-def save_specific_cookies(driver, data: Dict) -> None:
+# Tracking cookies saved in the journey result
+REQUIRED_COOKIES = [
+    'admitad_uid',
+    'admitad_aid',
+    'tagtag_aid',
+    'deduplication_cookie',
+    '_source',
+    'deduplication_source',
+    '_aid',
+]
+# Parameters of the first redirect URL saved in the journey result
+REDIRECT_URL_PARAMETERS = [
+    'utm_source',
+    'admitad_uid',
+    'admitad_aid',
+    'tagtag_aid',
+    'tagtag_uid',
+    'source',
+]
+
+# Result fields never taken over from the snapshot of another journey
+SNAPSHOT_OWN_KEYS = (
+    'datetime', 'test_name', 'snapshot', 'subid', 'Cart', 'Thank_you_page', 'Order_number')
+
+# Steps whose element may not be there, e.g. a popup which did not show up;
+# they never count as failed for the circuit of their host
+OPTIONAL_ACTIONS = ['close_popup_window']
+
+
+def save_specific_cookies(driver, data: Dict, cookies: list = None) -> None:
     """
     Saves specified cookies in the data dictionary.
 
     Args:
         driver: WebDriver instance.
         data: Dictionary to store cookies.
+        cookies: Cookies of the page if already read, else they are read
+                 with a single get_cookies() call.
     """
-    list_of_required_cookies = [
-        'admitad_uid',
-        'admitad_aid',
-        'tagtag_aid',
-        'deduplication_cookie',
-        '_source',
-        'deduplication_source',
-        '_aid',
-    ]
-    for cookie_name in list_of_required_cookies:
-        cookie_value = driver.get_cookie(cookie_name)
-        if cookie_value:
-            data['cookies'][cookie_name] = cookie_value['value']
+    if cookies is None:
+        cookies = driver.get_cookies()
+    values = {}
+    for cookie in cookies:
+        values.setdefault(cookie['name'], cookie['value'])
+    for cookie_name in REQUIRED_COOKIES:
+        if cookie_name in values:
+            data['cookies'][cookie_name] = values[cookie_name]
+
+
+def parse_redirect_url(url: str, data: Dict) -> None:
+    """
+    Saves the redirect URL and its parameters in the data dictionary.
+    """
+    data['final_url'] = url
+    # Parse parameters from final_url
+    parsed_url = urllib.parse.urlparse(data['final_url'])
+    data['query_params'] = urllib.parse.parse_qs(parsed_url.query)
+    for param in REDIRECT_URL_PARAMETERS:
+        if param in data['query_params']:
+            data[param] = data['query_params'][param][0]
 
 
 def save_first_redirect_url(driver, data: Dict) -> None:
@@ -127,21 +198,7 @@ def save_first_redirect_url(driver, data: Dict) -> None:
         driver: WebDriver instance.
         data: Dictionary to store extracted parameters.
     """
-    url_parameters_to_extract = [
-        'utm_source',
-        'admitad_uid',
-        'admitad_aid',
-        'tagtag_aid',
-        'tagtag_uid',
-        'source',
-    ]
-    data['final_url'] = driver.current_url
-    # Parse parameters from final_url
-    parsed_url = urllib.parse.urlparse(data['final_url'])
-    data['query_params'] = urllib.parse.parse_qs(parsed_url.query)
-    for param in url_parameters_to_extract:
-        if param in data['query_params']:
-            data[param] = data['query_params'][param][0]
+    parse_redirect_url(driver.current_url, data)
 
 
 def extract_order_id_from_url(url, search_list=None):
@@ -177,11 +234,335 @@ def extract_order_id_from_url(url, search_list=None):
         return None
 
 
+def new_journey_data(title: str, initial_url: str) -> Dict:
+    """
+    Returns the test results template of a journey, data to collect.
+    """
+    return {
+        'datetime': str(datetime.now().strftime('%d.%m.%Y-%H:%M:%S')),
+        'test_name': title,
+        'initial_link': initial_url,
+        'final_url': '',
+        'query_params': '',
+        'cookies': {},
+        'subid': '',
+        'Cart': '',
+        'Thank_you_page': '',
+        'Order_number': '',
+        'Request_Response': '',
+    }
+
+
+class JourneyContext:
+    """
+    State of a running user journey, shared by the step handlers.
+    """
+
+    def __init__(self, driver, campaign_id, data: Dict, settings: Dict,
+                 capture: TrackingCapture, search_list: list = None):
+        self.driver = driver
+        self.campaign_id = campaign_id
+        self.data = data
+        self.settings = settings
+        self.capture = capture
+        self.search_list = search_list
+        self.budget = JourneyBudget(campaign_id, settings.get('budgets'))
+        self.first_redirect = True
+        # Pending screenshot writes, see screenshots.py
+        self.screenshots = []
+        self.driver_cookie = []
+        # Set for every step by the runner
+        self.step_number = 0
+        self.by = None
+        self.pacing = ADAPTIVE_PACING
+        # Real WebDriver clicks and keystrokes instead of fused in-page scripts
+        self.keystrokes = False
+        self.condition = None
+        self.timeout = None
+        self.previous_url = None
+        # Why the current step failed, e.g. its page did not load in time
+        self.failure_reason = None
+
+    def fail_step(self, reason: str) -> None:
+        """
+        Records why the current step failed, for the circuit of its host.
+        The first reason of a step is kept.
+        """
+        if self.failure_reason is None:
+            self.failure_reason = reason
+
+
+def stop_loading(ctx: JourneyContext, er: TimeoutException) -> None:
+    """
+    Stops a page load which ran over the page-load timeout, the step goes
+    on with the partly loaded page.
+    """
+    ctx.fail_step(f'page load over {ctx.budget.page_load} secs')
+    logging.warning(f'Page load timed out ({er}), stopping it')
+    try:
+        ctx.driver.execute_script('window.stop()')
+    except WebDriverException:
+        pass
+
+
+def wait_for_step(ctx: JourneyContext, condition: str, step: Dict,
+                  previous_url: str = None, by=None) -> bool:
+    """
+    Waits for a condition of the current step. A condition not met in time
+    fails the step, except for popups which may not show up at all and
+    network idle, which pages polling analytics may never reach.
+    """
+    met = wait_for_condition(ctx.driver, condition, step, ctx.timeout, previous_url, by)
+    if met or step.get('action') in OPTIONAL_ACTIONS:
+        return met
+    if condition == NETWORK_IDLE:
+        logging.warning(f'Network not idle within {ctx.timeout:.0f} secs, going on')
+    else:
+        ctx.fail_step(f'{condition} not met within {ctx.timeout:.0f} secs')
+    return met
+
+
+# Opening required URL
+@register_action('goto', required=('url',), manages_wait=True)
+def goto(ctx: JourneyContext, step: Dict) -> None:
+    driver, data = ctx.driver, ctx.data
+    logging.info(f"Open URL: {step['url']}")
+    try:
+        driver.get(step['url'])
+    except TimeoutException as er:
+        stop_loading(ctx, er)
+    wait_for_step(ctx, ctx.condition, step, ctx.previous_url)
+    human_pause('goto', ctx.pacing)
+    # One command for all cookies, one for the URL
+    reads = PageReads(driver)
+    ctx.driver_cookie = reads.cookies()
+    # Collect and save only first redirect in the user's journey within one testcase
+    if ctx.first_redirect:
+        parse_redirect_url(reads.url(), data)
+        save_specific_cookies(driver, data, ctx.driver_cookie)
+        ctx.first_redirect = False
+    logging.info(f"Redirect URL: {data['final_url']}")
+    logging.info(f"Link parameters: {data['query_params']}")
+    log_payload('All cookies', ctx.driver_cookie)
+    logging.info(f"Admitad cookies: {data['cookies']}")
+
+
+# Set additional time for page to load
+@register_action('wait', optional=('value',), manages_wait=True)
+def wait(ctx: JourneyContext, step: Dict) -> None:
+    logging.info('Awaiting some event')
+    started = time.time()
+    if ctx.pacing == HUMAN_PACING:
+        pause(float(step.get('value') or ctx.timeout))
+    else:
+        wait_for_step(ctx, ctx.condition, step)
+    logging.info(f'Waited for {time.time() - started:.1f} secs')
+    logging.info(f'Current page URL: {ctx.driver.current_url}')
+
+
+def _press_key(key, name: str, purpose: str = ''):
+    """
+    Builds a handler pressing a keyboard key.
+    """
+    def handler(ctx: JourneyContext, step: Dict) -> None:
+        logging.info(f'Attempting {name}{purpose}')
+        webdriver.ActionChains(ctx.driver).send_keys(key).perform()
+        logging.info(f'Success {name}{purpose}')
+    return handler
+
+
+register_action('tab_key')(_press_key(Keys.TAB, 'TAB', ' to jump'))
+register_action('enter_key')(_press_key(Keys.ENTER, 'ENTER', ' to confirm action'))
+register_action('arrow_down')(_press_key(Keys.ARROW_DOWN, 'ARROW DOWN'))
+register_action('arrow_up')(_press_key(Keys.ARROW_UP, 'ARROW UP'))
+
+
+@register_action('scroll')
+def scroll(ctx: JourneyContext, step: Dict) -> None:
+    ctx.driver.execute_script('window.scrollBy(0, 250)')
+    logging.info('Scroll the page down')
+
+
+# Clicking required object, popups without selector are closed with ESCAPE
+def click_object(ctx: JourneyContext, step: Dict) -> None:
+    driver = ctx.driver
+    logging.info(f"Try to {step['action']}")
+    try:
+        if not step.get('selector'):
+            raise NoSuchElementException('No selector given')
+        if ctx.keystrokes:
+            driver.find_element(ctx.by, step['selector']).click()
+        elif not fused_click(driver, ctx.by, step['selector']):
+            raise NoSuchElementException(f"No element {step['selector']}")
+    except WebDriverException:
+        button = webdriver.ActionChains(driver).send_keys(Keys.ESCAPE)
+        button.perform()
+        logging.info('Object to click not found, attempted ESCAPE key')
+        if step['action'] not in OPTIONAL_ACTIONS:
+            ctx.fail_step(f"no element {step.get('selector')} to click, pressed ESCAPE")
+    log_payload('All cookies', ctx.driver_cookie)
+    logging.info(f"Admitad cookies: {ctx.data['cookies']}")
+
+
+register_action('close_popup_window', optional=('selector',))(click_object)
+for _action in CLICK_ACTIONS:
+    if _action != 'close_popup_window':
+        register_action(_action, required=('selector',))(click_object)
+
+
+# Typing in any fields
+@register_action('type_in_data', required=('selector', 'text'))
+def type_in_data(ctx: JourneyContext, step: Dict) -> None:
+    logging.info(f'Perform type-in, text element by {ctx.by}')
+    if ctx.keystrokes:
+        text_input_click_and_clear(ctx.driver, ctx.by, step, ctx.pacing)
+    elif fused_type(ctx.driver, ctx.by, step['selector'], step['text']):
+        logging.info(f"Text set: {step['text']}")
+    else:
+        raise NoSuchElementException(f"No element {step['selector']}")
+
+
+# Selecting option from drop-down menu
+@register_action('drop_down_menu', required=('selector', 'element'))
+def drop_down_menu(ctx: JourneyContext, step: Dict) -> None:
+    logging.info('Searching for selector')
+    element = ctx.driver.find_element(ctx.by, step['selector'])
+    Select(element).select_by_value(step['element'])
+    logging.info(f'{ctx.by} found')
+
+
+# Making required screenshots, captured through CDP and written in the background
+@register_action('make_screenshot')
+def make_screenshot(ctx: JourneyContext, step: Dict) -> None:
+    options = ctx.settings.get('screenshots') or {}
+    image_format = options.get('format', DEFAULT_FORMAT)
+    encoded = capture_screenshot(
+        ctx.driver, image_format, options.get('quality', DEFAULT_QUALITY))
+    path = screenshot_writer.path(
+        ctx.campaign_id, ctx.data['test_name'], ctx.data['subid'],
+        ctx.step_number, image_format)
+    ctx.screenshots.append(screenshot_writer.submit(
+        encoded, path, ctx.step_number, options.get('dedupe', True)))
+    logging.info(f'Screenshot queued: {path}')
+
+
+@register_action('capture_order_confirmation')
+def capture_order_confirmation(ctx: JourneyContext, step: Dict) -> None:
+    order_id = extract_order_id_from_url(ctx.driver.current_url, ctx.search_list)
+    if order_id:
+        ctx.data['Order_number'] = order_id
+        logging.info(f"Captured order ID from URL: {order_id}")
+
+
+def run_step(ctx: JourneyContext, step_number: int,
+             compiled_step: CompiledStep, step: Dict) -> None:
+    """
+    Runs one compiled step: waits for the element condition, calls the
+    handler of the action and lets the page settle afterwards.
+
+    Args:
+        ctx: The journey context.
+        step_number: Number of the step in the journey, starting with 1.
+        compiled_step: The step bound to its handler.
+        step: The step dictionary passed to the handler.
+    """
+    driver = ctx.driver
+    action = compiled_step.action
+    ctx.step_number = step_number
+    ctx.capture.set_step(step_number)
+    ctx.pacing = step.get('pacing', ctx.settings.get('pacing', ADAPTIVE_PACING))
+    ctx.keystrokes = uses_keystrokes(step, ctx.settings)
+    ctx.condition, ctx.timeout = resolve_wait(step)
+    ctx.timeout = ctx.budget.step_timeout(ctx.timeout)
+    ctx.failure_reason = None
+    if action == 'goto' or action in CLICK_ACTIONS:
+        ctx.budget.set_page_load_timeout(driver)
+    ctx.previous_url = driver.current_url if ctx.condition == URL_CHANGES else None
+    ctx.by = None
+    if step.get('selector'):
+        ctx.by = css_selector_or_xpath(driver, step['selector'], ctx.campaign_id)
+    human_pause(action, ctx.pacing, 'before')
+    if ctx.condition in ELEMENT_CONDITIONS:
+        wait_for_step(ctx, ctx.condition, step, by=ctx.by)
+
+    try:
+        compiled_step.run(ctx, step)
+    except TimeoutException as er:
+        # A click navigating to a page which does not load in time
+        stop_loading(ctx, er)
+
+    if not compiled_step.spec.manages_wait:
+        # Let the page settle after the action, e.g. navigation after a click
+        if ctx.condition in PAGE_CONDITIONS:
+            wait_for_step(ctx, ctx.condition, step, ctx.previous_url)
+        elif action in CLICK_ACTIONS:
+            wait_for_step(ctx, DOCUMENT_READY, step)
+        human_pause(action, ctx.pacing)
+    log_captured(ctx.capture.new_since_last_step())
+    human_pause(action, ctx.pacing, 'step')
+
+
+def restore_journey_snapshot(ctx: JourneyContext, journey: CompiledJourney,
+                             profiler: StepProfiler) -> int:
+    """
+    Restores the snapshot of the longest leading steps the journey shares
+    with another journey of the campaign, if one was taken.
+
+    Returns:
+        int: Number of leading steps covered by the snapshot, 0 if none.
+    """
+    ctx.data['snapshot'] = {'restored_steps': 0, 'taken_by': None}
+    if snapshot_store.latest(ctx.campaign_id, journey) is None:
+        return 0
+    profiler.start(0, {'action': 'restore_snapshot'})
+    snapshot = restore_latest(ctx.driver, ctx.campaign_id, journey)
+    if snapshot is None:
+        profiler.end('not restored')
+        return 0
+    wait_for_condition(ctx.driver, DOCUMENT_READY, {}, DEFAULT_TIMEOUT)
+    profiler.end()
+    # Outcomes of the journey which took the snapshot are not reported as
+    # this one's, its SUBID is kept as the one the attribution belongs to
+    for key, value in copy.deepcopy(snapshot.data).items():
+        if key not in SNAPSHOT_OWN_KEYS:
+            ctx.data[key] = value
+    ctx.capture.restore(snapshot.captured)
+    ctx.first_redirect = snapshot.first_redirect
+    ctx.driver_cookie = list(snapshot.driver_cookie)
+    ctx.data['snapshot'] = {
+        'restored_steps': snapshot.steps,
+        'taken_by': snapshot.title,
+        'attributed_subid': snapshot.data.get('subid'),
+    }
+    return snapshot.steps
+
+
+def save_journey_snapshot(ctx: JourneyContext, journey: CompiledJourney,
+                          step_number: int) -> None:
+    """
+    Snapshots the browser state after the leading steps shared with other
+    journeys, unless another journey already did.
+    """
+    prefix_key = journey.prefix_key(step_number)
+    if snapshot_store.get(ctx.campaign_id, prefix_key) is not None:
+        return
+    try:
+        snapshot = take_snapshot(
+            ctx.driver, journey.title, step_number, ctx.data, ctx.capture.results(),
+            ctx.first_redirect, ctx.driver_cookie)
+    except WebDriverException as er:
+        logging.warning(f'Snapshot after step {step_number} not taken: {er}')
+        return
+    snapshot_store.put(ctx.campaign_id, prefix_key, snapshot)
+    logging.info(f'Snapshot taken after step {step_number}: {snapshot.url}')
+
+
 def shopper_actions_by_steps(
         driver: webdriver.Chrome,
         campaign_id: int,
-        user_journey: Dict,
-        search_list: list = None) -> Dict:
+        user_journey,
+        search_list: list = None,
+        settings: Dict = None) -> Dict:
     """
     Executes a user journey defined in a dictionary format using a WebDriver instance.
 
@@ -193,7 +574,8 @@ def shopper_actions_by_steps(
         driver (webdriver.Chrome): An instance of the WebDriver (e.g., Chrome) used to
                                   interact with the web page.
         campaign_id (int): The campaign ID associated with the user journey.
-        user_journey (Dict): A dictionary containing the user journey information,
+        user_journey (Dict or CompiledJourney): A dictionary containing the user journey information,
+                             or the journey compiled from it by `compiler.compile_journey`,
                              including:
                                 - 'title' (str): The name of the user journey test case.
                                 - 'steps' (list): A list of dictionaries, where each dictionary
@@ -206,9 +588,18 @@ def shopper_actions_by_steps(
                                                     - 'text' (str, optional): The text to enter for "type_in_data" actions.
                                                     - 'element' (str, optional): The value to select from a dropdown menu
                                                                      (used in "drop_down_menu" actions).
+                                                    - 'wait_for' (str, optional): Condition to wait for instead of
+                                                                     the default of the action (see waits.py).
+                                                    - 'timeout' (int, optional): Timeout of the wait condition in secs.
         search_list (list, optional): A list of query parameters or path component patterns to
                                       search for when extracting the order ID from the URL.
                                       If None, defaults to ['order_id', 'order', 'transaction_id'].
+        settings (Dict, optional): Campaign level settings from the YAML, e.g.
+                                   'pacing': 'human' to keep fixed delays between actions
+                                   for anti-bot sites. Defaults to adaptive waits.
+                                   'replay': {'mode': 'record'} records every response of the
+                                   journey, {'mode': 'replay'} serves them from the recording
+                                   without network (see replay.py).
 
     Returns:
         dict: A dictionary containing data collected during the user journey, including:
@@ -222,155 +613,109 @@ def shopper_actions_by_steps(
             - 'Cart' (str, optional): Information about the shopping cart (if applicable).
             - 'Thank_you_page' (str, optional): URL of the 'thank you' page (if applicable).
             - 'Order_number' (str, optional): Order number (if applicable).
-            - 'Request_Response' (str, optional): Any request/response data captured during the journey (if applicable).
+            - 'Request_Response' (list): Requests to tracking domains captured during the journey.
+            - 'resources' (dict): Whether heavy resources were blocked and, per 'goto' step,
+                                  duration, requests and transferred bytes. Only with the
+                                  'baseline' option also the bytes and time saved against
+                                  the unblocked baseline load.
+            - 'screenshots' (list): Screenshots of the journey (step, path, size, sha1, and
+                                    whether it duplicates an earlier image).
+            - 'budget' (dict): The journey budget, steps skipped (journey budget spent or
+                               circuit of their host open) with the wait time saved, and
+                               failed steps (page-load or step timeout, wait condition
+                               not met, no element to click).
+            - 'memory' (dict): Peak RSS in MB of this process, chromedriver and Chrome during
+                               the journey, journeys run by the browser and relaunches so far.
+            - 'replay' (dict, optional): With the 'replay' setting, the archive of the journey and
+                                         the responses recorded, or the responses served from it
+                                         and the requests it has no response to ('unrecorded').
+            - 'snapshot' (dict): Number of leading steps restored from the snapshot of
+                                 another journey ('restored_steps'), its title ('taken_by') and
+                                 the SUBID the restored attribution belongs to
+                                 ('attributed_subid').
+            - 'profile' (dict): Span of every step (action, selector, start/end, duration,
+                                WebDriver commands, captured bytes, wait and work time) and totals.
     """
     start_time = time.time()
-    # Test results template, data to collect
-    data = {
-        'datetime': str(datetime.now().strftime('%d.%m.%Y-%H:%M:%S')),
-        'test_name': user_journey.get('title'),
-        'initial_link': user_journey.get('steps')[0]['url'],
-        'final_url': '',
-        'query_params': '',
-        'cookies': {},
-        'subid': '',
-        'Cart': '',
-        'Thank_you_page': '',
-        'Order_number': '',
-        'Request_Response': '',
-    }
+    journey = user_journey
+    if not isinstance(journey, CompiledJourney):
+        journey = compile_journey(user_journey)
+    initial_url = journey.steps[0].step['url']
+    data = new_journey_data(journey.title, initial_url)
 
     # Add SUBID to the initial link and save it in the data dictionary
-    initial_url = user_journey.get('steps')[0]['url']
     modified_url = add_subid_to_url(initial_url, data)  # Add SUBID and save it
-    user_journey.get('steps')[0]['url'] = modified_url  # Update the URL in the user journey
-
-    first_redirect = True
-
-    for step in user_journey.get('steps'):
-        action = step['action']
-        # Opening required URL
-        if action == 'goto':
-            logging.info(f"Open URL: {step['url']}")
-            driver.get(step['url'])
-            sleep(3)
-            driver_cookie = driver.get_cookies()
-            # Collect and save only first redirect in the user's journey within one testcase
-            if first_redirect:
-                save_first_redirect_url(driver, data)
-                save_specific_cookies(driver, data)
-                first_redirect = False
-            logging.info(f"Redirect URL: {data['final_url']}")
-            logging.info(f"Link parameters: {data['query_params']}")
-            logging.info(f'All cookies: {driver_cookie}')
-            logging.info(f"Admitad cookies: {data['cookies']}")
-        # Set additional time for page to load
-        elif action == 'wait':
-            logging.info(f'Awaiting some event')
-            duration = int(step['value'])
-            sleep(duration)
-            logging.info(f'Waited for {duration} secs')
-            logging.info(f'Current page URL: {driver.current_url}')
-        elif action == 'tab_key':
-            logging.info(f'Attempting TAB to jump')
-            webdriver.ActionChains(driver).send_keys(Keys.TAB).perform()
-            logging.info(f'Success TAB to jump')
-            sleep(1)
-        elif action == 'enter_key':
-            logging.info(f'Attempting ENTER to confirm action')
-            webdriver.ActionChains(driver).send_keys(Keys.ENTER).perform()
-            logging.info(f'Success ENTER to confirm action')
-            sleep(1)
-        elif action == 'arrow_down':
-            logging.info(f'Attempting ARROW DOWN')
-            webdriver.ActionChains(driver).send_keys(Keys.ARROW_DOWN).perform()
-            logging.info(f'Success ARROW DOWN')
-            sleep(1)
-        elif action == 'arrow_up':
-            logging.info(f'Attempting ARROW UP')
-            webdriver.ActionChains(driver).send_keys(Keys.ARROW_UP).perform()
-            logging.info(f'Success ARROW UP')
-            sleep(1)
-        elif action == 'scroll':
-            sleep(1)
-            driver.execute_script('window.scrollBy(0, 250)')
-            logging.info(f'Scroll the page down')
-            sleep(1)
-        # Clicking required object
-        elif action in [
-            'close_popup_window', 'click_object', 'click_add_to_cart',
-            'click_confirm_order', 'click_confirm_payment',
-        ]:
-            logging.info(f'Try to {action}')
-            for request in driver.requests:
-                if request.response and any(
-                        domain in request.url for domain in ['aflink.ru',
-                                                             'ad.admitad.com',
-                                                             'tjzuh.com',
-                                                             'z.asbmit.com',
-                                                             'pafutos.com',
-                                                             'lenkmio.com',
-                                                             ]):
-                    logging.info(f"Captured request to {request.url}:")
-                    logging.info(f" - Method: {request.method}")
-                    logging.info(f" - Headers: {request.headers}")
-                    logging.info(
-                        f" - Response status code: {request.response.status_code}")
-                    logging.info(
-                        f" - Response body: {request.response.body.decode('utf-8')}")
-            try:
-                (driver.find_element(css_selector_or_xpath(
-                    driver, step['selector']))
-                 .click())
-                logging.info(f'All cookies: {driver_cookie}')
-                logging.info(f"Admitad cookies: {data['cookies']}")
-            except:
-                button = webdriver.ActionChains(driver).send_keys(Keys.ESCAPE)
-                button.perform()
-                logging.info(f'Object to click not found, attempted ESCAPE key')
-                logging.info(f'All cookies: {driver_cookie}')
-                logging.info(f"Admitad cookies: {data['cookies']}")
-            sleep(3)
-        # Typing in any fields
-        elif action == 'type_in_data':
-            logging.info(f'Perform type-in')
-            try:
-                logging.info(f'Text element by XPATH')
-                text_input_click_and_clear(driver, By.XPATH, step)
-            except:
-                logging.info(f'Text element by CSS_SELECTOR')
-                text_input_click_and_clear(driver, By.CSS_SELECTOR, step)
-            sleep(0.5)
-        # Selecting option from drop-down menu
-        elif action == 'drop_down_menu':
-            logging.info(f'Searching for selector')
+
+    settings = settings or {}
+    # Capture traffic to tracking domains as it arrives
+    capture = TrackingCapture(settings.get('tracking_domains'))
+    ctx = JourneyContext(driver, campaign_id, data, settings, capture, search_list)
+    # Span per step: timings, WebDriver commands, captured bytes
+    profiler = StepProfiler(driver, capture)
+    # Heavy assets are blocked, except on the first load of a URL with 'baseline'
+    policy = ResourcePolicy(settings.get('resources'), capture.domains)
+    goto_urls = [
+        compiled_step.step['url'] for compiled_step in journey.steps
+        if compiled_step.action == 'goto'
+    ]
+    resources = ResourceReport(campaign_id, policy.apply(
+        driver, not policy.needs_baseline(campaign_id, goto_urls)))
+    memory_governor.start_journey()
+    capture.attach(driver)
+    # Recording of all responses, or all requests served from one (replay.py)
+    session = replay_session(campaign_id, journey.title, settings.get('replay'), capture)
+    if session is not None:
+        session.attach(driver)
+    try:
+        restored = restore_journey_snapshot(ctx, journey, profiler)
+        for step_number, compiled_step in enumerate(journey.steps, start=1):
+            step = compiled_step.step
+            if step_number <= restored:
+                ctx.budget.track(step)
+                continue
+            skip_reason = ctx.budget.skip_reason(step)
+            if skip_reason:
+                ctx.budget.skip(step_number, step, skip_reason)
+                continue
+            if step_number == 1:
+                # The compiled plan is shared, the SUBID goes into a copy
+                step = dict(step, url=modified_url)
+            profiler.start(step_number, step)
             try:
-                element = driver.find_element(By.CSS_SELECTOR, step['selector'])
-                select = Select(element)
-                select.select_by_value(step['element'])
-                logging.info(f'CSS_SELECTOR found')
-            except:
-                element = driver.find_element(By.XPATH, step['selector'])
-                select = Select(element)
-                select.select_by_value(step['element'])
-                logging.info(f'XPATH found')
-            sleep(2)
-        # Making required screenshots, file name contains date and time
-        elif action == 'make_screenshot':
-            folder_name = f'reports/{campaign_id}'
-            file_name = datetime.now().strftime('%d%m%Y-%H%M%S')
-            if not os.path.exists(folder_name):
-                os.mkdir(folder_name)
-            driver.save_screenshot(f'{folder_name}/{file_name}.png')
-            logging.info(f'Screenshot saved in folder')
-        elif action == 'capture_order_confirmation':
-            order_id = extract_order_id_from_url(driver.current_url, search_list)
-            if order_id:
-                data['Order_number'] = order_id
-                logging.info(f"Captured order ID from URL: {order_id}")
-            else:
-                pass
-        sleep(2)
+                run_step(ctx, step_number, compiled_step, step)
+            except Exception as er:
+                profiler.end(str(er))
+                ctx.budget.failed(str(er))
+                raise
+            span = profiler.end()
+            ctx.budget.step_done(step_number, span, ctx.failure_reason)
+            memory_governor.sample(driver)
+            # Storages of these origins are cleared by the 'reset' isolation
+            record_frame_origins(driver)
+            logging.info(
+                f"Step {step_number} {span['action']}: {span['duration']:.2f} sec, "
+                f"{span['commands']} commands, waited {span['wait_time']:.2f} sec"
+            )
+            if compiled_step.action == 'goto':
+                resources.add(driver, step_number, compiled_step.step['url'], span['duration'])
+            if step_number in journey.snapshot_points:
+                save_journey_snapshot(ctx, journey, step_number)
+    finally:
+        if session is not None:
+            session.close(driver)
+        capture.detach(driver)
+        policy.clear(driver)
+        # The tracking traffic is captured, drop what selenium-wire stored
+        if hasattr(driver, 'requests'):
+            del driver.requests
+    data['Request_Response'] = capture.results()
+    data['budget'] = ctx.budget.summary()
+    data['memory'] = memory_governor.journey_summary()
+    if session is not None:
+        data['replay'] = session.summary()
+    data['resources'] = resources.summary()
+    data['screenshots'] = collect_screenshots(ctx.screenshots)
+    data['profile'] = profiler.summary()
     end_time = time.time()
     # Test time measurement and logging
     execution_time = end_time - start_time
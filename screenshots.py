@@ -0,0 +1,128 @@
+import atexit
+import base64
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from selenium.common.exceptions import WebDriverException
+
+from logging_setup import file_part
+
+REPORTS_DIR = 'reports'
+# Image formats encoded by Chrome, file extension of each
+SCREENSHOT_FORMATS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+DEFAULT_FORMAT = 'jpeg'
+DEFAULT_QUALITY = 70
+# Threads decoding, hashing and writing screenshots
+SCREENSHOT_THREADS = 2
+
+
+def valid_screenshot_settings(value) -> bool:
+    """
+    Checks the 'screenshots' campaign setting, e.g.
+    {'format': 'webp', 'quality': 60, 'dedupe': True}.
+    """
+    if not isinstance(value, dict):
+        return False
+    if set(value) - {'format', 'quality', 'dedupe'}:
+        return False
+    if value.get('format', DEFAULT_FORMAT) not in SCREENSHOT_FORMATS:
+        return False
+    quality = value.get('quality', DEFAULT_QUALITY)
+    if isinstance(quality, bool) or not isinstance(quality, int) or not 0 <= quality <= 100:
+        return False
+    return isinstance(value.get('dedupe', True), bool)
+
+
+def capture_screenshot(driver, image_format: str = DEFAULT_FORMAT,
+                       quality: int = DEFAULT_QUALITY) -> str:
+    """
+    Captures the viewport through CDP Page.captureScreenshot, Chrome encodes
+    the image. Falls back to a PNG from WebDriver for other browsers.
+
+    Returns:
+        str: The base64 encoded image, decoded off the driver thread.
+    """
+    params = {'format': image_format}
+    if image_format != 'png':
+        params['quality'] = quality
+    try:
+        return driver.execute_cdp_cmd('Page.captureScreenshot', params)['data']
+    except (AttributeError, WebDriverException) as er:
+        logging.warning(f'CDP screenshot failed ({er}), falling back to PNG')
+        return driver.get_screenshot_as_base64()
+
+
+class ScreenshotWriter:
+    """
+    Writes screenshots in a background thread pool. Images with the same
+    content as an earlier one are not written again, the earlier file is
+    referenced instead.
+    """
+
+    def __init__(self, threads: int = SCREENSHOT_THREADS, reports_dir: str = REPORTS_DIR):
+        self.reports_dir = reports_dir
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='screenshot')
+        self._written = {}
+        self._lock = threading.Lock()
+
+    def path(self, campaign_id, journey: str, subid: str, step_number: int,
+             image_format: str = DEFAULT_FORMAT) -> str:
+        """
+        Returns a file name unique per journey run and step:
+        reports/<campaign_id>/screenshots/<journey>-<subid>-step<NN>.<ext>
+        """
+        return os.path.join(
+            self.reports_dir, str(campaign_id), 'screenshots',
+            f'{file_part(journey)}-{subid}-step{step_number:02d}'
+            f'.{SCREENSHOT_FORMATS[image_format]}')
+
+    def submit(self, encoded: str, path: str, step_number: int,
+               dedupe: bool = True) -> Future:
+        """
+        Queues a base64 encoded screenshot for writing.
+
+        Returns:
+            Future: Resolves to the screenshot entry of the journey result,
+                    {'step', 'path', 'size', 'sha1', 'duplicate'}.
+        """
+        return self._executor.submit(self._write, encoded, path, step_number, dedupe)
+
+    def _write(self, encoded: str, path: str, step_number: int, dedupe: bool) -> Dict:
+        image = base64.b64decode(encoded)
+        digest = hashlib.sha1(image).hexdigest()
+        with self._lock:
+            existing = self._written.get(digest) if dedupe else None
+            if existing is None:
+                self._written[digest] = path
+        entry = {'step': step_number, 'path': existing or path,
+                 'size': len(image), 'sha1': digest, 'duplicate': existing is not None}
+        if existing is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(image)
+        return entry
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def collect_screenshots(futures: List[Future]) -> List[Dict]:
+    """
+    Waits for the queued screenshots of a journey and returns their entries.
+    """
+    screenshots = []
+    for future in futures:
+        try:
+            screenshots.append(future.result())
+        except (OSError, ValueError) as er:
+            logging.error(f'Screenshot not saved: {er}')
+    return screenshots
+
+
+screenshot_writer = ScreenshotWriter()
+atexit.register(screenshot_writer.shutdown)
@@ -0,0 +1,183 @@
+import copy
+import json
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from selenium.common.exceptions import WebDriverException
+
+# Snapshots older than this are not restored, secs
+SNAPSHOT_MAX_AGE = 1800
+# Fields of Network.getAllCookies accepted by Network.setCookies
+COOKIE_PARAMS = (
+    'name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite',
+    'expires', 'priority', 'sameParty', 'sourceScheme', 'sourcePort', 'partitionKey',
+)
+
+STORAGE_SCRIPT = """
+var dump = function (storage) {
+    var items = {};
+    for (var i = 0; i < storage.length; i++) {
+        var key = storage.key(i);
+        items[key] = storage.getItem(key);
+    }
+    return items;
+};
+return {
+    url: location.href,
+    origin: location.origin,
+    local_storage: dump(window.localStorage),
+    session_storage: dump(window.sessionStorage)
+};
+"""
+
+# Fills the storage of the snapshot origin before the scripts of the page run
+RESTORE_SCRIPT = """
+(function (origin, localItems, sessionItems) {
+    if (location.origin !== origin) {
+        return;
+    }
+    try {
+        Object.keys(localItems).forEach(function (key) {
+            localStorage.setItem(key, localItems[key]);
+        });
+        Object.keys(sessionItems).forEach(function (key) {
+            sessionStorage.setItem(key, sessionItems[key]);
+        });
+    } catch (e) {}
+})(%s, %s, %s);
+"""
+
+
+class JourneySnapshot:
+    """
+    Browser state after the leading steps of a journey: cookies of all
+    domains, localStorage and sessionStorage of the current origin, the
+    current URL, and the journey data collected so far.
+    """
+
+    def __init__(self, title: str, steps: int, cookies: List[Dict], storage: Dict,
+                 data: Dict, captured: List[Dict], first_redirect: bool,
+                 driver_cookie: List[Dict]):
+        self.title = title
+        self.steps = steps
+        self.cookies = cookies
+        self.url = storage.get('url')
+        self.origin = storage.get('origin')
+        self.local_storage = storage.get('local_storage') or {}
+        self.session_storage = storage.get('session_storage') or {}
+        self.data = data
+        self.captured = captured
+        self.first_redirect = first_redirect
+        self.driver_cookie = driver_cookie
+        self.taken = time.time()
+
+
+def take_snapshot(driver, title: str, steps: int, data: Dict, captured: List[Dict],
+                  first_redirect: bool, driver_cookie: List[Dict]) -> JourneySnapshot:
+    """
+    Takes a snapshot of the browser state after the first `steps` steps.
+    """
+    cookies = driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+    storage = driver.execute_script(STORAGE_SCRIPT) or {}
+    return JourneySnapshot(
+        title, steps, cookies, storage, copy.deepcopy(data), list(captured),
+        first_redirect, list(driver_cookie))
+
+
+def _cookie_param(cookie: Dict) -> Dict:
+    param = {key: cookie[key] for key in COOKIE_PARAMS if key in cookie}
+    if cookie.get('session') or param.get('expires', 0) < 0:
+        # Session cookie
+        param.pop('expires', None)
+    return param
+
+
+def restore_snapshot(driver, snapshot: JourneySnapshot) -> None:
+    """
+    Restores the cookies and storage of a snapshot and opens its URL.
+    The storage is filled before the scripts of the page run.
+    """
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setCookies', {
+        'cookies': [_cookie_param(cookie) for cookie in snapshot.cookies]})
+    script = RESTORE_SCRIPT % (
+        json.dumps(snapshot.origin),
+        json.dumps(snapshot.local_storage),
+        json.dumps(snapshot.session_storage),
+    )
+    identifier = driver.execute_cdp_cmd(
+        'Page.addScriptToEvaluateOnNewDocument', {'source': script})['identifier']
+    try:
+        driver.get(snapshot.url)
+    finally:
+        driver.execute_cdp_cmd(
+            'Page.removeScriptToEvaluateOnNewDocument', {'identifier': identifier})
+
+
+class SnapshotStore:
+    """
+    Snapshots of the shared leading steps of a campaign's journeys, keyed by
+    campaign and the steps they were taken after.
+    """
+
+    def __init__(self, max_age: float = SNAPSHOT_MAX_AGE):
+        self.max_age = max_age
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get(self, campaign_id, prefix_key: str):
+        with self._lock:
+            snapshot = self._snapshots.get((campaign_id, prefix_key))
+        if snapshot is None or time.time() - snapshot.taken > self.max_age:
+            return None
+        return snapshot
+
+    def put(self, campaign_id, prefix_key: str, snapshot: JourneySnapshot) -> None:
+        with self._lock:
+            self._snapshots[(campaign_id, prefix_key)] = snapshot
+
+    def latest(self, campaign_id, journey) -> JourneySnapshot:
+        """
+        Returns the snapshot of the longest leading steps of the journey
+        shared with another journey, or None.
+        """
+        for steps in sorted(journey.snapshot_points, reverse=True):
+            snapshot = self.get(campaign_id, journey.prefix_key(steps))
+            if snapshot is not None:
+                return snapshot
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
+
+
+def restore_latest(driver, campaign_id, journey) -> JourneySnapshot:
+    """
+    Restores the best snapshot for the journey.
+
+    Returns:
+        JourneySnapshot: The restored snapshot, None if there is none or it
+                         could not be restored (the journey then runs from
+                         its first step).
+    """
+    snapshot = snapshot_store.latest(campaign_id, journey)
+    if snapshot is None:
+        return None
+    try:
+        restore_snapshot(driver, snapshot)
+    except (KeyError, WebDriverException) as er:
+        logging.warning(f'Snapshot of {snapshot.title} not restored ({er}), running all steps')
+        try:
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        except WebDriverException:
+            pass
+        return None
+    logging.info(
+        f'Restored snapshot after {snapshot.steps} steps of {snapshot.title}: {snapshot.url}')
+    return snapshot
+
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,77 @@
+import gzip
+
+import pytest
+
+pytest.importorskip('seleniumwire')
+
+from capture import TrackingCapture  # noqa: E402
+from replay import JourneyRecorder, JourneyReplayer  # noqa: E402
+
+PAGE = b'<html><body>Checkout</body></html>'
+
+
+class Headers(dict):
+    pass
+
+
+class Request:
+    def __init__(self, url, method='GET'):
+        self.url = url
+        self.method = method
+        self.headers = {}
+        self.response = None
+
+    def create_response(self, status_code, headers, body):
+        self.response = (status_code, headers, body)
+
+
+class Response:
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = Headers(headers)
+        self.body = body
+
+
+class Driver:
+    pass
+
+
+def test_gzip_response_is_replayed_decompressed(tmp_path):
+    driver = Driver()
+    recorder = JourneyRecorder(str(tmp_path), TrackingCapture())
+    recorder.attach(driver)
+    driver.response_interceptor(
+        Request('https://shop.example/cart?subid=first'),
+        Response(200, {
+            'Content-Type': 'text/html',
+            'Content-Encoding': 'gzip',
+            'Content-Length': '57',
+        }, gzip.compress(PAGE)))
+    recorder.close(driver)
+
+    replayer = JourneyReplayer(str(tmp_path), TrackingCapture())
+    replayer.attach(driver)
+    request = Request('https://shop.example/cart?subid=second')
+    driver.request_interceptor(request)
+    replayer.close(driver)
+
+    status_code, headers, body = request.response
+    assert status_code == 200
+    # The proxy encodes by Content-Encoding again, the body must be plain
+    assert body == PAGE
+    assert [name.lower() for name, _ in headers] == ['content-type']
+    assert replayer.summary()['unrecorded'] == []
+
+
+def test_unrecorded_request_gets_404(tmp_path):
+    driver = Driver()
+    recorder = JourneyRecorder(str(tmp_path), TrackingCapture())
+    recorder.close(driver)
+
+    replayer = JourneyReplayer(str(tmp_path), TrackingCapture())
+    replayer.attach(driver)
+    request = Request('https://cdn.example/app.js')
+    driver.request_interceptor(request)
+
+    assert request.response[0] == 404
+    assert replayer.summary()['unrecorded'][0]['url'] == 'https://cdn.example/app.js'
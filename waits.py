@@ -0,0 +1,231 @@
+import logging
+import time
+from time import sleep
+from typing import Dict, Optional, Tuple
+
+from selenium.common.exceptions import (
+    InvalidSelectorException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Names of conditions which can be used in 'wait_for' of a YAML step
+DOCUMENT_READY = 'document_ready'
+CLICKABLE = 'clickable'
+VISIBLE = 'visible'
+URL_CHANGES = 'url_changes'
+NETWORK_IDLE = 'network_idle'
+COOKIE_PRESENT = 'cookie_present'
+NO_WAIT = 'none'
+
+# Element conditions are checked before the action, page conditions after it
+ELEMENT_CONDITIONS = (CLICKABLE, VISIBLE)
+PAGE_CONDITIONS = (DOCUMENT_READY, URL_CHANGES, NETWORK_IDLE, COOKIE_PRESENT)
+
+CLICK_ACTIONS = [
+    'close_popup_window', 'click_object', 'click_add_to_cart',
+    'click_confirm_order', 'click_confirm_payment',
+]
+KEY_ACTIONS = ['tab_key', 'enter_key', 'arrow_down', 'arrow_up']
+
+# Default condition for every action type
+DEFAULT_CONDITIONS = {
+    'goto': DOCUMENT_READY,
+    'wait': NETWORK_IDLE,
+    'type_in_data': VISIBLE,
+    'drop_down_menu': VISIBLE,
+    'scroll': NO_WAIT,
+    'make_screenshot': DOCUMENT_READY,
+    'capture_order_confirmation': DOCUMENT_READY,
+}
+DEFAULT_CONDITIONS.update({action: CLICKABLE for action in CLICK_ACTIONS})
+DEFAULT_CONDITIONS.update({action: DOCUMENT_READY for action in KEY_ACTIONS})
+
+DEFAULT_TIMEOUT = 10
+POLL_FREQUENCY = 0.1
+# Network is treated as idle when no new requests appeared for this time
+NETWORK_IDLE_TIME = 0.5
+
+# Pacing modes, 'human' keeps the fixed delays for anti-bot sites
+ADAPTIVE_PACING = 'adaptive'
+HUMAN_PACING = 'human'
+
+# Fixed delays (secs) of human pacing: (before action, after action)
+HUMAN_DELAYS = {
+    'goto': (0, 3),
+    'drop_down_menu': (0, 2),
+    'type_in_data': (0, 0.5),
+    'scroll': (1, 1),
+}
+HUMAN_DELAYS.update({action: (0, 3) for action in CLICK_ACTIONS})
+HUMAN_DELAYS.update({action: (0, 1) for action in KEY_ACTIONS})
+# Delay added after every step in human pacing
+HUMAN_STEP_DELAY = 2
+
+# Total time spent in waits and pauses by this process, for step profiling
+_waited = {'secs': 0.0}
+
+
+def waited_time() -> float:
+    """
+    Returns the total time in seconds spent waiting by this process so far.
+    """
+    return _waited['secs']
+
+
+def pause(secs: float) -> None:
+    """
+    Sleeps and accounts the time as waiting.
+    """
+    sleep(secs)
+    _waited['secs'] += secs
+
+
+def resolve_wait(step: Dict) -> Tuple[str, float]:
+    """
+    Resolves the wait condition and timeout for a step.
+
+    The condition and timeout may be overridden in the YAML with
+    'wait_for' and 'timeout' keys, otherwise the defaults of the action are used.
+
+    Args:
+        step: A dictionary containing the step information.
+
+    Returns:
+        tuple: The condition name and the timeout in seconds.
+    """
+    condition = step.get('wait_for') or DEFAULT_CONDITIONS.get(
+        step['action'], DOCUMENT_READY)
+    timeout = step.get('timeout')
+    if timeout is None and step['action'] == 'wait' and step.get('value'):
+        # Explicit wait step, its value is the upper bound of waiting
+        timeout = step['value']
+    timeout = float(timeout) if timeout is not None else DEFAULT_TIMEOUT
+    return condition, timeout
+
+
+def _find_displayed(driver, selector: str, clickable: bool = False, by=None):
+    """
+    Returns the first displayed (and enabled) element matched by the selector,
+    False if there is no such element yet. Both CSS selector and XPath are
+    tried if the locator type is not known.
+    """
+    for by in ((by,) if by else (By.CSS_SELECTOR, By.XPATH)):
+        try:
+            elements = driver.find_elements(by, selector)
+        except InvalidSelectorException:
+            continue
+        for element in elements:
+            try:
+                if element.is_displayed() and (
+                        not clickable or element.is_enabled()):
+                    return element
+            except WebDriverException:
+                # Element went stale while checking, try again on next poll
+                return False
+    return False
+
+
+def _document_ready(driver):
+    return driver.execute_script('return document.readyState') == 'complete'
+
+
+def _network_idle(driver, idle_time: float = NETWORK_IDLE_TIME):
+    """
+    Builds a condition which is true when no request is pending in
+    selenium-wire and no new resource finished loading in the page for idle_time.
+
+    selenium-wire stores only the requests in its scopes, so finished
+    resources are counted with the Resource Timing API of the page as well.
+    """
+    state = {'count': -1, 'since': time.time()}
+
+    def condition(d):
+        requests = getattr(d, 'requests', [])
+        pending = any(request.response is None for request in requests)
+        count = d.execute_script(
+            'return performance.getEntriesByType("resource").length'
+        ) + len(requests)
+        if count != state['count'] or pending:
+            state['count'] = count
+            state['since'] = time.time()
+            return False
+        return (time.time() - state['since'] >= idle_time
+                and _document_ready(d))
+    return condition
+
+
+def wait_for_condition(
+        driver,
+        condition: str,
+        step: Dict,
+        timeout: float,
+        previous_url: Optional[str] = None,
+        by: Optional[str] = None) -> bool:
+    """
+    Waits until the given condition is met or the timeout expires.
+
+    Args:
+        driver: The Selenium WebDriver instance.
+        condition: The name of the condition (e.g. 'document_ready', 'clickable').
+        step: A dictionary containing the step information,
+              'selector' is used for element conditions and 'cookie' for cookie_present.
+        timeout: Maximum time to wait in seconds.
+        previous_url: URL before the action, used by 'url_changes'.
+        by: Locator type of the selector for element conditions, if known.
+
+    Returns:
+        bool: True if the condition was met, False on timeout.
+    """
+    if condition == NO_WAIT or timeout <= 0:
+        return True
+    if condition in ELEMENT_CONDITIONS:
+        if not step.get('selector'):
+            return True
+        clickable = condition == CLICKABLE
+        predicate = lambda d: _find_displayed(d, step['selector'], clickable, by)
+    elif condition == DOCUMENT_READY:
+        predicate = _document_ready
+    elif condition == URL_CHANGES:
+        predicate = lambda d: d.current_url != previous_url
+    elif condition == NETWORK_IDLE:
+        predicate = _network_idle(driver)
+    elif condition == COOKIE_PRESENT:
+        predicate = lambda d: d.get_cookie(step['cookie']) is not None
+    else:
+        raise ValueError(f'Unsupported wait condition: {condition}')
+
+    started = time.time()
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY).until(
+            predicate)
+        logging.info(f'Wait condition met: {condition}')
+        return True
+    except TimeoutException:
+        logging.warning(f'Wait condition {condition} not met in {timeout} secs')
+        return False
+    finally:
+        _waited['secs'] += time.time() - started
+
+
+def human_pause(action: str, pacing: str, when: str = 'after') -> None:
+    """
+    Sleeps for the fixed delay of the action if human pacing is enabled.
+
+    Args:
+        action: The action of the step.
+        pacing: Pacing mode, 'adaptive' (default) or 'human'.
+        when: 'before' or 'after' the action, or 'step' for the delay
+              which follows every step.
+    """
+    if pacing != HUMAN_PACING:
+        return
+    if when == 'step':
+        pause(HUMAN_STEP_DELAY)
+        return
+    before, after = HUMAN_DELAYS.get(action, (0, 0))
+    delay = before if when == 'before' else after
+    if delay:
+        pause(delay)
@@ -0,0 +1,227 @@
+import logging
+import multiprocessing
+import queue
+import shutil
+import tempfile
+from logging.handlers import QueueListener
+from typing import Callable, Dict, List
+
+from selenium.common.exceptions import WebDriverException
+
+from isolation import isolate_journey
+from logging_setup import (
+    configure_worker_logging,
+    listener_handlers,
+    log_options,
+    set_log_context,
+)
+
+# How many times a journey is re-queued after its browser died
+MAX_JOB_ATTEMPTS = 3
+# How often the pool checks whether worker processes are alive, secs
+POLL_INTERVAL = 1
+
+
+def _browser_alive(driver) -> bool:
+    """
+    Checks whether the browser behind the driver still responds.
+    """
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def _worker_main(worker_id: int, job_queue, event_queue, log_queue,
+                 log_options: Dict = None) -> None:
+    """
+    Worker process: launches its own headless Chrome with an isolated
+    user-data-dir and runs journeys from the job queue until it gets None.
+
+    Events sent back to the pool:
+        ('started', worker_id, job_id)
+        ('done', worker_id, job_id, result)
+        ('failed', worker_id, job_id, error) - journey failed, browser is fine
+        ('crashed', worker_id, job_id, error) - browser died, journey is re-queued
+    """
+    # Imported here, main imports this module
+    from budgets import circuit_breaker
+    from compiler import load_plugins
+    from locators import locator_cache
+    from main import fresh_browser
+    from memory import memory_governor
+    from run_func import shopper_actions_by_steps
+
+    # Send log records to the pool process, it writes the log files
+    configure_worker_logging(log_queue, **(log_options or {}))
+
+    user_data_dir = tempfile.mkdtemp(prefix=f'chrome_worker_{worker_id}_')
+    driver = fresh_browser(user_data_dir)
+    browser_is_fresh = True
+    try:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            event_queue.put(('started', worker_id, job['job_id']))
+            set_log_context(job['campaign_id'], job['user_journey'].title)
+            skip_reason = circuit_breaker.skip_reason(job['campaign_id'], job['user_journey'])
+            if skip_reason:
+                logging.warning(skip_reason)
+                event_queue.put(('failed', worker_id, job['job_id'], skip_reason))
+                continue
+            logging.info(
+                f"Worker {worker_id} running test for campaign id: {job['campaign_id']}"
+            )
+            try:
+                if not browser_is_fresh:
+                    reason = memory_governor.recycle_reason((job['settings'] or {}).get('memory'))
+                    if reason:
+                        driver = memory_governor.recycle(
+                            driver, reason, lambda: fresh_browser(user_data_dir))
+                    else:
+                        driver = isolate_journey(
+                            driver,
+                            (job['settings'] or {}).get('isolation'),
+                            lambda: fresh_browser(user_data_dir)
+                        )
+                browser_is_fresh = False
+                load_plugins((job['settings'] or {}).get('plugins'))
+                result = shopper_actions_by_steps(
+                    driver,
+                    job['campaign_id'],
+                    job['user_journey'],
+                    settings=job['settings']
+                )
+            except Exception as er:
+                if _browser_alive(driver):
+                    event_queue.put(('failed', worker_id, job['job_id'], str(er)))
+                    continue
+                # Browser is gone, let the pool re-queue the journey and
+                # start a fresh worker
+                event_queue.put(('crashed', worker_id, job['job_id'], str(er)))
+                return
+            event_queue.put(('done', worker_id, job['job_id'], result))
+    finally:
+        locator_cache.save()
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+
+
+def run_journeys_in_workers(jobs: List[Dict], workers: int,
+                            on_result: Callable = None,
+                            on_failure: Callable = None) -> Dict:
+    """
+    Runs journeys in a pool of worker processes, each with its own browser.
+
+    A journey whose browser crashed (or whose worker process died) is
+    re-queued to a freshly started worker, up to MAX_JOB_ATTEMPTS times.
+    Log records of the workers are written by the log file handlers of the
+    calling process (see logging_setup).
+
+    Args:
+        jobs: A list of dictionaries with 'job_id', 'campaign_id',
+              'user_journey' (compiled journey) and 'settings' keys.
+        workers: Number of worker processes (browsers) to start.
+        on_result: Called as on_result(job, result) as soon as a journey is done.
+        on_failure: Called as on_failure(job, error) for a journey given up on.
+
+    Returns:
+        dict: Results of the successful journeys keyed by job_id.
+    """
+    context = multiprocessing.get_context('spawn')
+    job_queue = context.Queue()
+    event_queue = context.Queue()
+    log_queue = context.Queue()
+    listener = QueueListener(log_queue, *listener_handlers(), respect_handler_level=True)
+    listener.start()
+
+    jobs_by_id = {job['job_id']: job for job in jobs}
+    attempts = {job_id: 0 for job_id in jobs_by_id}
+    pending = set(jobs_by_id)
+    results = {}
+    in_flight = {}
+    processes = {}
+    next_worker_id = 0
+
+    def start_worker():
+        nonlocal next_worker_id
+        process = context.Process(
+            target=_worker_main,
+            args=(next_worker_id, job_queue, event_queue, log_queue, log_options()),
+            daemon=True,
+        )
+        process.start()
+        processes[next_worker_id] = process
+        next_worker_id += 1
+
+    def requeue(job_id, reason):
+        attempts[job_id] += 1
+        if attempts[job_id] >= MAX_JOB_ATTEMPTS:
+            logging.error(f'Giving up on job {job_id} after {attempts[job_id]} attempts: {reason}')
+            pending.discard(job_id)
+            if on_failure:
+                on_failure(jobs_by_id[job_id], reason)
+            return
+        logging.warning(f'Re-queue job {job_id}: {reason}')
+        job_queue.put(jobs_by_id[job_id])
+
+    def handle(event):
+        kind, worker_id, job_id = event[:3]
+        if kind == 'started':
+            in_flight[worker_id] = job_id
+            return
+        in_flight.pop(worker_id, None)
+        if kind == 'done':
+            results[job_id] = event[3]
+            pending.discard(job_id)
+            if on_result:
+                on_result(jobs_by_id[job_id], event[3])
+        elif kind == 'failed':
+            logging.error(f'ERROR ({event[3]}) in job {job_id}')
+            pending.discard(job_id)
+            if on_failure:
+                on_failure(jobs_by_id[job_id], event[3])
+        elif kind == 'crashed':
+            requeue(job_id, f'browser crashed ({event[3]})')
+
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(min(workers, len(jobs))):
+        start_worker()
+
+    try:
+        while pending:
+            try:
+                handle(event_queue.get(timeout=POLL_INTERVAL))
+            except queue.Empty:
+                pass
+            # Drain the events before checking the processes, so a result
+            # sent right before the exit is not lost
+            while True:
+                try:
+                    handle(event_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for worker_id, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                del processes[worker_id]
+                job_id = in_flight.pop(worker_id, None)
+                if job_id in pending:
+                    requeue(job_id, f'worker {worker_id} exited with {process.exitcode}')
+                if pending:
+                    start_worker()
+    finally:
+        for _ in processes:
+            job_queue.put(None)
+        for process in processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        listener.stop()
+    return results